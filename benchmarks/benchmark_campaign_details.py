@@ -0,0 +1,66 @@
+"""
+Measures how many round trips and how much time it takes to fetch the details of every active campaign for a single
+poll, using different batch sizes. Each batch size runs a full poll with a new watchdog and in-memory storage, so the
+round trips include the request for the drops dashboard.
+
+Usage: python -m benchmarks.benchmark_campaign_details [--campaigns 150] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from twitch_drops_notifier.storage import create_storage
+from twitch_drops_notifier.twitch import Client
+from twitch_drops_notifier.twitch_drops_watchdog import TwitchDropsWatchdog
+from .fake_gql_server import FakeGQLServer, generate_campaigns
+
+
+def get_new_campaign_details(watchdog):
+    """
+    Poll once with a watchdog that has not seen any campaigns yet.
+    :return: The campaign details passed to the watchdog's listeners.
+    """
+    new_campaign_details = []
+    watchdog.add_on_new_campaign_details_listener(new_campaign_details.extend)
+    asyncio.run(watchdog.run_once())
+    return new_campaign_details
+
+
+def run(campaign_count, latency_seconds, batch_sizes, max_concurrent_requests):
+    campaigns = generate_campaigns(campaign_count)
+
+    results = []
+    with FakeGQLServer(campaigns, latency_seconds=latency_seconds) as server:
+        for batch_size in batch_sizes:
+            twitch_client = Client(client_id=Client.CLIENT_ID_TV, oath_token='benchmark', user_id='benchmark', url=server.url)
+            watchdog = TwitchDropsWatchdog(twitch_client, create_storage('memory'), details_batch_size=batch_size, max_concurrent_requests=max_concurrent_requests)
+
+            server.reset_counters()
+            start_time = time.perf_counter()
+            campaign_details = get_new_campaign_details(watchdog)
+            elapsed = time.perf_counter() - start_time
+
+            assert len(campaign_details) == len(campaigns)
+            results.append({
+                'batch_size': batch_size,
+                'max_concurrent_requests': max_concurrent_requests,
+                'round_trips': server.request_count,
+                'retries': twitch_client.stats.retry_count,
+                'average_latency_seconds': round(twitch_client.stats.average_latency_seconds, 4),
+                'wall_time_seconds': round(elapsed, 4)
+            })
+            twitch_client.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--campaigns', dest='campaigns', default=150, type=int)
+    parser.add_argument('--latency', help='Simulated server latency in seconds.', dest='latency', default=0.05, type=float)
+    parser.add_argument('--batch-sizes', dest='batch_sizes', default=[1, 10, 25, 35], type=int, nargs='+')
+    parser.add_argument('--max-concurrent-requests', dest='max_concurrent_requests', default=1, type=int)
+    args = parser.parse_args()
+
+    for result in run(args.campaigns, args.latency, args.batch_sizes, args.max_concurrent_requests):
+        print(json.dumps(result))
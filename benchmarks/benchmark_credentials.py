@@ -0,0 +1,67 @@
+"""
+Measures how spreading requests across several OAuth tokens speeds up fetching the details of every active campaign
+when the server limits the number of requests each token can send. One invalid token can be added to the pool to check
+that it is quarantined after its first rejection instead of slowing down every poll.
+
+Usage: python -m benchmarks.benchmark_credentials [--tokens 1 2 4] [--invalid-tokens 1] [--token-requests-per-minute 600]
+"""
+import argparse
+import json
+import time
+
+from twitch_drops_notifier.storage import create_storage
+from twitch_drops_notifier.twitch import Client, Credential, CredentialPool
+from twitch_drops_notifier.twitch_drops_watchdog import TwitchDropsWatchdog
+from .benchmark_campaign_details import get_new_campaign_details
+from .fake_gql_server import FakeGQLServer, generate_campaigns
+
+
+def run(args, token_count):
+    campaigns = generate_campaigns(args.campaigns)
+
+    tokens = [f'valid-{i}' for i in range(token_count)]
+    invalid_tokens = [f'invalid-{i}' for i in range(args.invalid_tokens)]
+    credentials = CredentialPool([Credential(token, 'benchmark', args.client_requests_per_minute) for token in invalid_tokens + tokens])
+
+    server = FakeGQLServer(campaigns, latency_seconds=args.latency, token_requests_per_minute=args.token_requests_per_minute,
+                           token_burst=args.token_burst, invalid_tokens=invalid_tokens)
+    with server:
+        twitch_client = Client(client_id=Client.CLIENT_ID_TV, credentials=credentials, url=server.url, max_retries=args.max_retries,
+                               pool_size=4 * len(credentials))
+        watchdog = TwitchDropsWatchdog(twitch_client, create_storage('memory'), details_batch_size=args.batch_size, max_concurrent_requests=4 * len(credentials))
+
+        start_time = time.perf_counter()
+        campaign_details = get_new_campaign_details(watchdog)
+        elapsed = time.perf_counter() - start_time
+        twitch_client.close()
+
+        return {
+            'tokens': token_count,
+            'invalid_tokens': len(invalid_tokens),
+            'campaigns_fetched': len(campaign_details),
+            'round_trips': server.request_count,
+            'rate_limited': server.rate_limited_count,
+            'unauthorized': server.auth_error_count,
+            'requests_per_token': dict(sorted(server.token_request_counts.items())),
+            'wall_time_seconds': round(elapsed, 3)
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', help='The numbers of valid tokens to run the benchmark with.', dest='tokens', nargs='+', default=[1, 2, 4], type=int)
+    parser.add_argument('--invalid-tokens', help='The number of invalid tokens to add to the pool.', dest='invalid_tokens', default=1, type=int)
+    parser.add_argument('--campaigns', dest='campaigns', default=150, type=int)
+    parser.add_argument('--batch-size', help='Use small batches so that there are enough requests to hit the limit.', dest='batch_size', default=1, type=int)
+    parser.add_argument('--latency', help='Simulated server latency in seconds.', dest='latency', default=0.05, type=float)
+    parser.add_argument('--token-requests-per-minute', help='The number of requests the server allows per token per minute.',
+                        dest='token_requests_per_minute', default=600, type=float)
+    parser.add_argument('--token-burst', help='The number of requests the server allows per token at once.', dest='token_burst', default=10, type=int)
+    parser.add_argument('--client-requests-per-minute', help='The budget the client assumes for each token. By default, this is the server limit.',
+                        dest='client_requests_per_minute', default=None, type=float)
+    parser.add_argument('--max-retries', dest='max_retries', default=10, type=int)
+    args = parser.parse_args()
+    if args.client_requests_per_minute is None:
+        args.client_requests_per_minute = args.token_requests_per_minute
+
+    print(json.dumps([run(args, token_count) for token_count in args.tokens], indent=2))
@@ -0,0 +1,184 @@
+"""
+Measures how notifying several webhook channels affects polling, with one channel that is much slower than the others.
+Each round stands in for a poll that found new campaigns, and passes the campaigns a watchdog polling the fake GQL
+server gave its listeners. The channels share a session and POST to a local HTTP sink that counts the requests and
+campaigns of each channel and the connections they opened, and takes longer to respond to the slow one.
+
+The listeners are either called one after another, like the watchdog used to, or queued on a NotificationDispatcher.
+The time the poll is blocked for, and the time until the fast channels and every channel received all campaigns, are
+recorded for both.
+
+Usage: python -m benchmarks.benchmark_dispatcher [--channels 8] [--campaigns 50] [--rounds 3] [--slow-latency 0.5]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from twitch_drops_notifier.dispatcher import NotificationDispatcher
+from twitch_drops_notifier.storage import create_storage
+from twitch_drops_notifier.twitch import Client
+from twitch_drops_notifier.twitch_drops_watchdog import TwitchDropsWatchdog
+from twitch_drops_notifier.webhooks import WebhookChannel, create_session
+from .fake_gql_server import FakeGQLServer, generate_campaigns
+
+
+class WebhookSink:
+    """
+    A local HTTP server that accepts webhook payloads. Each channel posts to its own path, and the time the server takes
+    to respond can be set for each path.
+    """
+
+    def __init__(self, latencies, host: str = 'localhost', port: int = 0):
+        """
+        Creates a new WebhookSink.
+        :param latencies: A dictionary mapping paths to the number of seconds to wait before responding.
+        """
+        self._latencies = latencies
+        self._lock = threading.Lock()
+        self.request_counts = collections.Counter()
+        self.campaign_counts = collections.Counter()
+        self.connections = set()
+        self.last_request_times = {}
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # Allow clients to reuse connections
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                time.sleep(sink._latencies.get(self.path, 0))
+                with sink._lock:
+                    sink.request_counts[self.path] += 1
+                    sink.campaign_counts[self.path] += len(body.get('campaigns', []))
+                    sink.connections.add(self.client_address)
+                    sink.last_request_times[self.path] = time.perf_counter()
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self._http_server = ThreadingHTTPServer((host, port), Handler)
+        self._http_server.daemon_threads = True
+
+    def get_url(self, path: str) -> str:
+        host, port = self._http_server.server_address[:2]
+        return f'http://{host}:{port}{path}'
+
+    def wait_for(self, paths, campaign_count: int, timeout_seconds: float):
+        """
+        Wait until every path received `campaign_count` campaigns.
+        :return: The time the last of them was received, or None if the timeout was reached.
+        """
+        deadline = time.perf_counter() + timeout_seconds
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if all(self.campaign_counts[path] >= campaign_count for path in paths):
+                    return max(self.last_request_times[path] for path in paths)
+            time.sleep(0.01)
+        return None
+
+    def __enter__(self):
+        threading.Thread(target=self._http_server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+
+def get_new_campaign_details(rounds: int, campaign_count: int):
+    """
+    Poll the fake GQL server with a watchdog, publishing new campaigns before each poll.
+    :return: A list with the new campaign details passed to the watchdog's listeners by each poll.
+    """
+    results = []
+    with FakeGQLServer([]) as server:
+        twitch_client = Client(client_id=Client.CLIENT_ID_TV, oath_token='benchmark', user_id='benchmark', url=server.url, backoff_seconds=0.01)
+        watchdog = TwitchDropsWatchdog(twitch_client, create_storage('memory'))
+        watchdog.add_on_new_campaign_details_listener(results.append)
+        for _ in range(rounds):
+            server.set_campaigns(generate_campaigns(campaign_count))
+            asyncio.run(watchdog.run_once())
+        twitch_client.close()
+    return results
+
+
+async def call_sequentially(listeners, parameters):
+    # How the watchdog called its listeners before they were moved to a dispatcher
+    for listener in listeners:
+        await asyncio.to_thread(listener, parameters)
+
+
+def run(args, mode, new_campaign_details):
+    fast_paths = [f'/fast/{i}' for i in range(args.channels)]
+    latencies = {path: args.fast_latency for path in fast_paths}
+    latencies['/slow'] = args.slow_latency
+
+    with WebhookSink(latencies) as sink:
+        session = create_session()
+        channels = [WebhookChannel(sink.get_url(path), 'json', session=session, name=path, batch_size=args.batch_size) for path in ['/slow'] + fast_paths]
+        listeners = [channel.on_new_campaign_details for channel in channels]
+
+        async def run_rounds():
+            dispatcher = NotificationDispatcher(max_workers=len(listeners))
+            blocked_seconds = 0.0
+            for campaigns in new_campaign_details:
+                start_time = time.perf_counter()
+                if mode == 'sequential':
+                    await call_sequentially(listeners, campaigns)
+                else:
+                    dispatcher.dispatch(listeners, campaigns)
+                blocked_seconds += time.perf_counter() - start_time
+
+                # Stand in for the rest of the poll
+                await asyncio.sleep(args.poll_seconds)
+            await dispatcher.close()
+            return blocked_seconds
+
+        start_time = time.perf_counter()
+        loop_thread_result = {}
+        thread = threading.Thread(target=lambda: loop_thread_result.update(blocked_seconds=asyncio.run(run_rounds())))
+        thread.start()
+
+        expected = sum(len(x) for x in new_campaign_details)
+        fast_done_time = sink.wait_for(fast_paths, expected, args.timeout)
+        all_done_time = sink.wait_for(['/slow'] + fast_paths, expected, args.timeout)
+        thread.join()
+        session.close()
+
+        return {
+            'mode': mode,
+            'channels': len(channels),
+            'poll_blocked_seconds': round(loop_thread_result['blocked_seconds'], 3),
+            'fast_channels_done_seconds': None if fast_done_time is None else round(fast_done_time - start_time, 3),
+            'all_channels_done_seconds': None if all_done_time is None else round(all_done_time - start_time, 3),
+            'requests': sum(sink.request_counts.values()),
+            'campaigns_delivered': sum(sink.campaign_counts.values()),
+            'connections': len(sink.connections)
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', dest='modes', nargs='+', choices=('sequential', 'dispatcher'), default=['sequential', 'dispatcher'])
+    parser.add_argument('--channels', help='The number of fast webhook channels. One slow channel is always added.', dest='channels', default=8, type=int)
+    parser.add_argument('--campaigns', help='The number of new campaigns found by each poll.', dest='campaigns', default=50, type=int)
+    parser.add_argument('--rounds', help='The number of polls that find new campaigns.', dest='rounds', default=3, type=int)
+    parser.add_argument('--batch-size', dest='batch_size', default=10, type=int)
+    parser.add_argument('--fast-latency', help='The number of seconds the fast channels take to respond.', dest='fast_latency', default=0.01, type=float)
+    parser.add_argument('--slow-latency', help='The number of seconds the slow channel takes to respond.', dest='slow_latency', default=0.5, type=float)
+    parser.add_argument('--poll-seconds', help='The time each poll takes besides notifying listeners.', dest='poll_seconds', default=0.1, type=float)
+    parser.add_argument('--timeout', dest='timeout', default=120, type=float)
+    args = parser.parse_args()
+
+    new_campaign_details = get_new_campaign_details(args.rounds, args.campaigns)
+    print(json.dumps([run(args, mode, new_campaign_details) for mode in args.modes], indent=2))
@@ -0,0 +1,81 @@
+"""
+Compares finding the users subscribed to a set of new campaigns by scanning every user against using the UserIndex.
+
+Usage: python -m benchmarks.benchmark_fan_out [--users 100000] [--campaigns 200] [--games 500]
+"""
+import argparse
+import json
+import random
+import time
+
+from twitch_drops_notifier.user_index import UserIndex
+
+
+def generate_users(count, game_count, all_games_fraction=0.05):
+    users = []
+    for i in range(count):
+        games = []
+        if random.random() >= all_games_fraction:
+            games = [str(100000 + x) for x in random.sample(range(game_count), random.randint(1, 10))]
+        users.append({
+            'email': f'user{i}@example.com',
+            'id': str(i),
+            'games': games,
+            'timezone': 'UTC',
+            'new_game_notifications': random.random() < 0.5
+        })
+    return users
+
+
+def generate_campaigns(count, game_count):
+    return [{'id': str(i), 'name': f'Campaign {i}', 'game': {'id': str(100000 + random.randrange(game_count))}} for i in range(count)]
+
+
+def fan_out_scan(users, campaigns):
+    result = []
+    for user in users:
+        subscribed_campaigns = []
+        for campaign in campaigns:
+            if len(user['games']) == 0 or campaign['game']['id'] in user['games']:
+                subscribed_campaigns.append(campaign)
+        if len(subscribed_campaigns) > 0:
+            result.append((user, subscribed_campaigns))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', dest='users', default=100000, type=int)
+    parser.add_argument('--campaigns', dest='campaigns', default=200, type=int)
+    parser.add_argument('--games', dest='games', default=500, type=int)
+    args = parser.parse_args()
+
+    random.seed(0)
+    users = generate_users(args.users, args.games)
+    campaigns = generate_campaigns(args.campaigns, args.games)
+
+    start_time = time.perf_counter()
+    user_index = UserIndex()
+    for user in users:
+        user_index.add_or_update(user)
+    build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    scan_result = fan_out_scan(users, campaigns)
+    scan_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    index_result = user_index.get_subscribed_campaigns(campaigns)
+    index_time = time.perf_counter() - start_time
+
+    assert len(scan_result) == len(index_result)
+
+    print(json.dumps({
+        'users': args.users,
+        'campaigns': args.campaigns,
+        'recipients': len(index_result),
+        'index_build_seconds': round(build_time, 4),
+        'scan_seconds': round(scan_time, 4),
+        'index_seconds': round(index_time, 4),
+        'speedup': round(scan_time / index_time, 1) if index_time > 0 else None
+    }))
@@ -0,0 +1,205 @@
+"""
+Runs full poll cycles of the watchdog against the fake GQL server, with emails sent through the outbox to a local
+aiosmtpd sink. Each cycle adds and changes some campaigns before polling, like a real day of drops. Wall time, HTTP
+requests, database operations and emails sent are recorded for every cycle and can be compared against a baseline.
+
+Requires aiosmtpd: pip install aiosmtpd
+
+To use the Firestore emulator instead of in-memory storage, start it first and pass --storage firestore:
+gcloud emulators firestore start --host-port=localhost:8080
+
+The stored baseline was recorded with the default arguments. Times depend on the machine, so record a new baseline with
+--save-baseline before comparing on a different one.
+
+Usage: python -m benchmarks.benchmark_poll_cycle [--cycles 5] [--campaigns 200] [--users 2000] [--storage memory]
+       [--baseline benchmarks/poll_cycle_baseline.json] [--save-baseline]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from aiosmtpd.controller import Controller
+
+from twitch_drops_notifier.emails import EmailSender
+from twitch_drops_notifier.storage import create_storage
+from twitch_drops_notifier.twitch import Client
+from twitch_drops_notifier.twitch_drops_watchdog import TwitchDropsWatchdog
+from .benchmark_smtp import CountingHandler, get_free_port
+from .fake_gql_server import FakeGQLServer, generate_campaigns
+
+# Metrics that are compared against the baseline. Counts must not increase, and times must stay within the tolerance.
+COUNT_METRICS = ('http_requests', 'db_operations', 'emails_sent')
+TIME_METRICS = ('poll_seconds',)
+
+
+def generate_users(count, game_count):
+    users = []
+    for i in range(count):
+        users.append({
+            'email': f'user{i}@example.com',
+            'games': [str(100000 + x) for x in random.sample(range(game_count), random.randint(0, min(game_count, 5)))],
+            'timezone': random.choice(['UTC', 'America/New_York', 'Europe/Berlin', 'Asia/Tokyo']),
+            'id': str(uuid.uuid4()),
+            'created': '2023-01-01T00:00:00+00:00',
+            'new_game_notifications': random.random() < 0.5
+        })
+    return users
+
+
+def change_campaigns(campaigns, new_count, changed_count, game_count):
+    """
+    Simulate the changes between two polls by adding new campaigns and renaming some existing ones.
+    :return: The new list of campaigns.
+    """
+    campaigns = [dict(x) for x in campaigns]
+    for campaign in random.sample(campaigns, min(len(campaigns), changed_count)):
+        campaign['name'] += ' (updated)'
+    for campaign in generate_campaigns(new_count, game_count * 2):
+        campaign['name'] = f'New {campaign["name"]}'
+        campaigns.append(campaign)
+    return campaigns
+
+
+def wait_for_emails(email_sender, timeout_seconds):
+    if not email_sender.flush(timeout_seconds):
+        raise TimeoutError('Emails were not sent in time!')
+
+
+def run(args):
+    random.seed(args.seed)
+
+    if args.storage == 'firestore':
+        os.environ.setdefault('FIRESTORE_EMULATOR_HOST', args.emulator_host)
+        os.environ.setdefault('GOOGLE_CLOUD_PROJECT', args.project)
+        from .benchmark_web import clear_emulator
+        clear_emulator(os.environ['FIRESTORE_EMULATOR_HOST'], os.environ['GOOGLE_CLOUD_PROJECT'])
+
+    handler = CountingHandler(0)
+    controller = Controller(handler, hostname='localhost', port=get_free_port())
+    controller.start()
+
+    campaigns = generate_campaigns(args.campaigns, args.games)
+    server = FakeGQLServer(campaigns, latency_seconds=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    server.start()
+
+    directory = tempfile.TemporaryDirectory()
+    storage = create_storage(args.storage, os.path.join(directory.name, 'storage.sqlite3'))
+    for user in generate_users(args.users, args.games):
+        storage.add_user(user)
+
+    twitch_client = Client(client_id=Client.CLIENT_ID_TV, oath_token='benchmark', user_id='benchmark', url=server.url, backoff_seconds=0.01)
+    watchdog = TwitchDropsWatchdog(twitch_client, storage)
+    email_credentials = {
+        'host': controller.hostname,
+        'port': controller.port,
+        'starttls': False
+    }
+    email_sender = EmailSender(email_credentials, storage, watchdog, outbox_path=os.path.join(directory.name, 'outbox.sqlite3'))
+
+    async def run_cycles(campaigns):
+        watchdog._bind_loop()
+        results = []
+        for cycle in range(args.cycles):
+            if cycle > 0:
+                campaigns = change_campaigns(campaigns, args.new_campaigns, args.changed_campaigns, args.games)
+                server.set_campaigns(campaigns)
+
+            server.reset_counters()
+            storage.operation_count = 0
+            message_count = handler.message_count
+
+            start_time = time.perf_counter()
+            await watchdog._poll()
+            poll_seconds = time.perf_counter() - start_time
+            await watchdog._dispatcher.join()
+            await asyncio.to_thread(wait_for_emails, email_sender, args.email_timeout)
+            total_seconds = time.perf_counter() - start_time
+
+            results.append({
+                'cycle': cycle,
+                'poll_seconds': round(poll_seconds, 4),
+                'total_seconds': round(total_seconds, 4),
+                'http_requests': server.request_count,
+                'gql_operations': server.operation_count,
+                'gql_errors': server.error_count,
+                'rate_limited': server.rate_limited_count,
+                'db_operations': storage.operation_count,
+                'emails_sent': handler.message_count - message_count
+            })
+        await watchdog._dispatcher.close()
+        return results
+
+    try:
+        return {
+            'storage': args.storage,
+            'campaigns': args.campaigns,
+            'users': args.users,
+            'cycles': asyncio.run(run_cycles(campaigns))
+        }
+    finally:
+        email_sender.close()
+        twitch_client.close()
+        storage.close()
+        server.stop()
+        controller.stop()
+        directory.cleanup()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results against a baseline.
+    :param tolerance: The fraction by which times may exceed the baseline.
+    :return: A list of regressions, one string per regressed metric.
+    """
+    regressions = []
+    for result, expected in zip(results['cycles'], baseline['cycles']):
+        for metric in COUNT_METRICS:
+            if result[metric] > expected[metric]:
+                regressions.append(f'Cycle {result["cycle"]}: {metric} increased from {expected[metric]} to {result[metric]}')
+        for metric in TIME_METRICS:
+            if result[metric] > expected[metric] * (1 + tolerance):
+                regressions.append(f'Cycle {result["cycle"]}: {metric} increased from {expected[metric]} to {result[metric]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cycles', dest='cycles', default=5, type=int)
+    parser.add_argument('--campaigns', dest='campaigns', default=200, type=int)
+    parser.add_argument('--games', dest='games', default=50, type=int)
+    parser.add_argument('--users', dest='users', default=2000, type=int)
+    parser.add_argument('--new-campaigns', help='The number of campaigns added before each cycle after the first.', dest='new_campaigns', default=5, type=int)
+    parser.add_argument('--changed-campaigns', help='The number of campaigns changed before each cycle after the first.', dest='changed_campaigns', default=10, type=int)
+    parser.add_argument('--latency', help='Simulated server latency in seconds.', dest='latency', default=0.05, type=float)
+    parser.add_argument('--error-rate', help='The fraction of GQL operations that fail.', dest='error_rate', default=0.0, type=float)
+    parser.add_argument('--rate-limit-rate', help='The fraction of GQL requests that are rejected with a 429 response.', dest='rate_limit_rate', default=0.0, type=float)
+    parser.add_argument('--storage', dest='storage', choices=('memory', 'sqlite', 'firestore'), default='memory')
+    parser.add_argument('--emulator-host', dest='emulator_host', default='localhost:8080')
+    parser.add_argument('--project', dest='project', default='twitch-drops-benchmark')
+    parser.add_argument('--email-timeout', help='The number of seconds to wait for the emails of a cycle to be sent.', dest='email_timeout', default=120, type=float)
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
+    parser.add_argument('--baseline', help='A results file to compare against.', dest='baseline', default=None)
+    parser.add_argument('--save-baseline', help='Write the results to the baseline file instead of comparing.', dest='save_baseline', action='store_true')
+    parser.add_argument('--tolerance', help='The fraction by which times may exceed the baseline.', dest='tolerance', default=0.5, type=float)
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline is not None:
+        if args.save_baseline:
+            with open(args.baseline, 'w') as file:
+                json.dump(results, file, indent=2)
+        else:
+            with open(args.baseline, 'r') as file:
+                regressions = compare(results, json.load(file), args.tolerance)
+            for regression in regressions:
+                print(regression, file=sys.stderr)
+            if len(regressions) > 0:
+                sys.exit(1)
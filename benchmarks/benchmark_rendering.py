@@ -0,0 +1,100 @@
+"""
+Compares rendering a new campaigns email blast by rendering the whole campaign list for every recipient against
+rendering each campaign once per timezone with the EmailRenderer.
+
+Usage: python -m benchmarks.benchmark_rendering [--recipients 10000] [--campaigns 5] [--timezones 30]
+"""
+import argparse
+import json
+import time
+
+import pytz
+from jinja2 import ChoiceLoader, DictLoader, Environment, FileSystemLoader
+
+from twitch_drops_notifier.rendering import EmailRenderer, convert_time
+from .fake_gql_server import generate_campaigns
+
+# The campaign list template as it was before campaigns were rendered into shared fragments
+LEGACY_CAMPAIGNS_LIST = '''<div>
+    {% for campaign in campaigns %}
+        <div>
+            <span><b>{{ campaign.game.displayName }}</b> | {{ campaign.name }}</span>
+            <br>
+            <span>
+                Starts: {{ campaign.startAt | convert_time(user.timezone) }}
+                <br>
+                Ends&nbsp;&nbsp;: {{ campaign.endAt | convert_time(user.timezone) }}
+            </span>
+            <table>
+                <tbody>
+                    <tr>
+                        {% for timeBasedDrop in campaign.timeBasedDrops %}
+                            <td>
+                                <img src="{{ timeBasedDrop.benefitEdges[0].benefit.imageAssetURL }}" alt="Reward"/>
+                                <p>{{ timeBasedDrop.benefitEdges[0].benefit.name }}</p>
+                            </td>
+                        {% endfor %}
+                    </tr>
+                </tbody>
+            </table>
+            <a href="https://www.twitch.tv/directory/game/{{ campaign.game.displayName | urlencode }}">Watch now!</a>
+        </div>
+    {% endfor %}
+</div>'''
+
+LEGACY_NEW_CAMPAIGNS = '''<html><body>{% include 'campaigns_list.html' %}{% include 'footer.html' %}</body></html>'''
+
+
+def generate_users(count, timezone_count):
+    timezones = pytz.common_timezones[:timezone_count]
+    return [{'email': f'user{i}@example.com', 'id': str(i), 'timezone': timezones[i % len(timezones)]} for i in range(count)]
+
+
+def render_legacy(users, campaigns):
+    environment = Environment(loader=ChoiceLoader([
+        DictLoader({'campaigns_list.html': LEGACY_CAMPAIGNS_LIST, 'new_campaigns.html': LEGACY_NEW_CAMPAIGNS}),
+        FileSystemLoader('email_templates')
+    ]))
+    environment.filters['convert_time'] = convert_time
+    render_count = 0
+    for user in users:
+        environment.get_template('new_campaigns.html').render(user=user, domain='https://example.com', campaigns=campaigns)
+        render_count += 1
+    return render_count
+
+
+def render_fragments(users, campaigns):
+    renderer = EmailRenderer('email_templates')
+    fragment_cache = {}
+    for user in users:
+        renderer.render(
+            'new_campaigns.html',
+            user=user,
+            domain='https://example.com',
+            campaign_fragments=renderer.render_campaigns(campaigns, user['timezone'], fragment_cache)
+        )
+    return renderer.render_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recipients', dest='recipients', default=10000, type=int)
+    parser.add_argument('--campaigns', dest='campaigns', default=5, type=int)
+    parser.add_argument('--timezones', dest='timezones', default=30, type=int)
+    args = parser.parse_args()
+
+    users = generate_users(args.recipients, args.timezones)
+    campaigns = generate_campaigns(args.campaigns)
+
+    for name, f in [('before', render_legacy), ('after', render_fragments)]:
+        start_time = time.perf_counter()
+        render_count = f(users, campaigns)
+        elapsed = time.perf_counter() - start_time
+        print(json.dumps({
+            'mode': name,
+            'recipients': args.recipients,
+            'template_renders': render_count,
+            'campaign_renders': render_count * args.campaigns if name == 'before' else render_count - args.recipients,
+            'seconds': round(elapsed, 4),
+            'emails_per_second': round(args.recipients / elapsed, 1)
+        }))
@@ -0,0 +1,169 @@
+"""
+Compares restarting the notifier with and without a checkpoint. For each number of users, the database is filled and
+polled once, the state is checkpointed, and a small fraction of the users are then added, changed, or removed while
+the notifier is "down". The time until the first poll after a restart has finished, and the number of documents read
+from the database, are recorded for a cold restart and for a restart from the checkpoint.
+
+Requires aiosmtpd: pip install aiosmtpd
+
+To use the Firestore emulator instead of SQLite, start it first and pass --storage firestore:
+gcloud emulators firestore start --host-port=localhost:8080
+
+Usage: python -m benchmarks.benchmark_restart [--users 1000 10000 50000] [--campaigns 200] [--storage sqlite]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from aiosmtpd.controller import Controller
+
+from twitch_drops_notifier.checkpoint import Checkpoint
+from twitch_drops_notifier.emails import STATE_MARGIN, EmailSender
+from twitch_drops_notifier.storage import create_storage
+from twitch_drops_notifier.twitch import Client
+from twitch_drops_notifier.twitch_drops_watchdog import TwitchDropsWatchdog
+from .benchmark_poll_cycle import generate_users
+from .benchmark_smtp import CountingHandler, get_free_port
+from .fake_gql_server import FakeGQLServer, generate_campaigns
+
+
+def count_document_reads(storage):
+    """
+    Wrap the read methods of a storage so that the number of documents they return is counted in `storage.read_count`.
+    """
+    storage.read_count = 0
+
+    def wrap(f):
+        def wrapper(*args, **kwargs):
+            result = f(*args, **kwargs)
+            if not isinstance(result, (dict, list)):
+                result = list(result)
+            storage.read_count += len(result)
+            return result
+        return wrapper
+
+    for name in ('get_campaigns', 'get_games', 'get_users', 'get_user_changes'):
+        setattr(storage, name, wrap(getattr(storage, name)))
+
+
+def change_users(storage, users, fraction, game_count):
+    """
+    Simulate the users that subscribe, change their preferences, and unsubscribe while the notifier is down.
+    """
+    count = max(1, int(len(users) * fraction))
+    changed = random.sample(users, count * 2)
+    for user in changed[:count]:
+        storage.update_user(user['id'], lambda x: dict(x, games=[str(100000 + random.randrange(game_count))]))
+    for user in changed[count:]:
+        storage.remove_user(user['id'])
+    for user in generate_users(count, game_count):
+        user['email'] = f'new-{uuid.uuid4().hex[:8]}@example.com'
+        storage.add_user(user)
+
+
+def run(args, user_count):
+    random.seed(args.seed)
+
+    if args.storage == 'firestore':
+        os.environ.setdefault('FIRESTORE_EMULATOR_HOST', args.emulator_host)
+        os.environ.setdefault('GOOGLE_CLOUD_PROJECT', args.project)
+        from .benchmark_web import clear_emulator
+        clear_emulator(os.environ['FIRESTORE_EMULATOR_HOST'], os.environ['GOOGLE_CLOUD_PROJECT'])
+
+    controller = Controller(CountingHandler(0), hostname='localhost', port=get_free_port())
+    controller.start()
+    email_credentials = {
+        'host': controller.hostname,
+        'port': controller.port,
+        'starttls': False
+    }
+
+    server = FakeGQLServer(generate_campaigns(args.campaigns, args.games), latency_seconds=args.latency, seed=args.seed)
+    server.start()
+
+    directory = tempfile.TemporaryDirectory()
+    storage_path = os.path.join(directory.name, 'storage.sqlite3')
+    outbox_path = os.path.join(directory.name, 'outbox.sqlite3')
+    checkpoint_path = os.path.join(directory.name, 'checkpoint.json.gz')
+    twitch_client = Client(client_id=Client.CLIENT_ID_TV, oath_token='benchmark', user_id='benchmark', url=server.url, backoff_seconds=0.01)
+
+    def start(state):
+        """
+        Start the notifier like __main__ does and poll once.
+        :return: A (seconds, documents read, user count) tuple.
+        """
+        storage = create_storage(args.storage, storage_path)
+        count_document_reads(storage)
+        start_time = time.perf_counter()
+        watchdog = TwitchDropsWatchdog(twitch_client, storage, state=state.get('watchdog'))
+        email_sender = EmailSender(email_credentials, storage, watchdog, outbox_path=outbox_path, state=state.get('email_sender'))
+        asyncio.run(watchdog.run_once())
+        seconds = time.perf_counter() - start_time
+
+        checkpoint = Checkpoint(checkpoint_path)
+        checkpoint.add_source('watchdog', watchdog.get_state)
+        checkpoint.add_source('email_sender', email_sender.get_state)
+        checkpoint.save()
+
+        user_count = len(email_sender._user_index)
+        email_sender.close()
+        storage.close()
+        return seconds, storage.read_count, user_count
+
+    try:
+        storage = create_storage(args.storage, storage_path)
+        users = generate_users(user_count, args.games)
+        for user in users:
+            storage.add_user(user)
+
+        # Fill the database with campaigns before any users can be notified about them
+        asyncio.run(TwitchDropsWatchdog(twitch_client, storage).run_once())
+
+        # Users changed shortly before a checkpoint are read again after a restart, so let them age first
+        time.sleep(STATE_MARGIN.total_seconds() + 1)
+
+        # Run once to save a checkpoint, then change some users while the notifier is down
+        start({})
+        change_users(storage, users, args.changed_fraction, args.games)
+        storage.close()
+
+        cold_seconds, cold_reads, cold_users = start({})
+        warm_seconds, warm_reads, warm_users = start(Checkpoint(checkpoint_path).load())
+        if cold_users != warm_users:
+            raise RuntimeError(f'Restored {warm_users} users, but there are {cold_users}!')
+
+        return {
+            'storage': args.storage,
+            'users': user_count,
+            'checkpoint_bytes': os.path.getsize(checkpoint_path),
+            'cold_seconds': round(cold_seconds, 3),
+            'warm_seconds': round(warm_seconds, 3),
+            'cold_documents_read': cold_reads,
+            'warm_documents_read': warm_reads
+        }
+    finally:
+        twitch_client.close()
+        server.stop()
+        controller.stop()
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', help='The numbers of users to run the benchmark with.', dest='users', nargs='+', default=[1000, 10000, 50000], type=int)
+    parser.add_argument('--campaigns', dest='campaigns', default=200, type=int)
+    parser.add_argument('--games', dest='games', default=50, type=int)
+    parser.add_argument('--changed-fraction', help='The fraction of users that are added, changed, and removed while the notifier is down.', dest='changed_fraction', default=0.01, type=float)
+    parser.add_argument('--latency', help='Simulated server latency in seconds.', dest='latency', default=0.05, type=float)
+    parser.add_argument('--storage', dest='storage', choices=('sqlite', 'firestore'), default='sqlite')
+    parser.add_argument('--emulator-host', dest='emulator_host', default='localhost:8080')
+    parser.add_argument('--project', dest='project', default='twitch-drops-benchmark')
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
+    args = parser.parse_args()
+
+    print(json.dumps([run(args, user_count) for user_count in args.users], indent=2))
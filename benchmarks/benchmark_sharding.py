@@ -0,0 +1,227 @@
+"""
+Measures how email delivery scales with the number of sharded instances. Each instance runs in its own process, like
+separate `python -m twitch_drops_notifier --shards N` processes, and they share one storage, the fake GQL server and a
+local aiosmtpd sink. Once the instances have balanced the shards between themselves, new campaigns are published on the
+fake server, the elected leader finds them, and every instance sends the emails of the users in its shards. The sink
+counts how long the blast took and whether any user received the same email twice.
+
+Requires aiosmtpd: pip install aiosmtpd
+
+To use the Firestore emulator instead of a shared SQLite database, start it first and pass --storage firestore:
+gcloud emulators firestore start --host-port=localhost:8080
+
+Usage: python -m benchmarks.benchmark_sharding [--instances 1 2 4] [--users 2000] [--campaigns 50] [--storage sqlite]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+
+from twitch_drops_notifier.storage import create_storage
+from twitch_drops_notifier.user_index import UserIndex
+from .benchmark_poll_cycle import generate_users
+from .benchmark_smtp import get_free_port
+from .fake_gql_server import FakeGQLServer, generate_campaigns
+
+
+class RecipientHandler:
+    """
+    An aiosmtpd handler that counts the messages received by each recipient, and simulates the time a real SMTP server
+    takes to accept a message.
+    """
+
+    def __init__(self, latency_seconds):
+        self._latency_seconds = latency_seconds
+        self._lock = threading.Lock()
+        self.recipients = collections.Counter()
+        self.last_message_time = None
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self._latency_seconds)
+        with self._lock:
+            for recipient in envelope.rcpt_tos:
+                self.recipients[recipient] += 1
+            self.last_message_time = time.perf_counter()
+        return '250 Message accepted for delivery'
+
+    @property
+    def message_count(self):
+        with self._lock:
+            return sum(self.recipients.values())
+
+
+def run_instance(index, config, stop_event):
+    """
+    Run a single instance until `stop_event` is set. This is the target of each worker process.
+    """
+    import logging
+    from twitch_drops_notifier.emails import EmailSender
+    from twitch_drops_notifier.sharding import ShardCoordinator
+    from twitch_drops_notifier.twitch import Client
+    from twitch_drops_notifier.twitch_drops_watchdog import TwitchDropsWatchdog
+
+    logging.basicConfig(format=f'%(asctime)s [instance {index}] [%(name)s] [%(levelname)s] %(message)s', level=config['log_level'])
+
+    os.environ.update(config['environment'])
+    storage = create_storage(config['storage'], config['storage_path'])
+    twitch_client = Client(client_id=Client.CLIENT_ID_TV, oath_token='benchmark', user_id='benchmark', url=config['gql_url'], backoff_seconds=0.01)
+    watchdog = TwitchDropsWatchdog(twitch_client, storage, sleep_delay_seconds=config['poll_seconds'], min_sleep_delay_seconds=config['poll_seconds'])
+
+    coordinator = ShardCoordinator(storage, shard_count=config['shards'], lease_seconds=config['lease_seconds'], instance_id=f'instance-{index}')
+    coordinator.start()
+
+    email_credentials = {
+        'host': 'localhost',
+        'port': config['smtp_port'],
+        'starttls': False
+    }
+    email_sender = EmailSender(
+        email_credentials,
+        storage,
+        watchdog,
+        smtp_pool_size=config['smtp_pool_size'],
+        outbox_path=os.path.join(config['directory'], f'outbox-{index}.sqlite3'),
+        digest_window_seconds=config['digest_window'],
+        coordinator=coordinator,
+        event_poll_seconds=0.25
+    )
+
+    def wait_for_stop():
+        stop_event.wait()
+        coordinator.close()
+    threading.Thread(target=wait_for_stop, daemon=True).start()
+
+    try:
+        coordinator.start_watchdog(watchdog)
+    finally:
+        email_sender.close()
+        twitch_client.close()
+        storage.close()
+
+
+def get_expected_recipients(users, campaigns):
+    """
+    Get the users that should receive an email about the new campaigns and games.
+    """
+    user_index = UserIndex()
+    for user in users:
+        user_index.add_or_update(user)
+    recipients = {user['email'] for user, _ in user_index.get_subscribed_campaigns(campaigns)}
+    recipients.update(user['email'] for user in user_index.get_new_games_subscribers())
+    return recipients
+
+
+def run(args, instance_count):
+    random.seed(args.seed)
+
+    environment = {}
+    if args.storage == 'firestore':
+        environment = {'FIRESTORE_EMULATOR_HOST': args.emulator_host, 'GOOGLE_CLOUD_PROJECT': args.project}
+        os.environ.update(environment)
+        from .benchmark_web import clear_emulator
+        clear_emulator(args.emulator_host, args.project)
+
+    handler = RecipientHandler(args.smtp_latency)
+    controller = Controller(handler, hostname='localhost', port=get_free_port())
+    controller.start()
+
+    # Start without campaigns, so that every campaign is new once they are published
+    server = FakeGQLServer([], latency_seconds=args.latency, seed=args.seed)
+    server.start()
+
+    directory = tempfile.TemporaryDirectory()
+    storage_path = os.path.join(directory.name, 'storage.sqlite3')
+    storage = create_storage(args.storage, storage_path)
+    users = generate_users(args.users, args.games)
+    for user in users:
+        storage.add_user(user)
+    storage.close()
+
+    config = {
+        'storage': args.storage,
+        'storage_path': storage_path,
+        'environment': environment,
+        'gql_url': server.url,
+        'smtp_port': controller.port,
+        'smtp_pool_size': args.smtp_pool_size,
+        'shards': args.shards,
+        'lease_seconds': args.lease_seconds,
+        'poll_seconds': 1,
+        'digest_window': args.digest_window,
+        'directory': directory.name,
+        'log_level': args.log_level
+    }
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+    processes = [context.Process(target=run_instance, args=(i, config, stop_event)) for i in range(instance_count)]
+    for process in processes:
+        process.start()
+
+    try:
+        # Wait for the instances to balance the shards. This takes a few heartbeats once every instance has started.
+        time.sleep(args.warmup)
+
+        campaigns = generate_campaigns(args.campaigns, args.games)
+        expected = get_expected_recipients(users, campaigns)
+        start_time = time.perf_counter()
+        server.set_campaigns(campaigns)
+
+        deadline = start_time + args.timeout
+        while len(handler.recipients) < len(expected) and time.perf_counter() < deadline:
+            time.sleep(0.1)
+
+        # Give late duplicates a chance to arrive
+        time.sleep(args.settle)
+        elapsed = (handler.last_message_time or start_time) - start_time
+        message_count = handler.message_count
+        return {
+            'instances': instance_count,
+            'expected_emails': len(expected),
+            'emails': message_count,
+            'missing': len(expected - set(handler.recipients)),
+            'duplicates': sum(count - 1 for count in handler.recipients.values() if count > 1),
+            'seconds': round(elapsed, 3),
+            'emails_per_second': round(message_count / elapsed, 1) if elapsed > 0 else None
+        }
+    finally:
+        stop_event.set()
+        for process in processes:
+            process.join(args.lease_seconds * 2)
+            if process.is_alive():
+                process.terminate()
+        server.stop()
+        controller.stop()
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', help='The numbers of instances to run the benchmark with.', dest='instances', nargs='+', default=[1, 2, 4], type=int)
+    parser.add_argument('--shards', dest='shards', default=16, type=int)
+    parser.add_argument('--users', dest='users', default=2000, type=int)
+    parser.add_argument('--campaigns', dest='campaigns', default=50, type=int)
+    parser.add_argument('--games', dest='games', default=50, type=int)
+    parser.add_argument('--latency', help='Simulated GQL server latency in seconds.', dest='latency', default=0.01, type=float)
+    parser.add_argument('--smtp-latency', help='Simulated number of seconds the SMTP server takes to accept a message.', dest='smtp_latency', default=0.02, type=float)
+    parser.add_argument('--smtp-pool-size', dest='smtp_pool_size', default=2, type=int)
+    parser.add_argument('--digest-window', dest='digest_window', default=1, type=float)
+    parser.add_argument('--lease-seconds', dest='lease_seconds', default=3, type=float)
+    parser.add_argument('--warmup', help='The number of seconds to let the instances balance the shards for.', dest='warmup', default=8, type=float)
+    parser.add_argument('--timeout', help='The maximum number of seconds to wait for the emails.', dest='timeout', default=300, type=float)
+    parser.add_argument('--settle', help='The number of seconds to wait for duplicates after every email arrived.', dest='settle', default=3, type=float)
+    parser.add_argument('--storage', dest='storage', choices=('sqlite', 'firestore'), default='sqlite')
+    parser.add_argument('--emulator-host', dest='emulator_host', default='localhost:8080')
+    parser.add_argument('--project', dest='project', default='twitch-drops-benchmark')
+    parser.add_argument('--log-level', dest='log_level', default='WARNING')
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
+    args = parser.parse_args()
+
+    print(json.dumps([run(args, instance_count) for instance_count in args.instances], indent=2))
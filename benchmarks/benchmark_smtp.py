@@ -0,0 +1,104 @@
+"""
+Compares sending emails over a new SMTP connection per message against sending them through the SMTPConnectionPool,
+using a local aiosmtpd server as a stand-in for the mail provider.
+
+Requires aiosmtpd: pip install aiosmtpd
+
+Usage: python -m benchmarks.benchmark_smtp [--messages 500] [--pool-size 4] [--handshake-latency 0.05]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import smtplib
+import socket
+import time
+from email.mime.text import MIMEText
+
+from aiosmtpd.controller import Controller
+
+from twitch_drops_notifier.smtp_pool import SMTPConnectionPool
+
+
+class CountingHandler:
+    """
+    An aiosmtpd handler that counts messages and sessions, and simulates the latency of a real SMTP handshake.
+    """
+
+    def __init__(self, handshake_latency_seconds):
+        self._handshake_latency_seconds = handshake_latency_seconds
+        self.message_count = 0
+        self.session_count = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.session_count += 1
+        await asyncio.sleep(self._handshake_latency_seconds)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.message_count += 1
+        return '250 Message accepted for delivery'
+
+
+def get_free_port():
+    # aiosmtpd connects to its own port to check that it started, so it can't be given port 0
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def create_message(i):
+    message = MIMEText(f'<p>Message {i}</p>', 'html')
+    message['to'] = f'user{i}@example.com'
+    message['from'] = 'twitchdropsbot@gmail.com'
+    message['subject'] = 'Benchmark'
+    return message
+
+
+def send_without_pool(host, port, message):
+    server = smtplib.SMTP(host, port)
+    server.send_message(message)
+    server.quit()
+
+
+def run(send, message_count, worker_count):
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for future in [executor.submit(send, create_message(i)) for i in range(message_count)]:
+            future.result()
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', dest='messages', default=500, type=int)
+    parser.add_argument('--pool-size', dest='pool_size', default=4, type=int)
+    parser.add_argument('--max-messages-per-connection', dest='max_messages_per_connection', default=100, type=int)
+    parser.add_argument('--handshake-latency', help='Simulated latency of each SMTP handshake in seconds.', dest='handshake_latency', default=0.05, type=float)
+    args = parser.parse_args()
+
+    handler = CountingHandler(args.handshake_latency)
+    controller = Controller(handler, hostname='localhost', port=get_free_port())
+    controller.start()
+    try:
+        host, port = controller.hostname, controller.port
+
+        results = []
+
+        handler.message_count = handler.session_count = 0
+        elapsed = run(lambda message: send_without_pool(host, port, message), args.messages, args.pool_size)
+        results.append({'mode': 'connection_per_message', 'messages': handler.message_count, 'sessions': handler.session_count,
+                        'seconds': round(elapsed, 4), 'messages_per_second': round(handler.message_count / elapsed, 1)})
+
+        pool = SMTPConnectionPool(host, port, size=args.pool_size, max_messages_per_connection=args.max_messages_per_connection, starttls=False)
+        handler.message_count = handler.session_count = 0
+        elapsed = run(pool.send, args.messages, args.pool_size)
+        pool.close()
+        results.append({'mode': 'pool', 'messages': handler.message_count, 'sessions': handler.session_count,
+                        'seconds': round(elapsed, 4), 'messages_per_second': round(handler.message_count / elapsed, 1)})
+
+        for result in results:
+            print(json.dumps(result))
+    finally:
+        controller.stop()
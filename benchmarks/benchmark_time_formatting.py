@@ -0,0 +1,66 @@
+"""
+Microbenchmarks for the timestamp parsing and formatting done for every campaign in the watchdog and in every email.
+
+Usage: python -m benchmarks.benchmark_time_formatting [--number 100000]
+"""
+import argparse
+import datetime
+import json
+import timeit
+
+import pytz
+
+from twitch_drops_notifier import utils
+from twitch_drops_notifier.rendering import convert_time
+
+TIMESTAMPS = ['2023-08-01T17:00:00Z', '2023-08-15T16:59:59.999Z']
+TIMEZONES = ['America/New_York', 'Europe/Berlin', 'Asia/Tokyo', 'UTC']
+
+
+def legacy_get_datetime(timestamp):
+    try:
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f%z")
+    except:
+        pass
+    return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
+
+
+def legacy_convert_time(value, timezone):
+    value = legacy_get_datetime(value).astimezone(pytz.timezone(timezone))
+    return value.strftime('%d %B %Y %H:%M %Z')
+
+
+def uncached_get_datetime(timestamp):
+    return utils._parse_timestamp.__wrapped__(timestamp)
+
+
+def measure(f, number):
+    i = 0
+
+    def run():
+        nonlocal i
+        f(i)
+        i += 1
+
+    return timeit.timeit(run, number=number) / number * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', dest='number', default=100000, type=int)
+    args = parser.parse_args()
+
+    benchmarks = {
+        'get_datetime_legacy': lambda i: legacy_get_datetime(TIMESTAMPS[i % 2]),
+        'get_datetime_fromisoformat': lambda i: uncached_get_datetime(TIMESTAMPS[i % 2]),
+        'get_datetime_cached': lambda i: utils.get_datetime(TIMESTAMPS[i % 2]),
+        'convert_time_legacy': lambda i: legacy_convert_time(TIMESTAMPS[i % 2], TIMEZONES[i % len(TIMEZONES)]),
+        'convert_time_cached': lambda i: convert_time(TIMESTAMPS[i % 2], TIMEZONES[i % len(TIMEZONES)]),
+    }
+
+    results = {name: round(measure(f, args.number), 3) for name, f in benchmarks.items()}
+
+    # Each campaign in an email formats its start and end time
+    results['per_campaign_formatting_speedup'] = round(results['convert_time_legacy'] / results['convert_time_cached'], 1)
+
+    print(json.dumps({'microseconds_per_call': results}))
@@ -0,0 +1,231 @@
+"""
+Load test for the web subscription frontend. The Flask app in web/main.py is run against the Firestore emulator,
+seeded with synthetic users and games, and '/', '/subscribe', '/update' and '/unsubscribe' are requested concurrently.
+Latency percentiles, throughput and Firestore operations per request are reported as JSON.
+
+Start the emulator first: gcloud emulators firestore start --host-port=localhost:8080
+
+Usage: python -m benchmarks.benchmark_web [--users 1000] [--games 300] [--requests 2000] [--concurrency 16]
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+# The maximum number of operations allowed in a single Firestore write batch
+MAX_BATCH_SIZE = 500
+
+# Methods that result in a request to Firestore
+COUNTED_METHODS = {'get', 'set', 'create', 'update', 'delete', 'stream', 'list_documents', 'get_all', 'commit', 'transaction'}
+
+# Firestore operations made by the request that is being handled on the current thread
+_local = threading.local()
+
+
+def _count_operation():
+    _local.operation_count = getattr(_local, 'operation_count', 0) + 1
+
+
+class CountingProxy:
+    """
+    Wraps a Firestore client, collection, document or query and counts the calls that make requests to Firestore.
+    Starting a transaction is counted as one operation for its commit.
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        from google.cloud import firestore
+
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        def wrapper(*args, **kwargs):
+            if name in COUNTED_METHODS:
+                _count_operation()
+            result = attribute(*args, **kwargs)
+            if isinstance(result, (firestore.CollectionReference, firestore.DocumentReference, firestore.Query)):
+                return CountingProxy(result)
+            return result
+
+        return wrapper
+
+
+def clear_emulator(emulator_host, project):
+    requests.delete(f'http://{emulator_host}/emulator/v1/projects/{project}/databases/(default)/documents').raise_for_status()
+
+
+def seed(firestore_client, user_count, game_count):
+    games = [{'id': str(100000 + i), 'displayName': f'Game {i}'} for i in range(game_count)]
+    users = []
+    for i in range(user_count):
+        users.append({
+            'email': f'user{i}@example.com',
+            'games': [x['id'] for x in random.sample(games, min(len(games), random.randint(0, 10)))],
+            'timezone': 'UTC',
+            'id': str(uuid.uuid4()),
+            'created': '2023-01-01T00:00:00+00:00',
+            'new_game_notifications': True
+        })
+
+    writes = [('games', game['id'], game) for game in games]
+    for user in users:
+        writes.append(('users', user['email'], user))
+        writes.append(('user_ids', user['id'], {'email': user['email']}))
+    for i in range(0, len(writes), MAX_BATCH_SIZE):
+        batch = firestore_client.batch()
+        for collection, document_id, data in writes[i:i + MAX_BATCH_SIZE]:
+            batch.set(firestore_client.collection(collection).document(document_id), data)
+        batch.commit()
+
+    return users, games
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def create_requests(count, users, games):
+    """
+    Create a shuffled mix of requests. Each user is unsubscribed at most once.
+    :return: A list of (name, method, path, form) tuples.
+    """
+    users = list(users)
+    random.shuffle(users)
+    result = []
+    for i in range(count):
+        kind = random.choices(['index', 'index_user', 'subscribe', 'update', 'unsubscribe'], weights=[40, 25, 10, 15, 10])[0]
+        if kind in ('index_user', 'update', 'unsubscribe') and len(users) == 0:
+            kind = 'index'
+        if kind == 'index':
+            result.append(('index', 'GET', '/', None))
+        elif kind == 'index_user':
+            result.append(('index_user', 'GET', f'/?id={random.choice(users)["id"]}', None))
+        elif kind == 'subscribe':
+            form = {'email': f'new{i}@example.com', 'timezone': 'UTC'}
+            form.update({f'game_{x["id"]}': 'on' for x in random.sample(games, min(len(games), 3))})
+            result.append(('subscribe', 'POST', '/subscribe', form))
+        elif kind == 'update':
+            form = {'timezone': 'Europe/Berlin', 'new_game_notifications': 'on'}
+            form.update({f'game_{x["id"]}': 'on' for x in random.sample(games, min(len(games), 3))})
+            result.append(('update', 'POST', f'/update?id={random.choice(users)["id"]}', form))
+        else:
+            result.append(('unsubscribe', 'GET', f'/unsubscribe?id={users.pop()["id"]}', None))
+    return result
+
+
+def run(args):
+    os.environ['FIRESTORE_EMULATOR_HOST'] = args.emulator_host
+    os.environ['GOOGLE_CLOUD_PROJECT'] = args.project
+
+    from google.cloud import firestore
+    from werkzeug.serving import make_server
+
+    random.seed(args.seed)
+    clear_emulator(args.emulator_host, args.project)
+    users, games = seed(firestore.Client(), args.users, args.games)
+
+    # Import the app after the emulator is configured, since it connects to Firestore when it is imported
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web'))
+    import main
+    main.storage._client = CountingProxy(main.storage._client)
+
+    # Record the Firestore operations of each request
+    operation_counts = collections.defaultdict(list)
+
+    @main.app.before_request
+    def before_request():
+        _local.operation_count = 0
+
+    @main.app.after_request
+    def after_request(response):
+        from flask import request
+        operation_counts[request.path].append(_local.operation_count)
+        return response
+
+    server = make_server('localhost', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://localhost:{server.server_port}'
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    local = threading.local()
+
+    def send(name, method, path, form):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start_time = time.perf_counter()
+        response = session.request(method, base_url + path, data=form)
+        latencies[name].append(time.perf_counter() - start_time)
+        if response.status_code >= 400:
+            errors[name] += 1
+
+    try:
+        start_time = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for future in [executor.submit(send, *x) for x in create_requests(args.requests, users, games)]:
+                future.result()
+        elapsed = time.perf_counter() - start_time
+    finally:
+        server.shutdown()
+
+    paths = {'index': '/', 'index_user': '/', 'subscribe': '/subscribe', 'update': '/update', 'unsubscribe': '/unsubscribe'}
+    endpoints = {}
+    for name, values in sorted(latencies.items()):
+        operations = operation_counts[paths[name]]
+        endpoints[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'firestore_ops_per_request': round(sum(operations) / len(operations), 2) if len(operations) > 0 else None
+        }
+
+    all_latencies = [x for values in latencies.values() for x in values]
+    return {
+        'users': args.users,
+        'games': args.games,
+        'concurrency': args.concurrency,
+        'requests': len(all_latencies),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(all_latencies) / elapsed, 1),
+        'p50_ms': round(percentile(all_latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(all_latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(all_latencies, 99) * 1000, 2),
+        'endpoints': endpoints
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', dest='users', default=1000, type=int)
+    parser.add_argument('--games', dest='games', default=300, type=int)
+    parser.add_argument('--requests', dest='requests', default=2000, type=int)
+    parser.add_argument('--concurrency', dest='concurrency', default=16, type=int)
+    parser.add_argument('--emulator-host', dest='emulator_host', default=os.environ.get('FIRESTORE_EMULATOR_HOST', 'localhost:8080'))
+    parser.add_argument('--project', dest='project', default='twitch-drops-benchmark')
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
+    parser.add_argument('--output', help='Write the results to this file instead of printing them.', dest='output', default=None)
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,258 @@
+import argparse
+import collections
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def generate_campaigns(count: int, game_count: int = 50):
+    """
+    Generate drop campaign details that look like the ones returned by the Twitch GQL API.
+    :param count: The number of campaigns to generate.
+    :param game_count: The number of distinct games to spread the campaigns across.
+    :return:
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    campaigns = []
+    for i in range(count):
+        game_index = i % game_count
+        campaign_id = str(uuid.uuid4())
+        campaigns.append({
+            'id': campaign_id,
+            'name': f'Campaign {i}',
+            'status': 'ACTIVE',
+            'startAt': (now - datetime.timedelta(days=1)).isoformat().replace('+00:00', 'Z'),
+            'endAt': (now + datetime.timedelta(days=7)).isoformat().replace('+00:00', 'Z'),
+            'game': {
+                'id': str(100000 + game_index),
+                'displayName': f'Game {game_index}',
+                'boxArtURL': f'https://static-cdn.jtvnw.net/ttv-boxart/{100000 + game_index}.jpg'
+            },
+            'timeBasedDrops': [{
+                'id': str(uuid.uuid4()),
+                'name': f'Drop {j}',
+                'requiredMinutesWatched': 60 * (j + 1),
+                'benefitEdges': [{
+                    'benefit': {
+                        'id': str(uuid.uuid4()),
+                        'name': f'Reward {j}',
+                        'imageAssetURL': f'https://static-cdn.jtvnw.net/twitch-quests-assets/REWARD/{campaign_id}-{j}.png'
+                    }
+                }]
+            } for j in range(3)]
+        })
+    return campaigns
+
+
+def get_dashboard_campaign(campaign):
+    """
+    Get the subset of a campaign's details that is returned by the drops dashboard.
+    :param campaign:
+    :return:
+    """
+    return {key: value for key, value in campaign.items() if key != 'timeBasedDrops'}
+
+
+class FakeGQLServer:
+    """
+    A local stand-in for https://gql.twitch.tv/gql that serves the persisted queries used by the twitch client.
+    """
+
+    def __init__(self, campaigns, latency_seconds: float = 0.0, host: str = 'localhost', port: int = 0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after_seconds: float = 0.0, seed: int = None, token_requests_per_minute: float = None,
+                 token_burst: int = 10, invalid_tokens=()):
+        """
+        Creates a new FakeGQLServer.
+        :param campaigns: The campaign details to serve.
+        :param latency_seconds: The number of seconds to wait before responding to each request.
+        :param host:
+        :param port: The port to listen on. If this is 0, a free port is chosen.
+        :param error_rate: The fraction of operations that fail with a GQL error.
+        :param rate_limit_rate: The fraction of requests that are rejected with a 429 response.
+        :param retry_after_seconds: The value of the Retry-After header sent with 429 responses.
+        :param seed: A seed for choosing which requests fail, so that runs are repeatable.
+        :param token_requests_per_minute: If this is given, each OAuth token can only send this many requests per
+        minute. Requests over the limit are rejected with a 429 response.
+        :param token_burst: The number of requests each token can send at once before the limit applies.
+        :param invalid_tokens: OAuth tokens that are rejected with a 401 response.
+        """
+        self._campaigns = {campaign['id']: campaign for campaign in campaigns}
+        self._latency_seconds = latency_seconds
+        self._error_rate = error_rate
+        self._rate_limit_rate = rate_limit_rate
+        self._retry_after_seconds = retry_after_seconds
+        self._random = random.Random(seed)
+        self._token_requests_per_minute = token_requests_per_minute
+        self._token_burst = token_burst
+        self._invalid_tokens = set(invalid_tokens)
+        self._lock = threading.Lock()
+
+        # Map OAuth tokens to (remaining requests, last refill time) tuples
+        self._token_budgets = {}
+
+        self.request_count = 0
+        self.operation_count = 0
+        self.error_count = 0
+        self.rate_limited_count = 0
+        self.auth_error_count = 0
+        self.token_request_counts = collections.Counter()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # Allow clients to reuse connections
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                token = self.headers.get('Authorization', '').replace('OAuth ', '', 1)
+                status, response, headers = server._handle(json.loads(body), token)
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._http_server = ThreadingHTTPServer((host, port), Handler)
+        self._http_server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._http_server.server_address[:2]
+        return f'http://{host}:{port}/gql'
+
+    def _take_token_budget(self, token):
+        """
+        Take a request out of a token's budget.
+        :return: A (remaining requests, retry after seconds) tuple. The retry delay is None if the request is allowed.
+        """
+        rate_per_second = self._token_requests_per_minute / 60
+        now = time.monotonic()
+        remaining, refill_time = self._token_budgets.get(token, (self._token_burst, now))
+        remaining = min(self._token_burst, remaining + (now - refill_time) * rate_per_second)
+        if remaining < 1:
+            self._token_budgets[token] = (remaining, now)
+            return remaining, (1 - remaining) / rate_per_second
+        self._token_budgets[token] = (remaining - 1, now)
+        return remaining - 1, None
+
+    def _handle(self, operations, token=''):
+        headers = {}
+        with self._lock:
+            self.request_count += 1
+            self.token_request_counts[token] += 1
+            unauthorized = token in self._invalid_tokens
+            rate_limited = not unauthorized and self._random.random() < self._rate_limit_rate
+            retry_after_seconds = self._retry_after_seconds
+            if not unauthorized and not rate_limited and self._token_requests_per_minute is not None:
+                remaining, token_retry_after_seconds = self._take_token_budget(token)
+                headers['Ratelimit-Remaining'] = str(int(remaining))
+                if token_retry_after_seconds is not None:
+                    rate_limited = True
+                    retry_after_seconds = token_retry_after_seconds
+            if unauthorized:
+                self.auth_error_count += 1
+            elif rate_limited:
+                self.rate_limited_count += 1
+            else:
+                self.operation_count += len(operations)
+
+        if self._latency_seconds > 0:
+            time.sleep(self._latency_seconds)
+
+        if unauthorized:
+            return 401, {'error': 'Unauthorized', 'status': 401, 'message': 'The "Authorization" token is invalid.'}, {}
+
+        if rate_limited:
+            return 429, {'error': 'Too Many Requests', 'status': 429}, dict(headers, **{'Retry-After': f'{retry_after_seconds:.3f}'})
+
+        return 200, [self._handle_operation(operation) for operation in operations], headers
+
+    def _handle_operation(self, operation):
+        with self._lock:
+            failed = self._random.random() < self._error_rate
+            if failed:
+                self.error_count += 1
+            campaigns = list(self._campaigns.values())
+        if failed:
+            return {'errors': [{'message': 'service error'}]}
+
+        name = operation.get('operationName')
+        if name == 'ViewerDropsDashboard':
+            return {'data': {'currentUser': {'dropCampaigns': [get_dashboard_campaign(x) for x in campaigns]}}}
+        elif name == 'DropCampaignDetails':
+            campaign = self._campaigns.get(operation['variables']['dropID'])
+            return {'data': {'user': {'dropCampaign': campaign}}}
+        return {'errors': [{'message': 'PersistedQueryNotFound'}]}
+
+    def set_campaigns(self, campaigns):
+        """
+        Replace the campaigns that are served.
+        :param campaigns:
+        """
+        with self._lock:
+            self._campaigns = {campaign['id']: campaign for campaign in campaigns}
+
+    def reset_counters(self):
+        with self._lock:
+            self.request_count = 0
+            self.operation_count = 0
+            self.error_count = 0
+            self.rate_limited_count = 0
+            self.auth_error_count = 0
+            self.token_request_counts.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._http_server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    # Run the server on its own, for example to point a watchdog at it
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--campaigns', dest='campaigns', default=150, type=int)
+    parser.add_argument('--games', dest='games', default=50, type=int)
+    parser.add_argument('--latency', help='Simulated server latency in seconds.', dest='latency', default=0.05, type=float)
+    parser.add_argument('--error-rate', help='The fraction of operations that fail.', dest='error_rate', default=0.0, type=float)
+    parser.add_argument('--rate-limit-rate', help='The fraction of requests that are rejected with a 429 response.', dest='rate_limit_rate', default=0.0, type=float)
+    parser.add_argument('--retry-after', help='The value of the Retry-After header sent with 429 responses.', dest='retry_after', default=1.0, type=float)
+    parser.add_argument('--token-requests-per-minute', help='The number of requests each OAuth token can send per minute. By default, there is no limit.',
+                        dest='token_requests_per_minute', default=None, type=float)
+    parser.add_argument('--invalid-token', help='An OAuth token to reject with a 401 response. This can be given more than once.', dest='invalid_tokens',
+                        action='append', default=[])
+    parser.add_argument('--port', dest='port', default=8000, type=int)
+    args = parser.parse_args()
+
+    server = FakeGQLServer(generate_campaigns(args.campaigns, args.games), latency_seconds=args.latency, port=args.port, error_rate=args.error_rate,
+                           rate_limit_rate=args.rate_limit_rate, retry_after_seconds=args.retry_after,
+                           token_requests_per_minute=args.token_requests_per_minute, invalid_tokens=args.invalid_tokens)
+    print(f'Serving {args.campaigns} campaigns at {server.url}')
+    try:
+        server._http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._http_server.server_close()
@@ -1,16 +1,27 @@
+import argparse
 import csv
 
-from google.cloud import firestore
+from twitch_drops_notifier.storage import BACKENDS, create_storage
 
 if __name__ == '__main__':
 
-    firestore_client = firestore.Client()
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage',
+                        help='Where campaigns, games, and users are stored.',
+                        dest='storage',
+                        choices=BACKENDS,
+                        default='firestore')
+    parser.add_argument('--storage-path',
+                        help='The path of the database file when using the sqlite storage backend.',
+                        dest='storage_path',
+                        default=None)
+    args = parser.parse_args()
+
+    storage = create_storage(args.storage, args.storage_path)
 
     # Get sorted games list
-    games = []
-    for game_document in firestore_client.collection('games').list_documents():
-        games.append(game_document.get().to_dict())
-    games = list(sorted(games, key=lambda x: x['displayName']))
+    games = list(sorted(storage.get_games().values(), key=lambda x: x['displayName']))
 
     # Write to file
     with open('games.csv', 'w', newline='\n') as file:
@@ -3,11 +3,14 @@ import json
 import logging
 import argparse
 
-from google.cloud import firestore
-
-from twitch_drops_notifier.twitch import Client
+from twitch_drops_notifier.twitch import Client, CredentialPool
+from . import metrics
+from .checkpoint import Checkpoint
+from .storage import BACKENDS, create_storage
 from .twitch_drops_watchdog import TwitchDropsWatchdog
 from .emails import EmailSender
+from .sharding import ShardCoordinator
+from .webhooks import WebhookChannel, create_session
 
 
 def logging_filter(record):
@@ -37,9 +40,14 @@ if __name__ == '__main__':
     # Parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--twitch-credentials',
-                        help='The path to the credentials to use when interacting with the Twitch API.',
+                        help='The path to the credentials to use when interacting with the Twitch API. This can contain a list of credentials to spread requests across.',
                         dest='twitch_credentials',
                         default='twitch.json')
+    parser.add_argument('--twitch-requests-per-minute',
+                        help='The number of requests that can be sent to the Twitch API per minute with each OAuth token. This can be overridden for a token with "requests_per_minute" in the credentials file.',
+                        dest='twitch_requests_per_minute',
+                        default=600,
+                        type=float)
     parser.add_argument('--email-credentials',
                         help='The path to the credentials for the email account used to send email notifications.',
                         dest='email_credentials',
@@ -48,32 +56,238 @@ if __name__ == '__main__':
                         help='The path to the credentials for Google',
                         dest='google_credentials',
                         default='google.json')
+    parser.add_argument('--storage',
+                        help='Where to store campaigns, games, and users.',
+                        dest='storage',
+                        choices=BACKENDS,
+                        default='firestore')
+    parser.add_argument('--storage-path',
+                        help='The path of the database file when using the sqlite storage backend.',
+                        dest='storage_path',
+                        default=None)
     parser.add_argument('--sleep-delay',
-                        help='The number of seconds to wait in between requests for new drop campaigns.',
+                        help='The usual number of seconds to wait in between requests for new drop campaigns. The delay gets shorter after changes are found and when known campaigns start, and longer while nothing changes.',
                         dest='sleep_delay',
                         default=60 * 30,
                         type=int)
+    parser.add_argument('--min-sleep-delay',
+                        help='The number of seconds to wait in between requests after changes are found. By default, this is a quarter of --sleep-delay.',
+                        dest='min_sleep_delay',
+                        default=None,
+                        type=int)
+    parser.add_argument('--max-sleep-delay',
+                        help='The longest number of seconds to wait in between requests while nothing changes. By default, this is twice --sleep-delay.',
+                        dest='max_sleep_delay',
+                        default=None,
+                        type=int)
+    parser.add_argument('--once',
+                        help='Poll once, wait for the emails to be sent, and exit. This is useful for running from cron or a scheduled job.',
+                        dest='once',
+                        action='store_true')
+    parser.add_argument('--once-email-timeout',
+                        help='The maximum number of seconds to wait for emails to be sent when using --once.',
+                        dest='once_email_timeout',
+                        default=60 * 10,
+                        type=int)
+    parser.add_argument('--details-batch-size',
+                        help='The maximum number of drop campaigns to request details for in a single request.',
+                        dest='details_batch_size',
+                        default=25,
+                        type=int)
+    parser.add_argument('--max-concurrent-requests',
+                        help='The maximum number of requests to the Twitch API that can be in flight at the same time. By default, this is 4 per OAuth token.',
+                        dest='max_concurrent_requests',
+                        default=None,
+                        type=int)
+    parser.add_argument('--max-concurrent-writes',
+                        help='The maximum number of database operations that can be in flight at the same time.',
+                        dest='max_concurrent_writes',
+                        default=16,
+                        type=int)
+    parser.add_argument('--full-refresh-interval',
+                        help='The number of seconds after which the details of every campaign are fetched again, even if they appear unchanged.',
+                        dest='full_refresh_interval',
+                        default=60 * 60 * 6,
+                        type=int)
+    parser.add_argument('--smtp-pool-size',
+                        help='The maximum number of SMTP connections to send emails over at the same time.',
+                        dest='smtp_pool_size',
+                        default=4,
+                        type=int)
+    parser.add_argument('--smtp-max-messages-per-connection',
+                        help='The number of emails to send over an SMTP connection before reconnecting.',
+                        dest='smtp_max_messages_per_connection',
+                        default=100,
+                        type=int)
+    parser.add_argument('--outbox',
+                        help='The path of the SQLite database that queued emails are stored in.',
+                        dest='outbox_path',
+                        default='outbox.sqlite3')
+    parser.add_argument('--email-rate-limit',
+                        help='The maximum number of emails to send per second. By default, there is no limit.',
+                        dest='email_rate_limit',
+                        default=None,
+                        type=float)
+    parser.add_argument('--email-digest-window',
+                        help='The number of seconds to collect notifications for each user before sending them as a single email.',
+                        dest='email_digest_window',
+                        default=60,
+                        type=float)
+    parser.add_argument('--email-max-attempts',
+                        help='The number of times to try sending an email before giving up on it.',
+                        dest='email_max_attempts',
+                        default=5,
+                        type=int)
+    parser.add_argument('--template-cache-dir',
+                        help='A directory to store compiled email templates in. By default, compiled templates are only kept in memory.',
+                        dest='template_cache_dir',
+                        default=None)
+    parser.add_argument('--metrics-port',
+                        help='Serve Prometheus metrics on this port. Requires prometheus_client. By default, metrics are only logged.',
+                        dest='metrics_port',
+                        default=None,
+                        type=int)
+    parser.add_argument('--shards',
+                        help='Split users into this many shards so that several instances can share the work. Every instance must use the same number of shards and the same storage, and only one of them polls Twitch at a time. By default, sharding is disabled.',
+                        dest='shards',
+                        default=0,
+                        type=int)
+    parser.add_argument('--lease-seconds',
+                        help='The number of seconds after which the shards of an instance that stopped responding are taken over by the others, when using --shards.',
+                        dest='lease_seconds',
+                        default=30,
+                        type=float)
+    parser.add_argument('--checkpoint',
+                        help='Periodically save the known campaigns and users to this file, and resume from it after a restart so that only what changed is read from the database. By default, nothing is saved.',
+                        dest='checkpoint_path',
+                        default=None)
+    parser.add_argument('--checkpoint-interval',
+                        help='The number of seconds in between checkpoints.',
+                        dest='checkpoint_interval',
+                        default=60,
+                        type=float)
+    parser.add_argument('--webhooks',
+                        help='The path to a JSON list of webhooks to also send notifications to. Each entry has a "url" and optionally a "format" ("discord", "slack", or "json"), a "name", and a "batch_size". By default, only emails are sent.',
+                        dest='webhooks',
+                        default=None)
+    parser.add_argument('--max-concurrent-listeners',
+                        help='The maximum number of notification channels, like emails and each webhook, that can run at the same time.',
+                        dest='max_concurrent_listeners',
+                        default=8,
+                        type=int)
+    parser.add_argument('--listener-timeout',
+                        help='The number of seconds after which a notification channel that has not finished is abandoned.',
+                        dest='listener_timeout',
+                        default=60,
+                        type=float)
     args = parser.parse_args()
 
+    if args.shards > 0 and args.once:
+        parser.error('--once can not be used with --shards')
+
+    if args.metrics_port is not None:
+        metrics.start_server(args.metrics_port)
+
     # Load Twitch credentials
     with open(args.twitch_credentials, 'r') as file:
         twitch_credentials = json.load(file)
 
     # Create Twitch client
-    oauth_token = twitch_credentials['oauth_token']
-    user_id = twitch_credentials['user_id']
-    twitch_client = Client(client_id=Client.CLIENT_ID_TV, oath_token=oauth_token, user_id=user_id)
+    credentials = CredentialPool.from_json(twitch_credentials, requests_per_minute=args.twitch_requests_per_minute)
+    if len(credentials) == 0:
+        parser.error(f'No Twitch credentials found in {args.twitch_credentials}')
+    twitch_client = Client(client_id=Client.CLIENT_ID_TV, credentials=credentials, pool_size=max(10, 4 * len(credentials)))
+    logger.info(f'Using {len(credentials)} Twitch OAuth token(s).')
+    if args.max_concurrent_requests is None:
+        args.max_concurrent_requests = 4 * len(credentials)
 
-    firestore_client = firestore.Client()
+    storage = create_storage(args.storage, args.storage_path)
+
+    # Load the state saved before the last restart
+    checkpoint = None
+    state = {}
+    if args.checkpoint_path is not None:
+        checkpoint = Checkpoint(args.checkpoint_path, interval_seconds=args.checkpoint_interval)
+        state = checkpoint.load()
+
+        # Another instance may have been the leader since then, so the saved campaigns may be out of date
+        if args.shards > 0:
+            state.pop('watchdog', None)
 
     # Create watchdog
-    watchdog = TwitchDropsWatchdog(twitch_client, firestore_client, sleep_delay_seconds=args.sleep_delay)
+    watchdog = TwitchDropsWatchdog(
+        twitch_client,
+        storage,
+        sleep_delay_seconds=args.sleep_delay,
+        details_batch_size=args.details_batch_size,
+        max_concurrent_requests=args.max_concurrent_requests,
+        max_concurrent_writes=args.max_concurrent_writes,
+        full_refresh_interval_seconds=args.full_refresh_interval,
+        min_sleep_delay_seconds=args.min_sleep_delay,
+        max_sleep_delay_seconds=args.max_sleep_delay,
+        state=state.get('watchdog'),
+        max_concurrent_listeners=args.max_concurrent_listeners,
+        listener_timeout_seconds=args.listener_timeout
+    )
+
+    # Send notifications to webhooks. Only the instance running the watchdog sends them.
+    webhook_session = None
+    if args.webhooks is not None:
+        with open(args.webhooks) as file:
+            webhooks = json.load(file)
+        webhook_session = create_session()
+        for webhook in webhooks:
+            channel = WebhookChannel.from_json(webhook, session=webhook_session)
+            watchdog.add_on_new_campaign_details_listener(channel.on_new_campaign_details)
+            watchdog.add_on_new_games_listener(channel.on_new_games)
+        logger.info(f'Sending notifications to {len(webhooks)} webhook(s).')
+
+    # Share the work with other instances
+    coordinator = None
+    if args.shards > 0:
+        coordinator = ShardCoordinator(storage, shard_count=args.shards, lease_seconds=args.lease_seconds)
+        coordinator.start()
+        logger.info(f'Started instance {coordinator.instance_id} with {len(coordinator.get_shards())} of {args.shards} shards.')
 
     with open(args.email_credentials) as file:
         email_credentials = json.load(file)
 
     # Create email sender
-    email_sender = EmailSender(email_credentials, firestore_client, watchdog)
+    email_sender = EmailSender(
+        email_credentials,
+        storage,
+        watchdog,
+        smtp_pool_size=args.smtp_pool_size,
+        max_messages_per_connection=args.smtp_max_messages_per_connection,
+        outbox_path=args.outbox_path,
+        rate_per_second=args.email_rate_limit,
+        max_attempts=args.email_max_attempts,
+        template_cache_directory=args.template_cache_dir,
+        digest_window_seconds=args.email_digest_window,
+        coordinator=coordinator,
+        state=state.get('email_sender')
+    )
+
+    if checkpoint is not None:
+        if args.shards == 0:
+            checkpoint.add_source('watchdog', watchdog.get_state)
+        checkpoint.add_source('email_sender', email_sender.get_state)
+        checkpoint.start()
 
     # Start watchdog
-    watchdog.start()
+    try:
+        if coordinator is None:
+            watchdog.start(once=args.once)
+        else:
+            coordinator.start_watchdog(watchdog)
+        if args.once and not email_sender.flush(args.once_email_timeout):
+            logger.warning('Timed out waiting for emails to be sent. They will be sent on the next run.')
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        if coordinator is not None:
+            coordinator.close()
+        email_sender.close()
+        if webhook_session is not None:
+            webhook_session.close()
+        storage.close()
@@ -0,0 +1,77 @@
+import collections
+import datetime
+import threading
+from typing import Iterable, List, Optional
+
+from .expiry_scheduler import ExpiryScheduler
+from .storage import Change
+from .utils import get_datetime
+
+
+class ActiveCampaignsView:
+    """
+    An in-memory view of the campaigns that haven't ended yet, indexed by game ID. It is kept up to date by watching the
+    'campaigns' collection, and campaigns are dropped as soon as they end, so looking up the active campaigns for a user
+    doesn't read the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # Map campaign IDs to campaigns
+        self._campaigns = {}
+
+        # Map game IDs to the IDs of their campaigns
+        self._game_campaigns = collections.defaultdict(set)
+
+        self._expiry_scheduler = ExpiryScheduler()
+
+    def _remove(self, campaign_id: str):
+        campaign = self._campaigns.pop(campaign_id, None)
+        if campaign is None:
+            return
+        self._expiry_scheduler.unschedule(campaign_id)
+        campaign_ids = self._game_campaigns[campaign['game']['id']]
+        campaign_ids.discard(campaign_id)
+        if len(campaign_ids) == 0:
+            del self._game_campaigns[campaign['game']['id']]
+
+    def _remove_expired(self, now: datetime.datetime):
+        for campaign_id in self._expiry_scheduler.pop_expired(now):
+            self._remove(campaign_id)
+
+    def on_changes(self, changes: List[Change]):
+        """
+        Apply changes from the 'campaigns' collection. This can be passed to Storage.watch().
+        :param changes:
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            for change in changes:
+                self._remove(change.id)
+                if change.type == 'REMOVED':
+                    continue
+                end_time = get_datetime(change.data['endAt'])
+                if end_time <= now:
+                    continue
+                self._campaigns[change.id] = change.data
+                self._game_campaigns[change.data['game']['id']].add(change.id)
+                self._expiry_scheduler.schedule(change.id, end_time)
+
+    def get_campaigns(self, game_ids: Iterable[str], now: Optional[datetime.datetime] = None) -> List[dict]:
+        """
+        Get the active campaigns for some games.
+        :param game_ids:
+        :param now: The current time. Defaults to now.
+        :return: The campaigns, ordered by end time.
+        """
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._remove_expired(now)
+            campaigns = [self._campaigns[campaign_id] for game_id in set(game_ids) for campaign_id in self._game_campaigns.get(game_id, ())]
+        return sorted(campaigns, key=lambda x: get_datetime(x['endAt']))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._campaigns)
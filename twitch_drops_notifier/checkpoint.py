@@ -0,0 +1,117 @@
+import gzip
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from . import metrics
+from .utils import dumps_json, loads_json
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Increment this when the format of the saved state changes, so that old checkpoints are ignored
+VERSION = 1
+
+
+class Checkpoint:
+    """
+    Periodically saves the state derived from the database, like the known campaigns and the user index, to a compact
+    local file. After a restart, the state is loaded from the file so that only what changed since then needs to be
+    read from the database.
+    """
+
+    def __init__(self, path: str, interval_seconds: float = 60):
+        """
+        Creates a new Checkpoint.
+        :param path: The path of the file to save the state to. It is compressed with gzip.
+        :param interval_seconds: The number of seconds in between saves.
+        """
+        self._path = path
+        self._interval_seconds = interval_seconds
+
+        # Map names to functions that return the state to save under that name
+        self._sources = {}
+
+        # The state that was loaded, which is saved again for sources that have nothing new to save yet
+        self._loaded_state = {}
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def load(self) -> dict:
+        """
+        Load the saved state.
+        :return: A dictionary mapping the names passed to add_source() to their saved states. This is empty if there
+        is no saved state or it can't be read.
+        """
+        try:
+            with gzip.open(self._path, 'rt', encoding='utf-8') as file:
+                checkpoint = loads_json(file.read())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f'Failed to load checkpoint: {e}')
+            return {}
+        if checkpoint.get('version') != VERSION:
+            logger.warning(f'Ignoring checkpoint with version {checkpoint.get("version")}.')
+            return {}
+        logger.info(f'Loaded checkpoint from {time.time() - checkpoint["saved_at"]:.0f} seconds ago.')
+        self._loaded_state = checkpoint['state']
+        return checkpoint['state']
+
+    def add_source(self, name: str, get_state: Callable[[], Optional[dict]]):
+        """
+        Save the state returned by a function with every checkpoint.
+        :param name:
+        :param get_state: A function that returns the state to save. It is called from a background thread. If it
+        returns None, the state that was loaded under this name is kept.
+        """
+        self._sources[name] = get_state
+
+    @metrics.timed('checkpoint.save')
+    def save(self):
+        """
+        Save the current state. The file is replaced atomically, so a crash while saving keeps the previous checkpoint.
+        """
+        state = {}
+        for name, get_state in self._sources.items():
+            value = get_state()
+            if value is not None:
+                state[name] = value
+            elif name in self._loaded_state:
+                state[name] = self._loaded_state[name]
+        if len(state) == 0:
+            return
+
+        temporary_path = self._path + '.tmp'
+        with gzip.open(temporary_path, 'wt', encoding='utf-8') as file:
+            file.write(dumps_json({'version': VERSION, 'saved_at': time.time(), 'state': state}))
+        os.replace(temporary_path, self._path)
+        logger.debug(f'Saved checkpoint to {self._path}.')
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval_seconds):
+            try:
+                self.save()
+            except Exception as e:
+                logger.error('Failed to save checkpoint!', exc_info=e)
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='checkpoint', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop saving in the background and save one last time.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.save()
+        except Exception as e:
+            logger.error('Failed to save checkpoint!', exc_info=e)
@@ -0,0 +1,171 @@
+import heapq
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class PendingNotifications:
+    """
+    Everything that a single user should be notified about in their next email.
+    """
+
+    __slots__ = ('user', 'initial', 'update_time', 'campaigns', 'games', 'due_time')
+
+    def __init__(self, user: dict, due_time: float):
+        self.user = user
+        self.initial = False
+        self.update_time = None
+        self.campaigns = {}
+        self.games = {}
+        self.due_time = due_time
+
+    @property
+    def kinds(self) -> List[str]:
+        """
+        The kinds of notifications that are pending.
+        """
+        kinds = []
+        if self.initial:
+            kinds.append('initial')
+        elif self.update_time is not None:
+            kinds.append('update')
+        if len(self.campaigns) > 0:
+            kinds.append('new_campaigns')
+        if len(self.games) > 0:
+            kinds.append('new_games')
+        return kinds
+
+
+class DigestQueue:
+    """
+    Collects the notifications for each user for a short window, so that events that happen close together, like new
+    campaigns and new games found in the same poll or several quick preference changes, are sent as a single email.
+    The window starts at a user's first pending notification, so no notification is delayed by more than the window.
+    """
+
+    def __init__(self, flush: Callable[[List[PendingNotifications]], None], window_seconds: float = 60):
+        """
+        Creates a new DigestQueue.
+        :param flush: A function that sends the given pending notifications. It is called with every user whose window
+        ended at the same time.
+        :param window_seconds: The number of seconds to collect notifications for. If this is 0, notifications are
+        flushed as soon as the background thread wakes up, which still groups the emails of a single poll.
+        """
+        self._flush = flush
+        self._window_seconds = window_seconds
+
+        # Map emails to pending notifications
+        self._pending = {}
+
+        # A heap of (due time, email) tuples
+        self._heap = []
+
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def _get_pending(self, user) -> PendingNotifications:
+        pending = self._pending.get(user['email'])
+        if pending is None:
+            pending = self._pending[user['email']] = PendingNotifications(user, time.monotonic() + self._window_seconds)
+            heapq.heappush(self._heap, (pending.due_time, user['email']))
+            self._condition.notify()
+        else:
+            # Always use the latest preferences
+            pending.user = user
+        return pending
+
+    def _add(self, user, f):
+        with self._condition:
+            f(self._get_pending(user))
+
+    def add_initial(self, user):
+        def add(pending):
+            pending.initial = True
+        self._add(user, add)
+
+    def add_update(self, user, update_time):
+        def add(pending):
+            pending.update_time = update_time
+        self._add(user, add)
+
+    def add_campaigns(self, user, campaigns):
+        def add(pending):
+            for campaign in campaigns:
+                pending.campaigns[campaign['id']] = campaign
+        self._add(user, add)
+
+    def add_games(self, user, games):
+        def add(pending):
+            for game in games:
+                pending.games[game['id']] = game
+        self._add(user, add)
+
+    def remove(self, email: str):
+        """
+        Drop the pending notifications of a user, for example because they unsubscribed.
+        :param email:
+        """
+        with self._condition:
+            self._pending.pop(email, None)
+
+    def _pop_due(self, now: Optional[float]) -> List[PendingNotifications]:
+        due = []
+        with self._condition:
+            while len(self._heap) > 0 and (now is None or self._heap[0][0] <= now):
+                due_time, email = heapq.heappop(self._heap)
+                pending = self._pending.get(email)
+                if pending is not None and pending.due_time == due_time:
+                    due.append(self._pending.pop(email))
+        return due
+
+    def _flush_due(self):
+        due = self._pop_due(time.monotonic())
+        if len(due) > 0:
+            try:
+                self._flush(due)
+            except Exception as e:
+                logger.exception('Exception occurred while flushing notifications!', exc_info=e)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                timeout = None if len(self._heap) == 0 else max(0.0, self._heap[0][0] - time.monotonic())
+                self._condition.wait(timeout)
+                if self._stopped:
+                    return
+            self._flush_due()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='digest', daemon=True)
+        self._thread.start()
+
+    def flush(self):
+        """
+        Flush every pending notification now, without waiting for the end of its window.
+        """
+        due = self._pop_due(None)
+        if len(due) > 0:
+            self._flush(due)
+
+    def close(self):
+        """
+        Stop the background thread and flush every pending notification immediately.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
@@ -0,0 +1,150 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+from typing import Callable, Optional
+
+from . import metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def get_listener_name(listener) -> str:
+    name = getattr(listener, '__qualname__', type(listener).__name__)
+
+    # Tell apart the methods of objects that have a name, like webhook channels
+    owner_name = getattr(getattr(listener, '__self__', None), 'name', None)
+    if isinstance(owner_name, str):
+        name += f'[{owner_name}]'
+    return name
+
+
+class _Lane:
+    """
+    The notifications waiting to be passed to a single listener. Each lane delivers its notifications one at a time
+    and in order, so a listener is never called again before its previous call has returned.
+    """
+
+    def __init__(self, listener: Callable, queue_size: int):
+        self.listener = listener
+        self.name = get_listener_name(listener)
+        self.queue = collections.deque(maxlen=queue_size)
+        self.wake_event = asyncio.Event()
+        self.idle_event = asyncio.Event()
+        self.idle_event.set()
+        self.task = None
+
+
+class NotificationDispatcher:
+    """
+    Passes notifications to listeners without making the caller wait for them. Every listener has its own queue that is
+    delivered by its own task, and regular functions are run on a bounded thread pool, so a slow or stuck listener only
+    delays its own notifications. Calls that take longer than the timeout are abandoned and logged.
+
+    This must be used from a single event loop.
+    """
+
+    def __init__(self, max_workers: int = 8, timeout_seconds: float = 60, queue_size: int = 100):
+        """
+        Creates a new NotificationDispatcher.
+        :param max_workers: The maximum number of threads to run regular function listeners on. Each listener uses at
+        most one at a time, so this should be at least the number of listeners.
+        :param timeout_seconds: The number of seconds after which a call to a listener is abandoned. Coroutine
+        listeners are cancelled. Regular functions can't be interrupted, so their thread stays busy until they return,
+        and the listener's next notification waits for it.
+        :param queue_size: The maximum number of notifications to keep for each listener. When a listener falls this
+        far behind, its oldest notifications are dropped.
+        """
+        self._max_workers = max(1, max_workers)
+        self._timeout_seconds = timeout_seconds
+        self._queue_size = max(1, queue_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='listener')
+
+        # Map listeners to their lanes
+        self._lanes = {}
+
+    def _get_lane(self, listener: Callable) -> _Lane:
+        lane = self._lanes.get(listener)
+        if lane is None:
+            lane = self._lanes[listener] = _Lane(listener, self._queue_size)
+            lane.task = asyncio.create_task(self._run_lane(lane), name=f'listener-{lane.name}')
+            if len(self._lanes) > self._max_workers:
+                logger.warning(f'There are more listeners ({len(self._lanes)}) than listener threads ({self._max_workers}). Slow listeners may delay each other.')
+        return lane
+
+    def dispatch(self, listeners, parameters):
+        """
+        Queue a notification for each listener. This returns immediately.
+        :param listeners: Regular functions or coroutine functions that take `parameters`.
+        :param parameters:
+        """
+        for listener in listeners:
+            lane = self._get_lane(listener)
+            if len(lane.queue) == lane.queue.maxlen:
+                logger.warning(f'Listener {lane.name} is falling behind, dropping its oldest notification.')
+                metrics.increment('dispatcher.dropped')
+            lane.queue.append(parameters)
+            lane.idle_event.clear()
+            lane.wake_event.set()
+
+    async def _call(self, lane: _Lane, parameters):
+        start_time = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(lane.listener):
+                await asyncio.wait_for(lane.listener(parameters), self._timeout_seconds)
+            else:
+                future = asyncio.get_running_loop().run_in_executor(self._executor, lane.listener, parameters)
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), self._timeout_seconds)
+                except asyncio.TimeoutError:
+                    logger.error(f'Listener {lane.name} timed out after {self._timeout_seconds:.0f} seconds. Waiting for it to return...')
+                    metrics.increment('dispatcher.timeouts')
+                    await future
+                    return
+        except asyncio.TimeoutError:
+            logger.error(f'Listener {lane.name} timed out after {self._timeout_seconds:.0f} seconds and was cancelled.')
+            metrics.increment('dispatcher.timeouts')
+        except Exception as e:
+            logger.exception(f'Exception occurred while calling listener {lane.name}!', exc_info=e)
+            metrics.increment('dispatcher.errors')
+        finally:
+            metrics.observe('listener.' + lane.name, time.perf_counter() - start_time)
+
+    async def _run_lane(self, lane: _Lane):
+        while True:
+            await lane.wake_event.wait()
+            lane.wake_event.clear()
+            while len(lane.queue) > 0:
+                await self._call(lane, lane.queue.popleft())
+            lane.idle_event.set()
+
+    async def join(self, timeout_seconds: Optional[float] = None) -> bool:
+        """
+        Wait until every queued notification has been delivered.
+        :param timeout_seconds: The maximum number of seconds to wait. By default, there is no limit.
+        :return: True if every notification was delivered, or False if the timeout was reached.
+        """
+        lanes = list(self._lanes.values())
+        if len(lanes) == 0:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(lane.idle_event.wait() for lane in lanes)), timeout_seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self, timeout_seconds: Optional[float] = None):
+        """
+        Deliver the queued notifications and stop the lane tasks. The dispatcher can be used again afterwards, for
+        example on a new event loop.
+        :param timeout_seconds: The maximum number of seconds to wait for queued notifications. The rest are dropped.
+        """
+        if not await self.join(timeout_seconds):
+            pending = sum(len(lane.queue) for lane in self._lanes.values())
+            logger.warning(f'Timed out waiting for listeners, dropping {pending} queued notifications.')
+        for lane in self._lanes.values():
+            lane.task.cancel()
+        await asyncio.gather(*(lane.task for lane in self._lanes.values()), return_exceptions=True)
+        self._lanes.clear()
@@ -1,169 +1,433 @@
 import base64
+import collections
 import datetime
 import logging
+import threading
 from email.mime.text import MIMEText
-import smtplib
-
-import pytz
-from google.cloud import firestore
-from jinja2 import Environment, FileSystemLoader
-from jinja2.filters import FILTERS
-
+from typing import List, Optional
+
+from . import metrics
+from .active_campaigns import ActiveCampaignsView
+from .digest import DigestQueue, PendingNotifications
+from .outbox import Outbox, get_idempotency_key
+from .rendering import EmailRenderer
+from .sharding import ShardCoordinator, get_shard
+from .smtp_pool import SMTPConnectionPool
+from .storage import Change, Storage
+from .storage.base import USER_TOMBSTONE_RETENTION
 from .twitch_drops_watchdog import TwitchDropsWatchdog
-from .utils import get_datetime
+from .user_index import UserIndex
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# The maximum number of campaigns to store in a single event
+MAX_EVENT_CAMPAIGNS = 50
 
-def convert_time(value, user):
-    try:
-        value = get_datetime(value).astimezone(pytz.timezone(user['timezone']))
-    except pytz.exceptions.UnknownTimeZoneError:
-        pass
-    return value.strftime('%d %B %Y %H:%M %Z')
-
+# Changes to users that happened this long before a state was saved are read again when it is restored, in case they
+# had not reached the user index yet
+STATE_MARGIN = datetime.timedelta(seconds=10)
 
-FILTERS['convert_time'] = convert_time
+# The maximum number of user changes to keep for a shard that no instance owns
+MAX_DEFERRED_CHANGES = 1000
 
 
 class EmailSender:
 
-    def __init__(self, credentials, firestore_client: firestore.Client, watchdog: TwitchDropsWatchdog):
+    def __init__(self, credentials, storage: Storage, watchdog: TwitchDropsWatchdog, smtp_pool_size: int = 4,
+                 max_messages_per_connection: int = 100, outbox_path: str = 'outbox.sqlite3', rate_per_second: Optional[float] = None,
+                 max_attempts: int = 5, template_cache_directory: Optional[str] = None, digest_window_seconds: float = 60,
+                 coordinator: Optional[ShardCoordinator] = None, event_poll_seconds: float = 1, event_retention_seconds: float = 24 * 60 * 60,
+                 state: Optional[dict] = None):
+        """
+        Creates a new EmailSender.
+        :param credentials: The email account credentials. This must contain 'user' and 'password', and can contain
+        'host', 'port' and 'starttls' to use an SMTP server other than Gmail.
+        :param storage: Where users and campaigns are stored.
+        :param watchdog:
+        :param smtp_pool_size: The maximum number of SMTP connections to send emails over at the same time.
+        :param max_messages_per_connection: The number of emails to send over an SMTP connection before reconnecting.
+        :param outbox_path: The path of the SQLite database that queued emails are stored in.
+        :param rate_per_second: The maximum number of emails to send per second. If this is None, there is no limit.
+        :param max_attempts: The number of times to try sending an email before giving up on it.
+        :param template_cache_directory: A directory to store compiled email templates in.
+        :param digest_window_seconds: The number of seconds to collect a user's notifications for before sending
+        them as a single email.
+        :param coordinator: If this is given, only the users in the shards owned by this instance are sent emails. New
+        campaigns and games found by the leader are shared with the other instances through events in the storage.
+        :param event_poll_seconds: The number of seconds in between checks for new events, when sharded.
+        :param event_retention_seconds: The number of seconds to keep events for, when sharded. An instance that stops
+        for longer than this can miss notifications.
+        :param state: A state returned by get_state() before a restart. The users are loaded from it, and only the
+        users that changed since then are read from storage.
+        """
         self._credentials = credentials
 
-        self._firestore_client = firestore_client
+        self._smtp_pool = SMTPConnectionPool(
+            credentials.get('host', 'smtp.gmail.com'),
+            credentials.get('port', 587),
+            user=credentials.get('user'),
+            password=credentials.get('password'),
+            size=smtp_pool_size,
+            max_messages_per_connection=max_messages_per_connection,
+            starttls=credentials.get('starttls', True)
+        )
+
+        # Emails are queued and sent in the background so that listeners return immediately
+        self._outbox = Outbox(self._send_now, path=outbox_path, worker_count=smtp_pool_size, rate_per_second=rate_per_second, max_attempts=max_attempts)
+        self._outbox.start()
+
+        self._storage = storage
 
         self._start_time = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
 
         self._domain = 'https://twitch-drops-bot.uw.r.appspot.com'
 
-        self._jinja_environment = Environment(loader=FileSystemLoader('email_templates'))
+        self._renderer = EmailRenderer('email_templates', bytecode_cache_directory=template_cache_directory)
 
-        # Listen for database changes
-        firestore_client.collection('users').on_snapshot(self._on_snapshot_users)
+        self._user_index = UserIndex()
+
+        # Only the users in the shards owned by this instance are sent emails
+        self._coordinator = coordinator
+
+        # Map shards that no instance owns to the changes to their users, which are handled by whoever acquires them
+        self._deferred_changes = collections.defaultdict(lambda: collections.deque(maxlen=MAX_DEFERRED_CHANGES))
+        self._deferred_changes_lock = threading.Lock()
+        if coordinator is not None:
+            coordinator.add_on_shards_acquired_listener(self._on_shards_acquired)
 
-        watchdog.add_on_new_games_listener(self._on_new_games)
-        watchdog.add_on_new_campaign_details_listener(self._on_new_campaign_details)
+        # Notifications that happen close together are sent to each user as a single email
+        self._digest = DigestQueue(self._send_digests, digest_window_seconds)
+        self._digest.start()
+
+        # Keep the active campaigns in memory so that finding a user's campaigns doesn't read the database
+        self._active_campaigns = ActiveCampaignsView()
+        self._campaigns_subscription = storage.watch('campaigns', self._active_campaigns.on_changes)
+
+        # Resume from the saved users if we can still find out what changed since then
+        since = None
+        if state is not None:
+            since = datetime.datetime.fromisoformat(state['users_since'])
+            if since < datetime.datetime.now(datetime.timezone.utc) - USER_TOMBSTONE_RETENTION:
+                logger.warning('Saved users are too old, reloading every user.')
+                since = None
+            else:
+                for user in state['users']:
+                    self._user_index.add_or_update(user)
+                logger.info(f'Resumed with {len(self._user_index)} users.')
+
+        # Listen for database changes
+        self._users_subscription = storage.watch('users', self._on_users_changed, since=since)
+
+        self._event_poll_seconds = event_poll_seconds
+        self._event_retention = datetime.timedelta(seconds=event_retention_seconds)
+        self._stop_event = threading.Event()
+        self._event_thread = None
+        if coordinator is None:
+            watchdog.add_on_new_games_listener(self._on_new_games)
+            watchdog.add_on_new_campaign_details_listener(self._on_new_campaign_details)
+        else:
+            # Only the leader runs the watchdog, so it shares what it finds with every instance through events
+            watchdog.add_on_new_games_listener(self._publish_new_games)
+            watchdog.add_on_new_campaign_details_listener(self._publish_new_campaign_details)
+            self._event_thread = threading.Thread(target=self._consume_events, name='events', daemon=True)
+            self._event_thread.start()
 
         self._refresh_count = 0
 
     def _get_active_subscribed_games(self, user):
-        subscribed_games = []
-        for campaign_document in self._firestore_client.collection('campaigns').list_documents():
-            campaign = campaign_document.get().to_dict()
+        return self._active_campaigns.get_campaigns(user['games'])
+
+    def _owns(self, email: str) -> bool:
+        return self._coordinator is None or self._coordinator.owns(email)
 
-            # Ignore campaigns that have already ended
-            if datetime.datetime.now(datetime.timezone.utc) >= get_datetime(campaign['endAt']):
+    def _on_users_changed(self, changes: List[Change]):
+        for change in changes:
+            user = change.data
+
+            # Keep the user index up to date
+            if change.type == 'REMOVED':
+                self._user_index.remove(change.id)
+            else:
+                self._user_index.add_or_update(user)
+
+            # Other instances send the emails of users in shards we don't own. If nobody owns the shard right now, for
+            # example while it is being taken over, keep the change for whoever acquires it.
+            if not self._owns(change.id):
+                shard = get_shard(change.id, self._coordinator.shard_count)
+                if self._coordinator.is_unowned(shard):
+                    with self._deferred_changes_lock:
+                        self._deferred_changes[shard].append(change)
                 continue
 
-            if campaign['game']['id'] in user['games']:
-                subscribed_games.append(campaign)
-        return subscribed_games
+            self._handle_user_change(change)
 
-    def _on_snapshot_users(self, documents, changes, read):
+    def _on_shards_acquired(self, shards: List[int]):
+        with self._deferred_changes_lock:
+            changes = [change for shard in shards for change in self._deferred_changes.pop(shard, [])]
+
+            # Forget the changes of shards that another instance acquired, since it handles them
+            for shard in list(self._deferred_changes):
+                if not self._coordinator.is_unowned(shard):
+                    del self._deferred_changes[shard]
+        if len(changes) > 0:
+            logger.info(f'Handling {len(changes)} user changes from shards {shards}.')
         for change in changes:
-            user = change.document.to_dict()
-            if change.type.name == 'ADDED':
+            self._handle_user_change(change)
 
-                # Ignore documents that were added before this script was started
-                if datetime.datetime.fromisoformat(user['created']) < self._start_time:
-                    continue
+    def _handle_user_change(self, change: Change):
+        """
+        Send the emails for a change to one of the users owned by this instance.
+        """
+        user = change.data
+        if change.type == 'ADDED':
+
+            # Ignore documents that were added before this script was started
+            if datetime.datetime.fromisoformat(user['created']) < self._start_time:
+                return
 
-                logger.debug('User added: ' + user['email'])
+            logger.debug('User added: ' + user['email'])
 
-                # Send initial email
-                try:
-                    self._send_initial_email(user, self._get_active_subscribed_games(user))
-                except Exception as e:
-                    logger.error('Failed to send email: ' + str(e))
+            # Send initial email
+            self._digest.add_initial(user)
 
-            elif change.type.name == 'MODIFIED':
+        elif change.type == 'MODIFIED':
 
-                logger.debug('User modified: ' + user['email'])
-                try:
-                    self._send_update_email(user, self._get_active_subscribed_games(user))
-                except Exception as e:
-                    logger.error('Failed to send email: ' + str(e))
+            logger.debug('User modified: ' + user['email'])
+            self._digest.add_update(user, change.update_time)
 
-            elif change.type.name == 'REMOVED':
+        elif change.type == 'REMOVED':
 
-                logger.debug('User removed: ' + user['email'])
+            logger.debug('User removed: ' + change.id)
+            self._digest.remove(change.id)
 
-    def _on_new_games(self, games):
+    def _on_new_games(self, games, shards=None):
         # Send new game emails
-        for snapshot in self._firestore_client.collection('users').stream():
-            user = snapshot.to_dict()
-            if user.get('new_game_notifications', True):
-                try:
-                    self._send_new_games_email(user, games)
-                except Exception as e:
-                    logger.error('Failed to send email: ' + str(e))
-
-    def _on_new_campaign_details(self, campaigns):
-        # Send new campaign emails
-        for snapshot in self._firestore_client.collection('users').stream():
-            user = snapshot.to_dict()
-
-            # Get campaigns that the user is subscribed to
-            subscribed_campaigns = []
-            for campaign in campaigns:
-                if len(user['games']) == 0 or campaign['game']['id'] in user['games']:
-                    subscribed_campaigns.append(campaign)
-
-            # Send new campaigns email
-            if len(subscribed_campaigns) > 0:
-                try:
-                    self._send_new_campaigns_email(user, subscribed_campaigns)
-                except Exception as e:
-                    logger.error('Failed to send email: ' + str(e))
-
-    def _send(self, to, subject, body):
+        for user in self._user_index.get_new_games_subscribers():
+            if shards is None or get_shard(user['email'], self._coordinator.shard_count) in shards:
+                self._digest.add_games(user, games)
+
+    def _on_new_campaign_details(self, campaigns, shards=None):
+        # Send new campaigns emails to the users that are subscribed to at least one of the campaigns
+        for user, subscribed_campaigns in self._user_index.get_subscribed_campaigns(campaigns):
+            if shards is None or get_shard(user['email'], self._coordinator.shard_count) in shards:
+                self._digest.add_campaigns(user, subscribed_campaigns)
+
+    def _publish_new_games(self, games):
+        self._storage.add_event({'type': 'new_games', 'games': games})
+        self._remove_old_events()
+
+    def _publish_new_campaign_details(self, campaigns):
+        for i in range(0, len(campaigns), MAX_EVENT_CAMPAIGNS):
+            self._storage.add_event({'type': 'new_campaigns', 'campaigns': campaigns[i:i + MAX_EVENT_CAMPAIGNS]})
+        self._remove_old_events()
+
+    def _remove_old_events(self):
+        self._storage.remove_events(datetime.datetime.now(datetime.timezone.utc) - self._event_retention)
+
+    def _handle_event(self, event, shards):
+        if event['type'] == 'new_games':
+            self._on_new_games(event['games'], shards)
+        elif event['type'] == 'new_campaigns':
+            self._on_new_campaign_details(event['campaigns'], shards)
+        else:
+            logger.warning(f'Unknown event type: {event["type"]}')
+
+    def _consume_events(self):
+        timeout = self._event_poll_seconds
+        while not self._stop_event.wait(timeout):
+            timeout = self._event_poll_seconds
+            try:
+                shards = self._coordinator.get_shards()
+                if len(shards) == 0:
+                    continue
+                limit = 100
+                events = self._storage.get_events(min(shards.values()), limit)
+                for event_id, event in events:
+
+                    # Shards that were taken over from another instance may already be past this event
+                    targets = {shard for shard, cursor in shards.items() if cursor < event_id}
+                    if len(targets) > 0:
+                        self._handle_event(event, targets)
+                    for shard in targets:
+                        self._coordinator.set_cursor(shard, event_id)
+                        shards[shard] = event_id
+
+                # Don't wait if there are more events
+                if len(events) == limit:
+                    timeout = 0
+            except Exception as e:
+                logger.error('Failed to process events!', exc_info=e)
+
+    def _send_digests(self, pending_notifications: List[PendingNotifications]):
+        # Campaigns are rendered once per timezone and shared between users
+        fragment_cache = {}
+
+        for pending in pending_notifications:
+            try:
+                self._send_digest(pending, fragment_cache)
+            except Exception as e:
+                logger.error('Failed to send email: ' + str(e))
+        logger.debug(f'Outbox: {self._outbox.get_stats()}')
+
+    def _send_digest(self, pending: PendingNotifications, fragment_cache):
+        user = pending.user
+
+        # The user's preferences may have changed since the notifications were added
+        if len(user['games']) > 0:
+            pending.campaigns = {key: value for key, value in pending.campaigns.items() if value['game']['id'] in user['games']}
+        if not user.get('new_game_notifications', True):
+            pending.games = {}
+
+        kinds = pending.kinds
+        campaigns = list(pending.campaigns.values())
+        games = list(pending.games.values())
+
+        # Use the regular email when there is only one kind of notification
+        if kinds == ['new_campaigns']:
+            self._send_new_campaigns_email(user, campaigns, fragment_cache)
+        elif kinds == ['new_games']:
+            self._send_new_games_email(user, games)
+        elif kinds == ['initial']:
+            self._send_initial_email(user, self._get_active_subscribed_games(user), fragment_cache)
+        elif kinds == ['update']:
+            self._send_update_email(user, self._get_active_subscribed_games(user), pending.update_time, fragment_cache)
+        elif len(kinds) > 0:
+            self._send_digest_email(user, pending, fragment_cache)
+
+    @metrics.timed('email.send')
+    def _send_now(self, to, subject, body):
         message = MIMEText(body, 'html')
         message['to'] = to
         message['from'] = 'twitchdropsbot@gmail.com'
         message['subject'] = subject
 
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(self._credentials['user'], self._credentials['password'])
-        server.send_message(message)
-        server.quit()
-
-    def _send_new_campaigns_email(self, user, campaigns):
+        self._smtp_pool.send(message)
+        metrics.increment('email.sent')
+
+    def _send(self, key, to, subject, body):
+        """
+        Queue an email to be sent in the background.
+        :param key: An idempotency key that uniquely identifies this email. An email with a key that was already queued
+        is not sent again.
+        :param to:
+        :param subject:
+        :param body:
+        """
+        with metrics.span('email.enqueue'):
+            queued = self._outbox.enqueue(key, to, subject, body)
+        metrics.increment('email.queued' if queued else 'email.duplicate')
+
+    def get_state(self) -> dict:
+        """
+        Get the state of the user index, so that it can be saved and passed to the constructor after a restart. This
+        can be called from any thread.
+        :return:
+        """
+        # Take the time first, so that changes made while the users are copied are read again
+        users_since = datetime.datetime.now(datetime.timezone.utc) - STATE_MARGIN
+        return {
+            'users': self._user_index.get_users(),
+            'users_since': users_since.isoformat()
+        }
+
+    def flush(self, timeout_seconds: Optional[float] = None) -> bool:
+        """
+        Send pending notifications without waiting for their digest window, and wait until every queued email has been
+        sent.
+        :param timeout_seconds: The maximum number of seconds to wait. If this is None, wait forever.
+        :return: True if every email was sent, or False if the timeout expired first.
+        """
+        self._digest.flush()
+        return self._outbox.flush(timeout_seconds)
+
+    def close(self):
+        """
+        Stop sending emails and close the SMTP connections. Emails that have not been sent yet are sent the next time
+        the outbox is started.
+        """
+        self._stop_event.set()
+        if self._event_thread is not None:
+            self._event_thread.join()
+            self._event_thread = None
+        self._users_subscription.unsubscribe()
+        self._campaigns_subscription.unsubscribe()
+        self._digest.close()
+        self._outbox.close()
+        self._smtp_pool.close()
+
+    def _render_campaigns(self, user, campaigns, fragment_cache=None):
+        return self._renderer.render_campaigns(campaigns, user.get('timezone', 'UTC'), fragment_cache)
+
+    def _send_new_campaigns_email(self, user, campaigns, fragment_cache=None):
         logger.info('Sending new campaigns email to: ' + user['email'])
-        body = self._jinja_environment.get_template('new_campaigns.html').render(
+        body = self._renderer.render(
+            'new_campaigns.html',
             user=user,
             domain=self._domain,
-            campaigns=campaigns
+            campaign_fragments=self._render_campaigns(user, campaigns, fragment_cache)
         )
-        self._send(user['email'], 'New Twitch Drop Campaigns!', body)
+        key = get_idempotency_key('new_campaigns', user['email'], [campaign['id'] for campaign in campaigns])
+        self._send(key, user['email'], 'New Twitch Drop Campaigns!', body)
 
-    def _send_initial_email(self, user, campaigns):
+    def _send_initial_email(self, user, campaigns, fragment_cache=None):
         logger.info('Sending initial email to: ' + user['email'])
-        body = self._jinja_environment.get_template('message_and_campaigns_list.html').render(
+        body = self._renderer.render(
+            'message_and_campaigns_list.html',
             user=user,
             domain=self._domain,
-            campaigns=campaigns,
+            campaign_fragments=self._render_campaigns(user, campaigns, fragment_cache),
             message='You have subscribed to Twitch Drop Campaign notifications.'
         )
-        self._send(user['email'], 'Active Twitch Drop Campaigns', body)
+        key = get_idempotency_key('initial', user['email'], [user['id']])
+        self._send(key, user['email'], 'Active Twitch Drop Campaigns', body)
 
-    def _send_update_email(self, user, campaigns):
+    def _send_update_email(self, user, campaigns, update_time, fragment_cache=None):
         logger.info('Sending update email to: ' + user['email'])
-        body = self._jinja_environment.get_template('message_and_campaigns_list.html').render(
+        body = self._renderer.render(
+            'message_and_campaigns_list.html',
             user=user,
             domain=self._domain,
-            campaigns=campaigns,
+            campaign_fragments=self._render_campaigns(user, campaigns, fragment_cache),
             message='You recently updated your preferences.'
         )
-        self._send(user['email'], 'Active Twitch Drop Campaigns', body)
+        key = get_idempotency_key('update', user['email'], [user['id'], str(update_time)])
+        self._send(key, user['email'], 'Active Twitch Drop Campaigns', body)
 
     def _send_new_games_email(self, user, games):
         logger.info('Sending new games email to: ' + user['email'])
-        body = self._jinja_environment.get_template('new_games.html').render(
+        body = self._renderer.render(
+            'new_games.html',
             user=user,
             domain=self._domain,
             games=games
         )
-        self._send(user['email'], 'New Games', body)
+        key = get_idempotency_key('new_games', user['email'], [game['id'] for game in games])
+        self._send(key, user['email'], 'New Games', body)
+
+    def _send_digest_email(self, user, pending: PendingNotifications, fragment_cache=None):
+        logger.info('Sending digest email to: ' + user['email'])
+        message = None
+        campaigns = list(pending.campaigns.values())
+        ids = [f'campaign:{campaign_id}' for campaign_id in pending.campaigns] + [f'game:{game_id}' for game_id in pending.games]
+
+        # Welcome and preference emails list every active campaign, which includes the new ones
+        if pending.initial:
+            message = 'You have subscribed to Twitch Drop Campaign notifications.'
+            campaigns = self._get_active_subscribed_games(user)
+            ids.append(f'initial:{user["id"]}')
+        elif pending.update_time is not None:
+            message = 'You recently updated your preferences.'
+            campaigns = self._get_active_subscribed_games(user)
+            ids.append(f'update:{user["id"]}:{pending.update_time}')
+
+        body = self._renderer.render(
+            'digest.html',
+            user=user,
+            domain=self._domain,
+            message=message,
+            campaign_fragments=self._render_campaigns(user, campaigns, fragment_cache),
+            games=list(pending.games.values())
+        )
+        key = get_idempotency_key('digest', user['email'], ids)
+        self._send(key, user['email'], 'Twitch Drops Notifier', body)
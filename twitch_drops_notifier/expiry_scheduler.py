@@ -0,0 +1,71 @@
+import datetime
+import heapq
+from typing import Optional, List
+
+
+class ExpiryScheduler:
+    """
+    Keeps track of when campaigns end using a min-heap, so that finding the expired campaigns only costs as much as the
+    number of campaigns that expired.
+    """
+
+    def __init__(self):
+        # A heap of (end time, campaign ID) tuples. Entries that no longer match `_end_times` are stale and skipped.
+        self._heap = []
+
+        # Map campaign IDs to their current end time
+        self._end_times = {}
+
+    def schedule(self, campaign_id: str, end_time: datetime.datetime):
+        """
+        Schedule a campaign to expire at the given time. If the campaign was already scheduled, its end time is updated.
+        :param campaign_id:
+        :param end_time:
+        """
+        if self._end_times.get(campaign_id) == end_time:
+            return
+        self._end_times[campaign_id] = end_time
+        heapq.heappush(self._heap, (end_time, campaign_id))
+
+    def unschedule(self, campaign_id: str):
+        self._end_times.pop(campaign_id, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._end_times.clear()
+
+    def _remove_stale_entries(self):
+        while len(self._heap) > 0:
+            end_time, campaign_id = self._heap[0]
+            if self._end_times.get(campaign_id) == end_time:
+                break
+            heapq.heappop(self._heap)
+
+    def get_next_expiry_time(self) -> Optional[datetime.datetime]:
+        """
+        Get the time that the next campaign expires.
+        :return: The time that the next campaign expires, or None if no campaigns are scheduled.
+        """
+        self._remove_stale_entries()
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def pop_expired(self, now: datetime.datetime) -> List[str]:
+        """
+        Remove and return every campaign that has expired.
+        :param now: The current time.
+        :return: The IDs of the campaigns that ended at or before `now`.
+        """
+        expired_campaign_ids = []
+        while True:
+            self._remove_stale_entries()
+            if len(self._heap) == 0 or self._heap[0][0] > now:
+                break
+            end_time, campaign_id = heapq.heappop(self._heap)
+            del self._end_times[campaign_id]
+            expired_campaign_ids.append(campaign_id)
+        return expired_campaign_ids
+
+    def __len__(self):
+        return len(self._end_times)
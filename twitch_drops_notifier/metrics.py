@@ -0,0 +1,151 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import threading
+import time
+from typing import Dict
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds. Polls and email blasts can take minutes, so the buckets go higher than the defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+if prometheus_client is not None:
+    _span_seconds = prometheus_client.Histogram('twitch_drops_notifier_span_seconds', 'Time spent in each instrumented operation.', ['span'], buckets=BUCKETS)
+    _events = prometheus_client.Counter('twitch_drops_notifier_events', 'Number of times each event happened.', ['event'])
+
+
+class SpanStats:
+    """
+    Aggregated timings of a span.
+    """
+
+    __slots__ = ('count', 'total_seconds', 'max_seconds')
+
+    def __init__(self, count: int = 0, total_seconds: float = 0.0, max_seconds: float = 0.0):
+        self.count = count
+        self.total_seconds = total_seconds
+        self.max_seconds = max_seconds
+
+    def __repr__(self):
+        return f'SpanStats(count={self.count}, total={self.total_seconds:.3f}s, max={self.max_seconds:.3f}s)'
+
+
+# In-process totals, used for log summaries whether or not Prometheus is available
+_lock = threading.Lock()
+_spans: Dict[str, SpanStats] = {}
+_counters: Dict[str, int] = {}
+
+
+def observe(name: str, seconds: float):
+    """
+    Record the duration of a span.
+    :param name:
+    :param seconds:
+    """
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = SpanStats()
+        stats.count += 1
+        stats.total_seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+    if prometheus_client is not None:
+        _span_seconds.labels(name).observe(seconds)
+
+
+def increment(name: str, amount: int = 1):
+    """
+    Increment an event counter.
+    :param name:
+    :param amount:
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+    if prometheus_client is not None:
+        _events.labels(name).inc(amount)
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """
+    Time the body of a `with` block. The time is recorded even if the block raises an exception.
+    :param name:
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time)
+
+
+def timed(name: str):
+    """
+    Decorator that times every call of a function or coroutine function.
+    :param name:
+    """
+    def decorator(f):
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await f(*args, **kwargs)
+        else:
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_snapshot():
+    """
+    Get a copy of the in-process totals.
+    :return: A (spans, counters) tuple.
+    """
+    with _lock:
+        return {name: SpanStats(x.count, x.total_seconds, x.max_seconds) for name, x in _spans.items()}, dict(_counters)
+
+
+def get_summary(snapshot) -> str:
+    """
+    Describe what happened since a snapshot was taken, in a single line.
+    :param snapshot: A snapshot returned by get_snapshot().
+    :return:
+    """
+    spans_before, counters_before = snapshot
+    spans, counters = get_snapshot()
+    parts = []
+    for name, stats in sorted(spans.items()):
+        before = spans_before.get(name, SpanStats())
+        count = stats.count - before.count
+        if count > 0:
+            parts.append(f'{name}={count}x/{stats.total_seconds - before.total_seconds:.3f}s')
+    for name, value in sorted(counters.items()):
+        count = value - counters_before.get(name, 0)
+        if count > 0:
+            parts.append(f'{name}={count}')
+    return ' '.join(parts)
+
+
+def start_server(port: int, address: str = 'localhost') -> bool:
+    """
+    Serve Prometheus metrics over HTTP.
+    :param port:
+    :param address:
+    :return: True if the server was started, or False if prometheus_client is not installed.
+    """
+    if prometheus_client is None:
+        logger.warning('Metrics server not started: prometheus_client is not installed.')
+        return False
+    prometheus_client.start_http_server(port, addr=address)
+    logger.info(f'Serving metrics at http://{address}:{port}/metrics')
+    return True
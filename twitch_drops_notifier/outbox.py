@@ -0,0 +1,317 @@
+import collections
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional, Callable, Iterable
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# How long sent and dead emails are kept. Queueing the same email again within this time does not send it twice.
+DEFAULT_RETENTION_SECONDS = 60 * 60 * 24 * 30
+
+
+def get_idempotency_key(kind: str, email: str, ids: Iterable[str] = ()) -> str:
+    """
+    Create a key that identifies an email, so that the same email is never queued twice.
+    :param kind: The kind of email, for example 'new_campaigns'.
+    :param email: The recipient.
+    :param ids: The IDs of the things that the email is about, for example campaign IDs.
+    :return:
+    """
+    digest = hashlib.sha1(','.join(sorted(ids)).encode('utf-8')).hexdigest()
+    return f'{kind}:{email}:{digest}'
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket rate limiter.
+    """
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        """
+        Creates a new TokenBucket.
+        :param rate_per_second: The number of tokens added to the bucket every second.
+        :param capacity: The maximum number of tokens in the bucket. This is the largest burst that is allowed.
+        """
+        self._rate_per_second = rate_per_second
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last_update_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        Try to take a token from the bucket.
+        :return: 0 if a token was taken, otherwise the number of seconds until a token is available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last_update_time) * self._rate_per_second)
+            self._last_update_time = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate_per_second
+
+    def acquire(self, stop_event: Optional[threading.Event] = None) -> bool:
+        """
+        Take a token from the bucket, waiting until one is available.
+        :param stop_event: If this is set while waiting, give up.
+        :return: True if a token was taken, False if `stop_event` was set.
+        """
+        while True:
+            delay = self.try_acquire()
+            if delay == 0:
+                return True
+            if stop_event is None:
+                time.sleep(delay)
+            elif stop_event.wait(delay):
+                return False
+
+
+class Outbox:
+    """
+    A durable queue of outgoing emails stored in SQLite. Emails are sent by a pool of worker threads. Failed emails
+    are retried with exponential backoff and moved to a dead letter state after too many attempts. Every email has an
+    idempotency key, so queueing the same email again, for example after a restart, does not send it twice. Sent and
+    dead emails are deleted once they are older than the retention time.
+    """
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEAD = 'dead'
+
+    def __init__(self, send: Callable[[str, str, str], None], path: str = 'outbox.sqlite3', worker_count: int = 4,
+                 rate_per_second: Optional[float] = None, burst: int = 10, max_attempts: int = 5,
+                 retry_delay_seconds: float = 60, max_retry_delay_seconds: float = 60 * 60, retention_seconds: float = DEFAULT_RETENTION_SECONDS,
+                 prune_interval_seconds: float = 60 * 60):
+        """
+        Creates a new Outbox.
+        :param send: A function that sends an email given the recipient, subject and body. It should raise an
+        exception if the email could not be sent.
+        :param path: The path of the SQLite database file.
+        :param worker_count: The number of threads that send emails.
+        :param rate_per_second: The maximum number of emails to send per second. If this is None, there is no limit.
+        :param burst: The maximum number of emails that can be sent in a burst when `rate_per_second` is set.
+        :param max_attempts: The number of times to try sending an email before giving up on it.
+        :param retry_delay_seconds: The delay before the first retry. This is doubled after every failed attempt.
+        :param max_retry_delay_seconds: The maximum delay between retries.
+        :param retention_seconds: The number of seconds after which sent and dead emails are deleted. This is how long
+        their idempotency keys prevent them from being sent again.
+        :param prune_interval_seconds: The number of seconds in between deletions of old emails.
+        """
+        self._send = send
+        self._worker_count = worker_count
+        self._rate_limiter = None if rate_per_second is None else TokenBucket(rate_per_second, burst)
+        self._max_attempts = max_attempts
+        self._retry_delay_seconds = retry_delay_seconds
+        self._max_retry_delay_seconds = max_retry_delay_seconds
+        self._retention_seconds = retention_seconds
+        self._prune_interval_seconds = prune_interval_seconds
+
+        # The connection is shared by all threads, so every access must hold the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                recipient TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                sent_at REAL,
+                error TEXT
+            )
+        ''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_status_next_attempt_at ON jobs (status, next_attempt_at)')
+
+        # Emails that were being sent when the process stopped are sent again
+        self._connection.execute('UPDATE jobs SET status = ? WHERE status = ?', (Outbox.PENDING, Outbox.SENDING))
+
+        # Notified when a new job is queued
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._workers = []
+
+        # The time between queueing and sending of the most recently sent emails
+        self._latencies = collections.deque(maxlen=1000)
+
+    def enqueue(self, key: str, to: str, subject: str, body: str) -> bool:
+        """
+        Queue an email to be sent.
+        :param key: An idempotency key that uniquely identifies this email. See get_idempotency_key().
+        :param to:
+        :param subject:
+        :param body:
+        :return: True if the email was queued, or False if an email with the same key was already queued.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO jobs (key, recipient, subject, body, status, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, to, subject, body, Outbox.PENDING, now, now)
+            )
+        if cursor.rowcount == 0:
+            logger.debug(f'Ignoring duplicate email: {key}')
+            return False
+        with self._condition:
+            self._condition.notify()
+        return True
+
+    def _claim_job(self):
+        """
+        Take the next job that is ready to be sent.
+        :return: A (job, delay) tuple. If no job is ready, job is None and delay is the number of seconds until the
+        next job is ready, or None if there are no pending jobs.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT id, key, recipient, subject, body, attempts, created_at, next_attempt_at FROM jobs WHERE status = ? ORDER BY next_attempt_at LIMIT 1',
+                (Outbox.PENDING,)
+            ).fetchone()
+            if row is None:
+                return None, None
+            if row[7] > now:
+                return None, row[7] - now
+            self._connection.execute('UPDATE jobs SET status = ? WHERE id = ?', (Outbox.SENDING, row[0]))
+        return row, 0
+
+    def _process(self, job):
+        job_id, key, to, subject, body, attempts, created_at, _ = job
+        attempts += 1
+        try:
+            self._send(to, subject, body)
+        except Exception as e:
+            if attempts >= self._max_attempts:
+                logger.error(f'Giving up on email {key} after {attempts} attempts: {e}')
+                with self._lock:
+                    self._connection.execute('UPDATE jobs SET status = ?, attempts = ?, error = ? WHERE id = ?', (Outbox.DEAD, attempts, str(e), job_id))
+                return
+            delay = min(self._retry_delay_seconds * (2 ** (attempts - 1)), self._max_retry_delay_seconds)
+            logger.warning(f'Failed to send email {key}: {e}. Retrying in {delay:.0f} seconds...')
+            with self._lock:
+                self._connection.execute(
+                    'UPDATE jobs SET status = ?, attempts = ?, error = ?, next_attempt_at = ? WHERE id = ?',
+                    (Outbox.PENDING, attempts, str(e), time.time() + delay, job_id)
+                )
+            return
+
+        # The body is not needed anymore, but the key is kept so that the email is not sent again
+        now = time.time()
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET status = ?, attempts = ?, body = NULL, sent_at = ? WHERE id = ?', (Outbox.SENT, attempts, now, job_id))
+            self._latencies.append(now - created_at)
+
+    def _run_worker(self):
+        while not self._stop_event.is_set():
+            try:
+                job, delay = self._claim_job()
+            except sqlite3.Error as e:
+                logger.error('Failed to read outbox!', exc_info=e)
+                job, delay = None, 1
+
+            # Wait for a job to be queued or become ready
+            if job is None:
+                with self._condition:
+                    self._condition.wait(timeout=1 if delay is None else min(delay, 60))
+                continue
+
+            if self._rate_limiter is not None and not self._rate_limiter.acquire(self._stop_event):
+                # We are stopping, so put the job back
+                with self._lock:
+                    self._connection.execute('UPDATE jobs SET status = ? WHERE id = ?', (Outbox.PENDING, job[0]))
+                break
+
+            try:
+                self._process(job)
+            except Exception as e:
+                logger.exception('Exception occurred while sending email!', exc_info=e)
+
+    def prune(self) -> int:
+        """
+        Delete the sent and dead emails that are older than the retention time.
+        :return: The number of emails that were deleted.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'DELETE FROM jobs WHERE status IN (?, ?) AND COALESCE(sent_at, created_at) < ?',
+                (Outbox.SENT, Outbox.DEAD, time.time() - self._retention_seconds)
+            )
+        if cursor.rowcount > 0:
+            logger.info(f'Deleted {cursor.rowcount} old emails from the outbox.')
+        return cursor.rowcount
+
+    def _run_pruner(self):
+        while True:
+            try:
+                self.prune()
+            except sqlite3.Error as e:
+                logger.error('Failed to prune outbox!', exc_info=e)
+            if self._stop_event.wait(self._prune_interval_seconds):
+                break
+
+    def start(self):
+        for i in range(self._worker_count):
+            worker = threading.Thread(target=self._run_worker, name=f'outbox-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        pruner = threading.Thread(target=self._run_pruner, name='outbox-pruner', daemon=True)
+        pruner.start()
+        self._workers.append(pruner)
+
+    def flush(self, timeout_seconds: Optional[float] = None) -> bool:
+        """
+        Wait until every queued email has been sent or given up on.
+        :param timeout_seconds: The maximum number of seconds to wait. If this is None, wait forever.
+        :return: True if the outbox is empty, or False if the timeout expired first.
+        """
+        deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+        while self.get_stats()['depth'] > 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def close(self, timeout_seconds: Optional[float] = None):
+        """
+        Stop the workers once they finish the emails they are sending. Emails that have not been sent yet stay in the
+        outbox and are sent the next time it is started.
+        :param timeout_seconds: The maximum number of seconds to wait for each worker.
+        """
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join(timeout_seconds)
+        self._workers.clear()
+        with self._lock:
+            self._connection.close()
+
+    def get_stats(self) -> dict:
+        """
+        Get the number of emails in each state and the latency of recently sent emails.
+        :return:
+        """
+        with self._lock:
+            counts = dict(self._connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            oldest_pending = self._connection.execute('SELECT MIN(created_at) FROM jobs WHERE status = ?', (Outbox.PENDING,)).fetchone()[0]
+            latencies = list(self._latencies)
+        return {
+            'depth': counts.get(Outbox.PENDING, 0) + counts.get(Outbox.SENDING, 0),
+            'sent': counts.get(Outbox.SENT, 0),
+            'dead': counts.get(Outbox.DEAD, 0),
+            'oldest_pending_age_seconds': 0 if oldest_pending is None else time.time() - oldest_pending,
+            'average_latency_seconds': sum(latencies) / len(latencies) if len(latencies) > 0 else 0,
+            'max_latency_seconds': max(latencies, default=0)
+        }
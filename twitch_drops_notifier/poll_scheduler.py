@@ -0,0 +1,80 @@
+import datetime
+import random
+from typing import Iterable, Optional
+
+
+class PollScheduler:
+    """
+    Decides how long to wait before the next poll. The interval drops to the minimum after a poll that found changes and
+    grows again while nothing changes. Polls are also scheduled shortly after known campaign start times, since that is
+    when new drops become available.
+    """
+
+    def __init__(self, interval_seconds: float, min_interval_seconds: Optional[float] = None, max_interval_seconds: Optional[float] = None,
+                 backoff_factor: float = 1.5, jitter: float = 0.1, start_delay_seconds: float = 60):
+        """
+        Creates a new PollScheduler.
+        :param interval_seconds: The interval to start with.
+        :param min_interval_seconds: The interval used after a poll that found changes. Defaults to a quarter of
+        `interval_seconds`.
+        :param max_interval_seconds: The longest interval to back off to while nothing changes. Defaults to twice
+        `interval_seconds`.
+        :param backoff_factor: The interval is multiplied by this after every poll that found no changes.
+        :param jitter: The delay is randomly changed by up to this fraction, so that polls don't line up with other
+        clients.
+        :param start_delay_seconds: The number of seconds after a campaign's start time to poll at.
+        """
+        self._min_interval_seconds = interval_seconds / 4 if min_interval_seconds is None else min_interval_seconds
+        self._max_interval_seconds = interval_seconds * 2 if max_interval_seconds is None else max_interval_seconds
+        self._min_interval_seconds = min(self._min_interval_seconds, self._max_interval_seconds)
+        self._interval_seconds = min(max(interval_seconds, self._min_interval_seconds), self._max_interval_seconds)
+        self._backoff_factor = backoff_factor
+        self._jitter = jitter
+        self._start_delay = datetime.timedelta(seconds=start_delay_seconds)
+
+        # Start times of campaigns that haven't started yet, in ascending order
+        self._start_times = []
+
+    @property
+    def interval_seconds(self) -> float:
+        return self._interval_seconds
+
+    @interval_seconds.setter
+    def interval_seconds(self, value: float):
+        self._interval_seconds = min(max(value, self._min_interval_seconds), self._max_interval_seconds)
+
+    def set_start_times(self, start_times: Iterable[datetime.datetime]):
+        """
+        Replace the known campaign start times.
+        :param start_times:
+        """
+        self._start_times = sorted(set(start_times))
+
+    def record_poll(self, changed: bool):
+        """
+        Update the interval after a poll.
+        :param changed: Whether the poll found new or changed campaigns or games.
+        """
+        if changed:
+            self._interval_seconds = self._min_interval_seconds
+        else:
+            self._interval_seconds = min(self._interval_seconds * self._backoff_factor, self._max_interval_seconds)
+
+    def get_delay(self, now: datetime.datetime, poll_duration_seconds: float = 0) -> float:
+        """
+        Get the number of seconds to wait before the next poll.
+        :param now: The current time.
+        :param poll_duration_seconds: How long the last poll took. This is subtracted from the interval so that polls
+        start at a steady rate.
+        :return:
+        """
+        delay = self._interval_seconds * random.uniform(1 - self._jitter, 1 + self._jitter) - poll_duration_seconds
+
+        # Poll shortly after the next campaign starts if that's sooner
+        for start_time in self._start_times:
+            start_delay = (start_time + self._start_delay - now).total_seconds()
+            if start_delay > 0:
+                delay = min(delay, start_delay)
+                break
+
+        return max(0.0, delay)
@@ -0,0 +1,78 @@
+import datetime
+import functools
+import threading
+from typing import Optional
+
+import pytz
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+from . import metrics
+from .utils import get_datetime, get_timezone
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_time(value: datetime.datetime, timezone: str) -> str:
+    try:
+        value = value.astimezone(get_timezone(timezone))
+    except pytz.exceptions.UnknownTimeZoneError:
+        pass
+    return value.strftime('%d %B %Y %H:%M %Z')
+
+
+def convert_time(value, timezone):
+    return _format_time(get_datetime(value), timezone)
+
+
+class EmailRenderer:
+    """
+    Renders email templates. Templates are compiled once when the renderer is created. Campaigns are rendered into
+    fragments that only depend on the campaign and the timezone of the recipient, so that a fragment can be shared by
+    every recipient in the same timezone.
+    """
+
+    def __init__(self, directory: str = 'email_templates', bytecode_cache_directory: Optional[str] = None):
+        """
+        Creates a new EmailRenderer.
+        :param directory: The directory that contains the templates.
+        :param bytecode_cache_directory: A directory to store compiled templates in, so that they don't need to be
+        compiled again when the process restarts. If this is None, compiled templates are only kept in memory.
+        """
+        bytecode_cache = None if bytecode_cache_directory is None else FileSystemBytecodeCache(bytecode_cache_directory)
+
+        # Templates never change while we are running, so don't check if they are up to date
+        self._environment = Environment(loader=FileSystemLoader(directory), bytecode_cache=bytecode_cache, auto_reload=False)
+        self._environment.filters['convert_time'] = convert_time
+
+        # Compile every template up front
+        self._templates = {name: self._environment.get_template(name) for name in self._environment.list_templates()}
+
+        self._lock = threading.Lock()
+        self.render_count = 0
+
+    @metrics.timed('email.render')
+    def render(self, template_name: str, **kwargs) -> str:
+        with self._lock:
+            self.render_count += 1
+        return self._templates[template_name].render(**kwargs)
+
+    @metrics.timed('email.render_campaigns')
+    def render_campaigns(self, campaigns, timezone: str, cache: Optional[dict] = None):
+        """
+        Render a fragment for each campaign in the given timezone.
+        :param campaigns:
+        :param timezone: The name of the timezone to show times in.
+        :param cache: A dictionary used to share rendered fragments between calls. Fragments are keyed by campaign ID
+        and timezone, so the cache must not outlive changes to the campaigns, for example it can be used for the
+        duration of a single notification blast.
+        :return: A list of rendered fragments in the same order as `campaigns`.
+        """
+        fragments = []
+        for campaign in campaigns:
+            key = (campaign['id'], timezone)
+            fragment = None if cache is None else cache.get(key)
+            if fragment is None:
+                fragment = self.render('campaign.html', campaign=campaign, timezone=timezone)
+                if cache is not None:
+                    cache[key] = fragment
+            fragments.append(fragment)
+        return fragments
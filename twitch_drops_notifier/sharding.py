@@ -0,0 +1,305 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from .storage import Storage
+from .storage.base import get_event_id_bound
+from .twitch_drops_watchdog import TwitchDropsWatchdog
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE = 'leader'
+
+
+def get_shard(email: str, shard_count: int) -> int:
+    """
+    Get the shard that a user belongs to.
+    :param email:
+    :param shard_count:
+    :return:
+    """
+    return int(hashlib.sha1(email.lower().encode('utf-8')).hexdigest()[:8], 16) % shard_count
+
+
+class ShardCoordinator:
+    """
+    Splits the users into shards and balances them between every running instance using leases. Each instance sends
+    the emails of the users in the shards it owns, and a single elected leader polls the Twitch API. Leases are renewed
+    by a heartbeat, and the shards of an instance that stops renewing them are taken over once they expire.
+
+    Each shard lease also stores the ID of the last event processed for that shard, so that an instance that takes
+    over a shard continues where the previous owner stopped. Changes to users are only seen by the instances that are
+    running when they happen. Changes to the users of a shard that has no owner are kept by every instance and handled
+    by the one that acquires it, but changes that reach an owner that stops before handling them are lost.
+    """
+
+    def __init__(self, storage: Storage, shard_count: int = 16, lease_seconds: float = 30, heartbeat_seconds: Optional[float] = None,
+                 instance_id: Optional[str] = None):
+        """
+        Creates a new ShardCoordinator.
+        :param storage: Where leases are stored. Every instance must use the same storage.
+        :param shard_count: The number of shards to split users into. Every instance must use the same number.
+        :param lease_seconds: The number of seconds after which the leases of an instance that stopped responding
+        expire.
+        :param heartbeat_seconds: The number of seconds in between lease renewals. Defaults to a third of
+        `lease_seconds`.
+        :param instance_id: A unique ID for this instance. Defaults to one made from the host name and process ID.
+        """
+        self._storage = storage
+        self._shard_count = shard_count
+        self._lease_seconds = lease_seconds
+        self._heartbeat_seconds = lease_seconds / 3 if heartbeat_seconds is None else heartbeat_seconds
+        self.instance_id = instance_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+        self._lock = threading.Lock()
+
+        # Map owned shards to the ID of the last event processed for them
+        self._cursors = {}
+
+        # Map owned shards to the time that their lease expires
+        self._expiry_times = {}
+
+        self._leader_expiry_time = 0
+
+        # Shards that had no valid lease at the last heartbeat
+        self._unowned_shards = set()
+        self._on_shards_acquired_listeners = []
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def shard_count(self) -> int:
+        return self._shard_count
+
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self._leader_expiry_time
+
+    def _is_valid(self, expiry_time: float) -> bool:
+        # Stop using a lease a little before it expires, in case our clock is behind
+        return time.time() < expiry_time - self._heartbeat_seconds / 2
+
+    def get_shards(self) -> Dict[int, str]:
+        """
+        Get the shards owned by this instance.
+        :return: A dictionary mapping shards to the ID of the last event processed for them.
+        """
+        with self._lock:
+            return {shard: cursor for shard, cursor in self._cursors.items() if self._is_valid(self._expiry_times[shard])}
+
+    def owns(self, email: str) -> bool:
+        """
+        Check if this instance is responsible for a user.
+        :param email:
+        :return:
+        """
+        shard = get_shard(email, self._shard_count)
+        with self._lock:
+            return shard in self._cursors and self._is_valid(self._expiry_times[shard])
+
+    def is_unowned(self, shard: int) -> bool:
+        """
+        Check if no instance owned a shard at the last heartbeat, for example because its owner stopped and its lease
+        has not expired yet.
+        :param shard:
+        :return:
+        """
+        with self._lock:
+            return shard in self._unowned_shards
+
+    def add_on_shards_acquired_listener(self, listener: Callable[[List[int]], None]):
+        """
+        Add a listener that is called after every heartbeat with the shards that this instance acquired in it. It is
+        called from the heartbeat thread, even if no shards were acquired.
+        """
+        self._on_shards_acquired_listeners.append(listener)
+
+    def set_cursor(self, shard: int, event_id: str):
+        """
+        Remember that every event up to and including `event_id` has been processed for a shard. The cursor is stored
+        right away, so that an instance that takes over the shard doesn't process the event again.
+        :param shard:
+        :param event_id:
+        """
+        with self._lock:
+            if shard not in self._cursors:
+                return
+            self._cursors[shard] = event_id
+        lease = self._storage.acquire_lease(f'shard:{shard}', self.instance_id, self._lease_seconds, {'cursor': event_id})
+        self._update_shard(shard, lease)
+
+    def _update_shard(self, shard: int, lease: Optional[dict]):
+        # Forget a shard if its lease was taken over by another instance
+        with self._lock:
+            released = shard not in self._cursors
+            if not released and lease is None:
+                logger.warning(f'Lost shard {shard}.')
+                del self._cursors[shard]
+                del self._expiry_times[shard]
+            elif not released:
+                self._expiry_times[shard] = lease['expires_at']
+
+        # The shard was released while its lease was being renewed, so give it back again
+        if released and lease is not None:
+            self._storage.release_lease(f'shard:{shard}', self.instance_id)
+
+    def _heartbeat(self):
+        now = time.time()
+        with self._lock:
+            previous_shards = set(self._cursors)
+
+        # Let the other instances know that we are alive, so they can work out their share of the shards
+        self._storage.acquire_lease(f'instance:{self.instance_id}', self.instance_id, self._lease_seconds)
+
+        leader_lease = self._storage.acquire_lease(LEADER_LEASE, self.instance_id, self._lease_seconds)
+        was_leader = self.is_leader
+        self._leader_expiry_time = 0 if leader_lease is None else leader_lease['expires_at']
+        if self.is_leader != was_leader:
+            logger.info(f'Instance {self.instance_id} is {"now" if self.is_leader else "no longer"} the leader.')
+
+        leases = self._storage.get_leases()
+        instance_count = sum(1 for name, lease in leases.items() if name.startswith('instance:') and lease['expires_at'] > now)
+
+        # Delete the leases of instances that stopped, so that reading the leases doesn't get slower with every restart
+        if self.is_leader:
+            for name, lease in leases.items():
+                if name.startswith('instance:') and lease['expires_at'] <= now:
+                    self._storage.remove_lease(name)
+        fair_share = math.ceil(self._shard_count / max(1, instance_count))
+
+        # Renew the shards we own. Their cursors were stored when they were set.
+        with self._lock:
+            owned_shards = list(self._cursors)
+        for shard in owned_shards:
+            self._update_shard(shard, self._storage.acquire_lease(f'shard:{shard}', self.instance_id, self._lease_seconds))
+
+        # Give shards back when there are more instances, so that they can take them over
+        with self._lock:
+            extra_shards = sorted(self._cursors)[fair_share:]
+        for shard in extra_shards:
+            self._release_shard(shard)
+
+        # Take over shards that are not owned by anyone
+        for shard in range(self._shard_count):
+            with self._lock:
+                if len(self._cursors) >= fair_share:
+                    break
+                if shard in self._cursors:
+                    continue
+            lease = leases.get(f'shard:{shard}')
+            if lease is not None and lease['owner'] != self.instance_id and lease['expires_at'] > now:
+                continue
+            lease = self._storage.acquire_lease(f'shard:{shard}', self.instance_id, self._lease_seconds)
+            if lease is not None and lease.get('cursor') is None:
+                # Nobody has processed this shard before, so start with the events added from now on
+                data = {'cursor': get_event_id_bound(datetime.datetime.now(datetime.timezone.utc))}
+                lease = self._storage.acquire_lease(f'shard:{shard}', self.instance_id, self._lease_seconds, data)
+            if lease is not None:
+                logger.info(f'Acquired shard {shard}.')
+                with self._lock:
+                    self._cursors[shard] = lease.get('cursor')
+                    self._expiry_times[shard] = lease['expires_at']
+
+        with self._lock:
+            # Shards we just released count as unowned until another instance acquires them
+            self._unowned_shards = {
+                shard for shard in range(self._shard_count)
+                if shard not in self._cursors and self._is_free(leases.get(f'shard:{shard}'), now)
+            }
+            acquired_shards = sorted(set(self._cursors) - previous_shards)
+        for listener in self._on_shards_acquired_listeners:
+            try:
+                listener(acquired_shards)
+            except Exception as e:
+                logger.error('Exception occurred while calling shards listener!', exc_info=e)
+
+    def _is_free(self, lease: Optional[dict], now: float) -> bool:
+        return lease is None or lease['owner'] == self.instance_id or lease['expires_at'] <= now
+
+    def _release_shard(self, shard: int):
+        with self._lock:
+            self._cursors.pop(shard, None)
+            self._expiry_times.pop(shard, None)
+        self._storage.release_lease(f'shard:{shard}', self.instance_id)
+        logger.info(f'Released shard {shard}.')
+
+    def _beat(self):
+        try:
+            self._heartbeat()
+        except Exception as e:
+            logger.error('Failed to renew leases!', exc_info=e)
+
+    def _run(self):
+        while not self._stop_event.wait(self._heartbeat_seconds):
+            self._beat()
+
+    def start(self):
+        """
+        Acquire leases and keep renewing them in the background. The first heartbeat happens before this returns, so
+        that users can be assigned to this instance right away.
+        """
+        self._stop_event.clear()
+        self._beat()
+        self._thread = threading.Thread(target=self._run, name='shard-coordinator', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop renewing leases and release them, so that other instances can take over immediately.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            with self._lock:
+                owned_shards = list(self._cursors)
+            for shard in owned_shards:
+                self._release_shard(shard)
+            self._leader_expiry_time = 0
+            self._storage.release_lease(LEADER_LEASE, self.instance_id)
+            self._storage.remove_lease(f'instance:{self.instance_id}', self.instance_id)
+        except Exception as e:
+            logger.error('Failed to release leases!', exc_info=e)
+
+    async def run_watchdog(self, watchdog: TwitchDropsWatchdog):
+        """
+        Run the watchdog while this instance is the leader, until the coordinator is closed.
+        :param watchdog:
+        """
+        while not self._stop_event.is_set():
+            if not self.is_leader:
+                await asyncio.sleep(1)
+                continue
+
+            # The previous leader may have written campaigns and games since this instance last polled
+            watchdog.cache.invalidate()
+
+            task = asyncio.create_task(watchdog.run())
+            while self.is_leader and not task.done() and not self._stop_event.is_set():
+                await asyncio.sleep(1)
+            if not task.done():
+                logger.info('Stopping watchdog.')
+                watchdog.stop()
+            await task
+
+    def start_watchdog(self, watchdog: TwitchDropsWatchdog):
+        """
+        Run the watchdog on a new event loop while this instance is the leader. This blocks until the coordinator is
+        closed.
+        :param watchdog:
+        """
+        try:
+            asyncio.run(self.run_watchdog(watchdog))
+        except KeyboardInterrupt:
+            pass
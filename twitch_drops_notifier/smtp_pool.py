@@ -0,0 +1,139 @@
+import logging
+import queue
+import smtplib
+import threading
+from typing import Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class _Connection:
+    """
+    A single SMTP session that is opened lazily and reopened after it has sent a certain number of messages.
+    """
+
+    def __init__(self, pool: 'SMTPConnectionPool'):
+        self._pool = pool
+        self._smtp = None
+        self._message_count = 0
+
+    def _connect(self):
+        pool = self._pool
+        self._smtp = smtplib.SMTP(pool.host, pool.port, timeout=pool.timeout_seconds)
+        if pool.starttls:
+            self._smtp.starttls()
+        if pool.user is not None:
+            self._smtp.login(pool.user, pool.password)
+        self._message_count = 0
+        pool._on_connect()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+    def send(self, message):
+        if self._smtp is not None and self._message_count >= self._pool.max_messages_per_connection:
+            self.close()
+        if self._smtp is None:
+            self._connect()
+        self._smtp.send_message(message)
+        self._message_count += 1
+
+
+def _is_connection_error(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+
+    # 421 means the server is closing the connection
+    if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421:
+        return True
+
+    # SMTPException is a subclass of OSError, but other SMTP errors, like refused recipients, leave the session usable
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+
+class SMTPConnectionPool:
+    """
+    A pool of persistent SMTP connections. Each connection sends many messages before it is closed, so that the
+    cost of connecting, STARTTLS and logging in is only paid once per connection instead of once per message.
+    """
+
+    def __init__(self, host: str, port: int, user: Optional[str] = None, password: Optional[str] = None, size: int = 4,
+                 max_messages_per_connection: int = 100, starttls: bool = True, timeout_seconds: float = 60):
+        """
+        Creates a new SMTPConnectionPool.
+        :param host:
+        :param port:
+        :param user: The user to log in as. If this is None, the connections are not authenticated.
+        :param password:
+        :param size: The maximum number of connections to open at the same time.
+        :param max_messages_per_connection: The number of messages to send over a connection before reconnecting.
+        Mail providers limit how many messages can be sent in a single session.
+        :param starttls:
+        :param timeout_seconds:
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.starttls = starttls
+        self.timeout_seconds = timeout_seconds
+
+        # Connections that are not currently sending a message. A connection must be taken from here before it is used.
+        self._idle_connections = queue.LifoQueue()
+        for _ in range(size):
+            self._idle_connections.put(_Connection(self))
+
+        self._lock = threading.Lock()
+        self.connect_count = 0
+        self.sent_count = 0
+
+    def _on_connect(self):
+        with self._lock:
+            self.connect_count += 1
+
+    def send(self, message):
+        """
+        Send a message using the next available connection. This blocks until a connection is available. If the
+        connection was closed by the server, it is reopened and the message is sent again.
+        :param message:
+        """
+        connection = self._idle_connections.get()
+        try:
+            try:
+                connection.send(message)
+            except Exception as e:
+                if not _is_connection_error(e):
+                    raise
+                logger.debug(f'SMTP connection lost, reconnecting: {e}')
+                connection.close()
+                connection.send(message)
+            with self._lock:
+                self.sent_count += 1
+        except Exception:
+            connection.close()
+            raise
+        finally:
+            self._idle_connections.put(connection)
+
+    def close(self):
+        """
+        Close every idle connection. Closed connections are reopened the next time they are used.
+        """
+        connections = []
+        while True:
+            try:
+                connections.append(self._idle_connections.get_nowait())
+            except queue.Empty:
+                break
+        for connection in connections:
+            connection.close()
+            self._idle_connections.put(connection)
@@ -0,0 +1,126 @@
+import copy
+import hashlib
+import json
+import time
+from typing import Optional
+
+
+def get_content_hash(data) -> str:
+    """
+    Get a stable hash of a JSON-like object. Dictionaries with the same items produce the same hash regardless of the
+    order of their keys.
+    :param data:
+    :return:
+    """
+    normalized = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class StateCache:
+    """
+    Keeps the last known state of the campaigns and games in the database in memory, so that the watchdog doesn't
+    need to read the database or request details for campaigns that haven't changed since the last poll.
+    """
+
+    def __init__(self, full_refresh_interval_seconds: Optional[float] = 60 * 60 * 6):
+        """
+        Creates a new StateCache.
+        :param full_refresh_interval_seconds: The number of seconds after which the cache is considered stale and
+        must be reloaded from the database. If this is None, the cache never goes stale.
+        """
+        self._full_refresh_interval_seconds = full_refresh_interval_seconds
+
+        # Map document IDs to the data in the database
+        self.campaigns = {}
+        self.games = {}
+
+        # Map campaign IDs to the hash of the dashboard campaign that their details were last fetched for
+        self._dashboard_hashes = {}
+
+        self._last_refresh_time = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def is_stale(self) -> bool:
+        if self._last_refresh_time is None:
+            return True
+        if self._full_refresh_interval_seconds is None:
+            return False
+        return time.monotonic() - self._last_refresh_time >= self._full_refresh_interval_seconds
+
+    def warm(self, campaigns, games):
+        """
+        Replace the contents of the cache with the current state of the database.
+        :param campaigns: A dictionary mapping campaign IDs to campaign data.
+        :param games: A dictionary mapping game IDs to game data.
+        """
+        self.campaigns = campaigns
+        self.games = games
+        self._dashboard_hashes.clear()
+        self._last_refresh_time = time.monotonic()
+
+    def invalidate(self):
+        """
+        Mark the cache as stale, so that it is reloaded from the database before the next poll. This must be done
+        when something else may have written to the database, like another instance.
+        """
+        self._last_refresh_time = None
+
+    def get_state(self) -> dict:
+        """
+        Get a copy of the cache that can be saved and passed to load_state() after a restart.
+        :return:
+        """
+        refreshed_at = None
+        if self._last_refresh_time is not None:
+            refreshed_at = time.time() - (time.monotonic() - self._last_refresh_time)
+        return {
+            'campaigns': copy.deepcopy(self.campaigns),
+            'games': copy.deepcopy(self.games),
+            'dashboard_hashes': dict(self._dashboard_hashes),
+            'refreshed_at': refreshed_at
+        }
+
+    def load_state(self, state: dict):
+        """
+        Restore the cache from a state returned by get_state(). The cache goes stale at the same time it would have
+        without the restart.
+        :param state:
+        """
+        self.campaigns = state['campaigns']
+        self.games = state['games']
+        self._dashboard_hashes = dict(state['dashboard_hashes'])
+        self._last_refresh_time = None
+        if state['refreshed_at'] is not None:
+            self._last_refresh_time = time.monotonic() - max(0.0, time.time() - state['refreshed_at'])
+
+    def is_campaign_unchanged(self, campaign) -> bool:
+        """
+        Check if a campaign from the drops dashboard is the same as the last time its details were fetched.
+        :param campaign:
+        :return:
+        """
+        if campaign['id'] in self.campaigns and self._dashboard_hashes.get(campaign['id']) == get_content_hash(campaign):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def set_campaign_fetched(self, campaign):
+        """
+        Remember that the details of a campaign from the drops dashboard have been fetched and stored.
+        :param campaign:
+        """
+        self._dashboard_hashes[campaign['id']] = get_content_hash(campaign)
+
+    def remove_campaign(self, campaign_id):
+        self.campaigns.pop(campaign_id, None)
+        self._dashboard_hashes.pop(campaign_id, None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
@@ -0,0 +1,28 @@
+from typing import Optional
+
+from .base import Change, Storage, Subscription, Write
+from .memory_storage import MemoryStorage
+from .sqlite_storage import SQLiteStorage
+
+__all__ = ['BACKENDS', 'Change', 'MemoryStorage', 'SQLiteStorage', 'Storage', 'Subscription', 'Write', 'create_storage']
+
+BACKENDS = ('firestore', 'sqlite', 'memory')
+
+
+def create_storage(backend: str, path: Optional[str] = None) -> Storage:
+    """
+    Create a storage backend.
+    :param backend: One of 'firestore', 'sqlite', or 'memory'.
+    :param path: The path of the database file when using the 'sqlite' backend.
+    :return:
+    """
+    if backend == 'firestore':
+        # Only import Firestore when it is used, so that the other backends work without it
+        from .firestore_storage import FirestoreStorage
+        from google.cloud import firestore
+        return FirestoreStorage(firestore.Client())
+    elif backend == 'sqlite':
+        return SQLiteStorage(path or 'twitch_drops_notifier.sqlite3')
+    elif backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'Unknown storage backend: {backend}')
@@ -0,0 +1,319 @@
+import abc
+import collections
+import copy
+import datetime
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from ..utils import get_timestamp
+
+# A change to a document. `type` is one of 'ADDED', 'MODIFIED', or 'REMOVED'.
+Change = collections.namedtuple('Change', ['type', 'id', 'data', 'update_time'])
+
+# A write to a document. `operation` is one of 'set', 'update', or 'delete'. 'update' only replaces the given fields.
+Write = Tuple[str, str, str, Optional[dict]]
+
+COLLECTIONS = ('campaigns', 'games', 'users')
+
+# How long removed users are remembered for. Changes to users can only be caught up on for this long.
+USER_TOMBSTONE_RETENTION = datetime.timedelta(days=30)
+
+
+def touch_user(user: dict) -> dict:
+    """
+    Get a copy of a user with its 'updated' field set to the current time, so that it is found by get_user_changes().
+    :param user:
+    :return:
+    """
+    return dict(user, updated=get_timestamp())
+
+
+def create_user_tombstone(user: dict) -> dict:
+    """
+    Create the record that is kept for a while after a user is removed, so that get_user_changes() can report it.
+    :param user:
+    :return:
+    """
+    return {'email': user['email'], 'id': user['id'], 'removed': get_timestamp()}
+
+
+def get_timestamp_bound(value: datetime.datetime) -> str:
+    """
+    Format a time like the 'updated' and 'removed' fields of users and tombstones, so that they can be compared as
+    strings.
+    :param value:
+    :return:
+    """
+    return value.astimezone(datetime.timezone.utc).replace(microsecond=0).isoformat()
+
+
+def get_user_tombstone_bound() -> str:
+    """
+    Get the timestamp before which user tombstones can be removed.
+    :return:
+    """
+    return get_timestamp_bound(datetime.datetime.now(datetime.timezone.utc) - USER_TOMBSTONE_RETENTION)
+
+
+def create_event_id() -> str:
+    """
+    Create a unique event ID. Event IDs sort in the order that the events were created.
+    :return:
+    """
+    return f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
+
+
+def get_event_id_bound(value: datetime.datetime) -> str:
+    """
+    Get a string that sorts after the IDs of the events created before a certain time, and before the IDs of the events
+    created at or after it.
+    :param value:
+    :return:
+    """
+    return f'{int(value.timestamp() * 1e9):020d}'
+
+
+def get_lease(lease: Optional[dict], name: str, owner: str, ttl_seconds: float, data: Optional[dict], now: float) -> Optional[dict]:
+    """
+    Get the new state of a lease after trying to acquire it. This is shared by the storage backends.
+    :param lease: The current state of the lease, or None if it doesn't exist.
+    :return: The new state of the lease, or None if it can't be acquired.
+    """
+    if lease is not None and lease['owner'] != owner and lease['expires_at'] > now:
+        return None
+    return dict(lease or {}, **(data or {}), name=name, owner=owner, expires_at=now + ttl_seconds)
+
+
+class Subscription:
+    """
+    Returned by Storage.watch(). Call unsubscribe() to stop receiving changes.
+    """
+
+    def __init__(self, unsubscribe: Callable[[], None]):
+        self._unsubscribe = unsubscribe
+
+    def unsubscribe(self):
+        self._unsubscribe()
+
+
+class Storage(abc.ABC):
+    """
+    Stores campaigns, games, and users. Campaigns and games are keyed by their 'id' field, and users are keyed by
+    their 'email' field but can also be found by their 'id' field.
+    """
+
+    def __init__(self):
+        # Map collection names to the callbacks watching them
+        self._watchers = collections.defaultdict(list)
+        self._watchers_lock = threading.RLock()
+
+        # The number of operations that were sent to the underlying database
+        self._operation_count_lock = threading.Lock()
+        self.operation_count = 0
+
+    def _count_operations(self, count: int = 1):
+        with self._operation_count_lock:
+            self.operation_count += count
+
+    @abc.abstractmethod
+    def get_campaigns(self) -> Dict[str, dict]:
+        """
+        Get every campaign.
+        :return: A dictionary mapping campaign IDs to campaigns.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_games(self) -> Dict[str, dict]:
+        """
+        Get every game.
+        :return: A dictionary mapping game IDs to games.
+        """
+        pass
+
+    @abc.abstractmethod
+    def write(self, writes: List[Write]):
+        """
+        Write to the 'campaigns' and 'games' collections.
+        :param writes: A list of (operation, collection name, document ID, data) tuples. `operation` is one of 'set',
+        'update', or 'delete'. 'update' only replaces the given fields of an existing document.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_users(self) -> Iterable[dict]:
+        pass
+
+    @abc.abstractmethod
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        """
+        Find a user by their 'id' field.
+        :param user_id:
+        :return: The user, or None if there is no user with this ID.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_user_changes(self, since: datetime.datetime) -> List[Change]:
+        """
+        Get the users that were added, updated, or removed since a certain time. Users that were added or updated are
+        reported as 'ADDED' changes, since they can't be told apart. Removed users are reported as 'REMOVED' changes
+        whose data is the user's tombstone. Removals are only remembered for USER_TOMBSTONE_RETENTION.
+        :param since:
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def add_user(self, user: dict) -> bool:
+        """
+        Add a user.
+        :param user:
+        :return: True if the user was added, or False if a user with the same email already exists.
+        """
+        pass
+
+    @abc.abstractmethod
+    def update_user(self, user_id: str, update: Callable[[dict], dict]) -> bool:
+        """
+        Atomically update a user.
+        :param user_id:
+        :param update: A function that takes the current user and returns the updated user. It may be called more
+        than once, so it should not have side effects.
+        :return: True if the user was updated, or False if there is no user with this ID.
+        """
+        pass
+
+    @abc.abstractmethod
+    def remove_user(self, user_id: str) -> bool:
+        """
+        Remove a user.
+        :param user_id:
+        :return: True if the user was removed, or False if there is no user with this ID.
+        """
+        pass
+
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, owner: str, ttl_seconds: float, data: Optional[dict] = None) -> Optional[dict]:
+        """
+        Atomically acquire or renew a lease. A lease can be acquired if it doesn't exist, has expired, or is already
+        owned by `owner`.
+        :param name:
+        :param owner: A unique ID of the process acquiring the lease.
+        :param ttl_seconds: The number of seconds until the lease expires unless it is renewed.
+        :param data: Extra fields to store in the lease. Fields that are not given keep their previous values, even if
+        the lease changes owners.
+        :return: The lease if it was acquired, or None if it is owned by someone else. The lease contains 'owner',
+        'expires_at' (a UNIX timestamp), and any extra fields.
+        """
+        pass
+
+    @abc.abstractmethod
+    def release_lease(self, name: str, owner: str):
+        """
+        Release a lease so that someone else can acquire it immediately. Nothing happens if `owner` doesn't own it.
+        :param name:
+        :param owner:
+        """
+        pass
+
+    @abc.abstractmethod
+    def remove_lease(self, name: str, owner: Optional[str] = None):
+        """
+        Delete a lease, for leases that are not needed anymore.
+        :param name:
+        :param owner: If this is given, the lease is only deleted if `owner` owns it. Otherwise, it is only deleted if it
+        has expired, so that a lease that was renewed in the meantime is kept.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_leases(self) -> Dict[str, dict]:
+        """
+        Get every lease, including expired ones.
+        :return: A dictionary mapping lease names to leases.
+        """
+        pass
+
+    @abc.abstractmethod
+    def add_event(self, event: dict) -> str:
+        """
+        Add an event for other processes to consume.
+        :param event:
+        :return: The ID of the event.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_events(self, after_id: Optional[str] = None, limit: int = 100) -> List[Tuple[str, dict]]:
+        """
+        Get events in the order they were added.
+        :param after_id: Only get events that were added after the event with this ID.
+        :param limit: The maximum number of events to get.
+        :return: A list of (event ID, event) tuples.
+        """
+        pass
+
+    @abc.abstractmethod
+    def remove_events(self, before: datetime.datetime):
+        """
+        Remove events that were added before a certain time.
+        :param before:
+        """
+        pass
+
+    def watch(self, collection_name: str, callback: Callable[[List[Change]], None], since: Optional[datetime.datetime] = None) -> Subscription:
+        """
+        Call a function whenever documents in a collection change. The function is first called with an 'ADDED'
+        change for every existing document.
+        :param collection_name: One of 'campaigns', 'games', or 'users'.
+        :param callback: A function that takes a list of changes. It may be called from another thread.
+        :param since: Only supported for 'users'. If this is given, the function is first called with the changes
+        returned by get_user_changes() instead of every existing document, for callers that already know the state of
+        the users at that time.
+        :return:
+        """
+        if since is not None and collection_name != 'users':
+            raise ValueError(f'Can not watch changes since a time for collection: {collection_name}')
+        with self._watchers_lock:
+            self._watchers[collection_name].append(callback)
+            if since is None:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                initial_changes = [Change('ADDED', document_id, data, now) for document_id, data in self._get_documents(collection_name).items()]
+            else:
+                initial_changes = self.get_user_changes(since)
+            if len(initial_changes) > 0:
+                callback(initial_changes)
+
+        def unsubscribe():
+            with self._watchers_lock:
+                if callback in self._watchers[collection_name]:
+                    self._watchers[collection_name].remove(callback)
+
+        return Subscription(unsubscribe)
+
+    def _get_documents(self, collection_name: str) -> Dict[str, dict]:
+        if collection_name == 'campaigns':
+            return self.get_campaigns()
+        elif collection_name == 'games':
+            return self.get_games()
+        elif collection_name == 'users':
+            return {user['email']: user for user in self.get_users()}
+        raise ValueError(f'Unknown collection: {collection_name}')
+
+    def _notify(self, collection_name: str, changes: List[Change]):
+        """
+        Call the watchers of a collection. Backends that don't get change notifications from their database call this
+        after every write.
+        """
+        if len(changes) == 0:
+            return
+        with self._watchers_lock:
+            callbacks = list(self._watchers[collection_name])
+        for callback in callbacks:
+            callback([Change(x.type, x.id, copy.deepcopy(x.data), x.update_time) for x in changes])
+
+    def close(self):
+        pass
@@ -0,0 +1,241 @@
+import datetime
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from google.cloud import firestore
+
+from .base import (Change, Storage, Subscription, Write, create_event_id, create_user_tombstone, get_event_id_bound, get_lease,
+                   get_timestamp_bound, get_user_tombstone_bound, touch_user)
+
+# The maximum number of operations allowed in a single Firestore write batch
+MAX_BATCH_SIZE = 500
+
+
+class FirestoreStorage(Storage):
+    """
+    Stores everything in Firestore. Users can be found by ID using the 'user_ids' collection, which maps user IDs to
+    emails.
+    """
+
+    def __init__(self, client: firestore.Client):
+        super().__init__()
+        self._client = client
+
+    def _stream(self, collection_name: str) -> Dict[str, dict]:
+        self._count_operations()
+        return {x.id: x.to_dict() for x in self._client.collection(collection_name).stream()}
+
+    def get_campaigns(self) -> Dict[str, dict]:
+        return self._stream('campaigns')
+
+    def get_games(self) -> Dict[str, dict]:
+        return self._stream('games')
+
+    def write(self, writes: List[Write]):
+        for i in range(0, len(writes), MAX_BATCH_SIZE):
+            batch = self._client.batch()
+            for operation, collection_name, document_id, data in writes[i:i + MAX_BATCH_SIZE]:
+                document_reference = self._client.collection(collection_name).document(document_id)
+                if operation == 'set':
+                    batch.set(document_reference, data)
+                elif operation == 'update':
+                    batch.update(document_reference, data)
+                elif operation == 'delete':
+                    batch.delete(document_reference)
+                else:
+                    raise ValueError(f'Unknown operation: {operation}')
+            batch.commit()
+            self._count_operations()
+
+    def get_users(self) -> Iterable[dict]:
+        return self._stream('users').values()
+
+    def _get_user_reference(self, user_id: str, transaction=None):
+        snapshot = self._client.collection('user_ids').document(user_id).get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        return self._client.collection('users').document(snapshot.get('email'))
+
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        self._count_operations()
+        user_reference = self._get_user_reference(user_id)
+        if user_reference is None:
+            return None
+        snapshot = user_reference.get()
+        if not snapshot.exists:
+            return None
+        return snapshot.to_dict()
+
+    def get_user_changes(self, since: datetime.datetime) -> List[Change]:
+        self._count_operations(2)
+        bound = get_timestamp_bound(since)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        changes = [Change('ADDED', x.id, x.to_dict(), x.update_time) for x in self._client.collection('users').where('updated', '>=', bound).stream()]
+        changes += [Change('REMOVED', x.id, x.to_dict(), now) for x in self._client.collection('user_tombstones').where('removed', '>=', bound).stream()]
+        return changes
+
+    def add_user(self, user: dict) -> bool:
+        @firestore.transactional
+        def add(transaction):
+            user_reference = self._client.collection('users').document(user['email'])
+
+            # Make sure this user is not already subscribed
+            if user_reference.get(transaction=transaction).exists:
+                return False
+
+            transaction.set(user_reference, touch_user(user))
+            transaction.set(self._client.collection('user_ids').document(user['id']), {'email': user['email']})
+            transaction.delete(self._client.collection('user_tombstones').document(user['email']))
+            return True
+
+        self._count_operations()
+        return add(self._client.transaction())
+
+    def update_user(self, user_id: str, update: Callable[[dict], dict]) -> bool:
+        @firestore.transactional
+        def update_in_transaction(transaction):
+            user_reference = self._get_user_reference(user_id, transaction)
+            if user_reference is None:
+                return False
+            snapshot = user_reference.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            user = touch_user(update(snapshot.to_dict()))
+            transaction.set(user_reference, user)
+            transaction.set(self._client.collection('user_ids').document(user_id), {'email': user['email']})
+            return True
+
+        self._count_operations()
+        return update_in_transaction(self._client.transaction())
+
+    def remove_user(self, user_id: str) -> bool:
+        @firestore.transactional
+        def remove(transaction):
+            user_reference = self._get_user_reference(user_id, transaction)
+            if user_reference is None:
+                return False
+            snapshot = user_reference.get(transaction=transaction)
+            transaction.delete(user_reference)
+            transaction.delete(self._client.collection('user_ids').document(user_id))
+            if snapshot.exists:
+                transaction.set(self._client.collection('user_tombstones').document(snapshot.id), create_user_tombstone(snapshot.to_dict()))
+            return True
+
+        self._count_operations()
+        if not remove(self._client.transaction()):
+            return False
+
+        # Forget users that were removed a long time ago
+        self._count_operations()
+        query = self._client.collection('user_tombstones').where('removed', '<', get_user_tombstone_bound())
+        self.write([('delete', 'user_tombstones', x.id, None) for x in query.stream()])
+        return True
+
+    def acquire_lease(self, name: str, owner: str, ttl_seconds: float, data: Optional[dict] = None) -> Optional[dict]:
+        @firestore.transactional
+        def acquire(transaction):
+            lease_reference = self._client.collection('leases').document(name)
+            snapshot = lease_reference.get(transaction=transaction)
+            lease = get_lease(snapshot.to_dict() if snapshot.exists else None, name, owner, ttl_seconds, data, time.time())
+            if lease is not None:
+                transaction.set(lease_reference, lease)
+            return lease
+
+        self._count_operations()
+        return acquire(self._client.transaction())
+
+    def release_lease(self, name: str, owner: str):
+        @firestore.transactional
+        def release(transaction):
+            lease_reference = self._client.collection('leases').document(name)
+            snapshot = lease_reference.get(transaction=transaction)
+            if snapshot.exists and snapshot.get('owner') == owner:
+                transaction.update(lease_reference, {'expires_at': 0})
+
+        self._count_operations()
+        release(self._client.transaction())
+
+    def remove_lease(self, name: str, owner: Optional[str] = None):
+        @firestore.transactional
+        def remove(transaction):
+            lease_reference = self._client.collection('leases').document(name)
+            snapshot = lease_reference.get(transaction=transaction)
+            if not snapshot.exists:
+                return
+            if snapshot.get('owner') == owner if owner is not None else snapshot.get('expires_at') <= time.time():
+                transaction.delete(lease_reference)
+
+        self._count_operations()
+        remove(self._client.transaction())
+
+    def get_leases(self) -> Dict[str, dict]:
+        return self._stream('leases')
+
+    def add_event(self, event: dict) -> str:
+        self._count_operations()
+        event_id = create_event_id()
+        self._client.collection('events').document(event_id).set(dict(event, event_id=event_id))
+        return event_id
+
+    def get_events(self, after_id: Optional[str] = None, limit: int = 100) -> List[Tuple[str, dict]]:
+        self._count_operations()
+        query = self._client.collection('events').where('event_id', '>', after_id or '').order_by('event_id').limit(limit)
+        events = []
+        for snapshot in query.stream():
+            event = snapshot.to_dict()
+            events.append((event.pop('event_id'), event))
+        return events
+
+    def remove_events(self, before: datetime.datetime):
+        self._count_operations()
+        query = self._client.collection('events').where('event_id', '<', get_event_id_bound(before))
+        self.write([('delete', 'events', x.id, None) for x in query.stream()])
+
+    def watch(self, collection_name: str, callback: Callable[[List[Change]], None], since: Optional[datetime.datetime] = None) -> Subscription:
+        def on_snapshot(documents, changes, read_time):
+            callback([Change(x.type.name, x.document.id, x.document.to_dict(), x.document.update_time) for x in changes])
+
+        if since is None:
+            watch = self._client.collection(collection_name).on_snapshot(on_snapshot)
+            return Subscription(watch.unsubscribe)
+        if collection_name != 'users':
+            raise ValueError(f'Can not watch changes since a time for collection: {collection_name}')
+
+        # Only users that changed since then are read. Users that were removed are found through their tombstones,
+        # since they are no longer matched by the query.
+        def on_tombstones_snapshot(documents, changes, read_time):
+            removed = [Change('REMOVED', x.document.id, x.document.to_dict(), x.document.update_time) for x in changes if x.type.name != 'REMOVED']
+            if len(removed) > 0:
+                callback(removed)
+
+        # Firestore reports users that start matching the query as added, including users that existed before and were
+        # only changed after the first snapshot. Report those as modified, like the other backends do.
+        start_time = datetime.datetime.now(datetime.timezone.utc)
+        is_initial_snapshot = True
+
+        def on_users_snapshot(documents, changes, read_time):
+            nonlocal is_initial_snapshot
+            user_changes = []
+            for x in changes:
+                data = x.document.to_dict()
+                change_type = x.type.name
+                if change_type == 'ADDED' and not is_initial_snapshot and datetime.datetime.fromisoformat(data['created']) < start_time:
+                    change_type = 'MODIFIED'
+                user_changes.append(Change(change_type, x.document.id, data, x.document.update_time))
+            is_initial_snapshot = False
+            callback(user_changes)
+
+        bound = get_timestamp_bound(since)
+        watches = [
+            self._client.collection('users').where('updated', '>=', bound).on_snapshot(on_users_snapshot),
+            self._client.collection('user_tombstones').where('removed', '>=', bound).on_snapshot(on_tombstones_snapshot)
+        ]
+
+        def unsubscribe():
+            for watch in watches:
+                watch.unsubscribe()
+
+        return Subscription(unsubscribe)
+
+    def close(self):
+        self._client.close()
@@ -0,0 +1,174 @@
+import copy
+import datetime
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .base import (Change, Storage, Write, create_event_id, create_user_tombstone, get_event_id_bound, get_lease, get_timestamp_bound,
+                   get_user_tombstone_bound, touch_user)
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps everything in memory. This is useful for testing and profiling without a database.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._collections = {'campaigns': {}, 'games': {}, 'users': {}}
+
+        # Map user IDs to emails
+        self._user_ids = {}
+
+        # Map emails to the tombstones of removed users
+        self._user_tombstones = {}
+
+        self._leases = {}
+        self._events = {}
+
+    def get_campaigns(self) -> Dict[str, dict]:
+        self._count_operations()
+        with self._lock:
+            return copy.deepcopy(self._collections['campaigns'])
+
+    def get_games(self) -> Dict[str, dict]:
+        self._count_operations()
+        with self._lock:
+            return copy.deepcopy(self._collections['games'])
+
+    def write(self, writes: List[Write]):
+        if len(writes) == 0:
+            return
+        self._count_operations()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        changes = {'campaigns': [], 'games': []}
+        with self._lock:
+            for operation, collection_name, document_id, data in writes:
+                collection = self._collections[collection_name]
+                if operation == 'set':
+                    change_type = 'MODIFIED' if document_id in collection else 'ADDED'
+                    collection[document_id] = copy.deepcopy(data)
+                elif operation == 'update':
+                    change_type = 'MODIFIED'
+                    collection[document_id].update(copy.deepcopy(data))
+                elif operation == 'delete':
+                    removed = collection.pop(document_id, None)
+                    if removed is not None:
+                        changes[collection_name].append(Change('REMOVED', document_id, removed, now))
+                    continue
+                else:
+                    raise ValueError(f'Unknown operation: {operation}')
+                changes[collection_name].append(Change(change_type, document_id, copy.deepcopy(collection[document_id]), now))
+        for collection_name, x in changes.items():
+            self._notify(collection_name, x)
+
+    def get_users(self) -> Iterable[dict]:
+        self._count_operations()
+        with self._lock:
+            return copy.deepcopy(list(self._collections['users'].values()))
+
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        self._count_operations()
+        with self._lock:
+            email = self._user_ids.get(user_id)
+            if email is None:
+                return None
+            return copy.deepcopy(self._collections['users'][email])
+
+    def get_user_changes(self, since: datetime.datetime) -> List[Change]:
+        self._count_operations()
+        bound = get_timestamp_bound(since)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            changes = [Change('ADDED', email, copy.deepcopy(user), now) for email, user in self._collections['users'].items() if user.get('updated', '') >= bound]
+            changes += [Change('REMOVED', email, dict(x), now) for email, x in self._user_tombstones.items() if x['removed'] >= bound]
+        return changes
+
+    def add_user(self, user: dict) -> bool:
+        self._count_operations()
+        user = touch_user(user)
+        with self._lock:
+            users = self._collections['users']
+            if user['email'] in users:
+                return False
+            users[user['email']] = copy.deepcopy(user)
+            self._user_ids[user['id']] = user['email']
+            self._user_tombstones.pop(user['email'], None)
+        self._notify('users', [Change('ADDED', user['email'], user, datetime.datetime.now(datetime.timezone.utc))])
+        return True
+
+    def update_user(self, user_id: str, update: Callable[[dict], dict]) -> bool:
+        self._count_operations()
+        with self._lock:
+            email = self._user_ids.get(user_id)
+            if email is None:
+                return False
+            user = touch_user(update(copy.deepcopy(self._collections['users'][email])))
+            self._collections['users'][email] = copy.deepcopy(user)
+        self._notify('users', [Change('MODIFIED', email, user, datetime.datetime.now(datetime.timezone.utc))])
+        return True
+
+    def remove_user(self, user_id: str) -> bool:
+        self._count_operations()
+        with self._lock:
+            email = self._user_ids.pop(user_id, None)
+            if email is None:
+                return False
+            user = self._collections['users'].pop(email)
+            self._user_tombstones[email] = create_user_tombstone(user)
+
+            # Forget users that were removed a long time ago
+            bound = get_user_tombstone_bound()
+            for x in [x for x, tombstone in self._user_tombstones.items() if tombstone['removed'] < bound]:
+                del self._user_tombstones[x]
+        self._notify('users', [Change('REMOVED', email, user, datetime.datetime.now(datetime.timezone.utc))])
+        return True
+
+    def acquire_lease(self, name: str, owner: str, ttl_seconds: float, data: Optional[dict] = None) -> Optional[dict]:
+        self._count_operations()
+        with self._lock:
+            lease = get_lease(self._leases.get(name), name, owner, ttl_seconds, data, time.time())
+            if lease is None:
+                return None
+            self._leases[name] = lease
+            return copy.deepcopy(lease)
+
+    def release_lease(self, name: str, owner: str):
+        self._count_operations()
+        with self._lock:
+            lease = self._leases.get(name)
+            if lease is not None and lease['owner'] == owner:
+                lease['expires_at'] = 0
+
+    def remove_lease(self, name: str, owner: Optional[str] = None):
+        self._count_operations()
+        with self._lock:
+            lease = self._leases.get(name)
+            if lease is not None and (lease['owner'] == owner if owner is not None else lease['expires_at'] <= time.time()):
+                del self._leases[name]
+
+    def get_leases(self) -> Dict[str, dict]:
+        self._count_operations()
+        with self._lock:
+            return copy.deepcopy(self._leases)
+
+    def add_event(self, event: dict) -> str:
+        self._count_operations()
+        event_id = create_event_id()
+        with self._lock:
+            self._events[event_id] = copy.deepcopy(event)
+        return event_id
+
+    def get_events(self, after_id: Optional[str] = None, limit: int = 100) -> List[Tuple[str, dict]]:
+        self._count_operations()
+        with self._lock:
+            event_ids = sorted(x for x in self._events if after_id is None or x > after_id)[:limit]
+            return [(event_id, copy.deepcopy(self._events[event_id])) for event_id in event_ids]
+
+    def remove_events(self, before: datetime.datetime):
+        self._count_operations()
+        bound = get_event_id_bound(before)
+        with self._lock:
+            for event_id in [x for x in self._events if x < bound]:
+                del self._events[event_id]
@@ -0,0 +1,396 @@
+import datetime
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .base import (Change, Storage, Subscription, Write, create_event_id, create_user_tombstone, get_event_id_bound, get_lease,
+                   get_timestamp_bound, get_user_tombstone_bound, touch_user)
+from ..utils import dumps_json, get_datetime, loads_json
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Changes are read again for this long, in case a change with an older 'updated' field was committed after a poll
+USER_POLL_MARGIN = datetime.timedelta(seconds=5)
+
+# Marks users that were reported as removed
+_REMOVED = 'REMOVED'
+
+
+def _get_digest(document: dict) -> str:
+    return hashlib.sha1(dumps_json(document).encode('utf-8')).hexdigest()
+
+
+class _PollingWatch:
+    """
+    Watches a table by polling it on a thread, so that changes written by other processes using the same database file,
+    like the web app, are seen.
+    """
+
+    def __init__(self, callback: Callable[[List[Change]], None], interval_seconds: float, name: str):
+        self._callback = callback
+        self._interval_seconds = interval_seconds
+        self._name = name
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _poll(self) -> List[Change]:
+        """
+        Get the changes since the last poll.
+        """
+        raise NotImplementedError()
+
+    def _start(self, initial_changes: List[Change]) -> Subscription:
+        if len(initial_changes) > 0:
+            self._callback(initial_changes)
+        self._thread = threading.Thread(target=self._run, name=f'sqlite-{self._name}-watch', daemon=True)
+        self._thread.start()
+        return Subscription(self._stop)
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval_seconds):
+            try:
+                changes = self._poll()
+                if len(changes) > 0:
+                    self._callback(changes)
+            except Exception as e:
+                logger.error(f'Failed to poll for {self._name} changes!', exc_info=e)
+
+    def _stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class _UserWatch(_PollingWatch):
+    """
+    Watches the users table with get_user_changes().
+    """
+
+    def __init__(self, storage: 'SQLiteStorage', callback: Callable[[List[Change]], None], interval_seconds: float):
+        super().__init__(callback, interval_seconds, 'users')
+        self._storage = storage
+        self._start_time = datetime.datetime.now(datetime.timezone.utc)
+        self._last_poll_time = self._start_time
+
+        # Map emails to a digest of the last version of the user that was reported, or to _REMOVED
+        self._versions = {}
+
+    def _get_new_changes(self, changes: List[Change]) -> List[Change]:
+        """
+        Drop the changes that were already reported, and tell added users apart from updated ones.
+        """
+        new_changes = []
+        for change in changes:
+            previous = self._versions.get(change.id)
+            if change.type == 'REMOVED':
+                if previous == _REMOVED:
+                    continue
+                self._versions[change.id] = _REMOVED
+                new_changes.append(change)
+                continue
+            digest = _get_digest(change.data)
+            if previous == digest:
+                continue
+            self._versions[change.id] = digest
+
+            # Users that existed before the watch started were changed, unless they were removed since then
+            if previous is None:
+                is_modified = datetime.datetime.fromisoformat(change.data['created']) < self._start_time
+            else:
+                is_modified = previous != _REMOVED
+            new_changes.append(Change('MODIFIED' if is_modified else 'ADDED', change.id, change.data, change.update_time))
+        return new_changes
+
+    def start(self, since: Optional[datetime.datetime]) -> Subscription:
+        # Like the other backends, first report every user, or every user that changed since then, as added
+        if since is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            changes = [Change('ADDED', user['email'], user, now) for user in self._storage.get_users()]
+        else:
+            changes = self._storage.get_user_changes(since)
+        for change in changes:
+            self._versions[change.id] = _REMOVED if change.type == 'REMOVED' else _get_digest(change.data)
+        return self._start(changes)
+
+    def _poll(self) -> List[Change]:
+        poll_time = datetime.datetime.now(datetime.timezone.utc)
+        changes = self._get_new_changes(self._storage.get_user_changes(self._last_poll_time - USER_POLL_MARGIN))
+        self._last_poll_time = poll_time
+        return changes
+
+
+class _CollectionWatch(_PollingWatch):
+    """
+    Watches the campaigns or games table by comparing every document with the version reported by the last poll.
+    Campaigns and games have no field that tells when they changed, but there are few enough of them to read them all.
+    """
+
+    def __init__(self, storage: 'SQLiteStorage', collection_name: str, callback: Callable[[List[Change]], None], interval_seconds: float):
+        super().__init__(callback, interval_seconds, collection_name)
+        self._storage = storage
+        self._collection_name = collection_name
+
+        # Map document IDs to a (digest, data) tuple of the last version that was reported
+        self._documents = {}
+
+    def start(self) -> Subscription:
+        # The first poll reports every document as added
+        return self._start(self._poll())
+
+    def _poll(self) -> List[Change]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        changes = []
+        documents = {}
+        for document_id, data in self._storage._get_documents(self._collection_name).items():
+            digest = _get_digest(data)
+            previous = self._documents.get(document_id)
+            if previous is not None and previous[0] == digest:
+                documents[document_id] = previous
+                continue
+            documents[document_id] = (digest, data)
+            changes.append(Change('ADDED' if previous is None else 'MODIFIED', document_id, data, now))
+        for document_id in self._documents.keys() - documents.keys():
+            changes.append(Change('REMOVED', document_id, self._documents[document_id][1], now))
+        self._documents = documents
+        return changes
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores everything in a SQLite database. Documents are stored as JSON, with indexed columns for the fields that
+    are queried. Watched collections are polled for changes, so that several processes using the same database file,
+    like the notifier instances and the web app, see each other's writes. Leases and events can be shared by several
+    processes too.
+    """
+
+    def __init__(self, path: str = 'twitch_drops_notifier.sqlite3', poll_seconds: float = 1):
+        """
+        Creates a new SQLiteStorage.
+        :param path: The path of the database file.
+        :param poll_seconds: The number of seconds in between checks for changes to watched collections.
+        """
+        super().__init__()
+        self._poll_seconds = poll_seconds
+
+        # The connection is shared by all threads, so every access must hold the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS campaigns (id TEXT PRIMARY KEY, end_at REAL NOT NULL, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS campaigns_end_at ON campaigns (end_at);
+            CREATE TABLE IF NOT EXISTS games (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, id TEXT NOT NULL UNIQUE, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS users_updated ON users (json_extract(data, '$.updated'));
+            CREATE TABLE IF NOT EXISTS user_tombstones (email TEXT PRIMARY KEY, removed TEXT NOT NULL, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        ''')
+
+    def _get_all(self, table: str) -> Dict[str, dict]:
+        self._count_operations()
+        with self._lock:
+            rows = self._connection.execute(f'SELECT id, data FROM {table}').fetchall()
+        return {document_id: loads_json(data) for document_id, data in rows}
+
+    def get_campaigns(self) -> Dict[str, dict]:
+        return self._get_all('campaigns')
+
+    def get_games(self) -> Dict[str, dict]:
+        return self._get_all('games')
+
+    def _upsert(self, collection_name: str, document_id: str, data: dict):
+        if collection_name == 'campaigns':
+            self._connection.execute(
+                'INSERT INTO campaigns (id, end_at, data) VALUES (?, ?, ?) ON CONFLICT (id) DO UPDATE SET end_at = excluded.end_at, data = excluded.data',
+                (document_id, get_datetime(data['endAt']).timestamp(), dumps_json(data))
+            )
+        elif collection_name == 'games':
+            self._connection.execute(
+                'INSERT INTO games (id, data) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET data = excluded.data',
+                (document_id, dumps_json(data))
+            )
+        else:
+            raise ValueError(f'Unknown collection: {collection_name}')
+
+    def write(self, writes: List[Write]):
+        if len(writes) == 0:
+            return
+        self._count_operations()
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                for operation, collection_name, document_id, data in writes:
+                    row = self._connection.execute(f'SELECT data FROM {collection_name} WHERE id = ?', (document_id,)).fetchone()
+                    if operation == 'delete':
+                        if row is not None:
+                            self._connection.execute(f'DELETE FROM {collection_name} WHERE id = ?', (document_id,))
+                        continue
+                    if operation == 'update':
+                        if row is None:
+                            raise KeyError(f'Document does not exist: {collection_name}/{document_id}')
+                        data = dict(loads_json(row[0]), **data)
+                    elif operation != 'set':
+                        raise ValueError(f'Unknown operation: {operation}')
+                    self._upsert(collection_name, document_id, data)
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def get_users(self) -> Iterable[dict]:
+        self._count_operations()
+        with self._lock:
+            rows = self._connection.execute('SELECT data FROM users').fetchall()
+        return [loads_json(data) for data, in rows]
+
+    def get_user_by_id(self, user_id: str) -> Optional[dict]:
+        self._count_operations()
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM users WHERE id = ?', (user_id,)).fetchone()
+        return None if row is None else loads_json(row[0])
+
+    def get_user_changes(self, since: datetime.datetime) -> List[Change]:
+        self._count_operations()
+        bound = get_timestamp_bound(since)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            users = self._connection.execute("SELECT data FROM users WHERE json_extract(data, '$.updated') >= ?", (bound,)).fetchall()
+            tombstones = self._connection.execute('SELECT data FROM user_tombstones WHERE removed >= ?', (bound,)).fetchall()
+        changes = [Change('ADDED', user['email'], user, now) for user in (loads_json(data) for data, in users)]
+        changes += [Change('REMOVED', tombstone['email'], tombstone, now) for tombstone in (loads_json(data) for data, in tombstones)]
+        return changes
+
+    def add_user(self, user: dict) -> bool:
+        self._count_operations()
+        user = touch_user(user)
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                cursor = self._connection.execute('INSERT OR IGNORE INTO users (email, id, data) VALUES (?, ?, ?)', (user['email'], user['id'], dumps_json(user)))
+                if cursor.rowcount > 0:
+                    self._connection.execute('DELETE FROM user_tombstones WHERE email = ?', (user['email'],))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return cursor.rowcount > 0
+
+    def update_user(self, user_id: str, update: Callable[[dict], dict]) -> bool:
+        self._count_operations()
+        with self._lock:
+            # Take the write lock before reading, so that other processes, like the web app, can't change the user in
+            # between
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute('SELECT data FROM users WHERE id = ?', (user_id,)).fetchone()
+                if row is not None:
+                    user = touch_user(update(loads_json(row[0])))
+                    self._connection.execute('UPDATE users SET data = ? WHERE id = ?', (dumps_json(user), user_id))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return row is not None
+
+    def remove_user(self, user_id: str) -> bool:
+        self._count_operations()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute('SELECT data FROM users WHERE id = ?', (user_id,)).fetchone()
+                if row is None:
+                    self._connection.execute('COMMIT')
+                    return False
+                user = loads_json(row[0])
+                tombstone = create_user_tombstone(user)
+                self._connection.execute('DELETE FROM users WHERE id = ?', (user_id,))
+                self._connection.execute(
+                    'INSERT INTO user_tombstones (email, removed, data) VALUES (?, ?, ?) ON CONFLICT (email) DO UPDATE SET removed = excluded.removed, data = excluded.data',
+                    (user['email'], tombstone['removed'], dumps_json(tombstone))
+                )
+
+                # Forget users that were removed a long time ago
+                self._connection.execute('DELETE FROM user_tombstones WHERE removed < ?', (get_user_tombstone_bound(),))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return True
+
+    def watch(self, collection_name: str, callback: Callable[[List[Change]], None], since: Optional[datetime.datetime] = None) -> Subscription:
+        if collection_name == 'users':
+            return _UserWatch(self, callback, self._poll_seconds).start(since)
+        if since is not None:
+            raise ValueError(f'Can not watch changes since a time for collection: {collection_name}')
+        if collection_name not in ('campaigns', 'games'):
+            raise ValueError(f'Unknown collection: {collection_name}')
+        return _CollectionWatch(self, collection_name, callback, self._poll_seconds).start()
+
+    def acquire_lease(self, name: str, owner: str, ttl_seconds: float, data: Optional[dict] = None) -> Optional[dict]:
+        self._count_operations()
+        with self._lock:
+            # Take the write lock up front so that other processes can't acquire the lease at the same time
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute('SELECT data FROM leases WHERE name = ?', (name,)).fetchone()
+                lease = get_lease(None if row is None else loads_json(row[0]), name, owner, ttl_seconds, data, time.time())
+                if lease is not None:
+                    self._connection.execute(
+                        'INSERT INTO leases (name, data) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET data = excluded.data',
+                        (name, dumps_json(lease))
+                    )
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return lease
+
+    def release_lease(self, name: str, owner: str):
+        self._count_operations()
+        with self._lock:
+            self._connection.execute(
+                "UPDATE leases SET data = json_set(data, '$.expires_at', 0) WHERE name = ? AND json_extract(data, '$.owner') = ?",
+                (name, owner)
+            )
+
+    def remove_lease(self, name: str, owner: Optional[str] = None):
+        self._count_operations()
+        with self._lock:
+            if owner is not None:
+                self._connection.execute("DELETE FROM leases WHERE name = ? AND json_extract(data, '$.owner') = ?", (name, owner))
+            else:
+                self._connection.execute("DELETE FROM leases WHERE name = ? AND json_extract(data, '$.expires_at') <= ?", (name, time.time()))
+
+    def get_leases(self) -> Dict[str, dict]:
+        self._count_operations()
+        with self._lock:
+            rows = self._connection.execute('SELECT name, data FROM leases').fetchall()
+        return {name: loads_json(data) for name, data in rows}
+
+    def add_event(self, event: dict) -> str:
+        self._count_operations()
+        event_id = create_event_id()
+        with self._lock:
+            self._connection.execute('INSERT INTO events (id, data) VALUES (?, ?)', (event_id, dumps_json(event)))
+        return event_id
+
+    def get_events(self, after_id: Optional[str] = None, limit: int = 100) -> List[Tuple[str, dict]]:
+        self._count_operations()
+        with self._lock:
+            rows = self._connection.execute('SELECT id, data FROM events WHERE id > ? ORDER BY id LIMIT ?', (after_id or '', limit)).fetchall()
+        return [(event_id, loads_json(data)) for event_id, data in rows]
+
+    def remove_events(self, before: datetime.datetime):
+        self._count_operations()
+        with self._lock:
+            self._connection.execute('DELETE FROM events WHERE id < ?', (get_event_id_bound(before),))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,62 +1,429 @@
+import datetime
+import email.utils
 import logging
+import random
 import secrets
-from typing import Optional, List
+import threading
+import time
+from typing import Iterable, Optional, List, Tuple
 
 import requests
+import requests.adapters
 import json
 
+from . import metrics
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 
+class RequestStats:
+    """
+    Keeps track of the latency and retry counts of the requests made by a Client.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.retry_count = 0
+        self.error_count = 0
+        self.total_latency_seconds = 0.0
+        self.max_latency_seconds = 0.0
+        self.last_latency_seconds = 0.0
+
+    def record_request(self, latency_seconds: float, error: bool = False):
+        with self._lock:
+            self.request_count += 1
+            if error:
+                self.error_count += 1
+            self.total_latency_seconds += latency_seconds
+            self.max_latency_seconds = max(self.max_latency_seconds, latency_seconds)
+            self.last_latency_seconds = latency_seconds
+
+    def record_retry(self):
+        with self._lock:
+            self.retry_count += 1
+
+    @property
+    def average_latency_seconds(self) -> float:
+        if self.request_count == 0:
+            return 0.0
+        return self.total_latency_seconds / self.request_count
+
+    def __repr__(self):
+        return f'RequestStats(requests={self.request_count}, retries={self.retry_count}, errors={self.error_count}, ' \
+               f'average_latency={self.average_latency_seconds:.3f}s, max_latency={self.max_latency_seconds:.3f}s)'
+
+
+class Credential:
+    """
+    An OAuth token and the state of its rate budget. The budget is a token bucket that refills continuously, so that
+    requests are spread out instead of being sent in bursts until the server starts rejecting them.
+    """
+
+    def __init__(self, oauth_token: str, user_id: Optional[str] = None, requests_per_minute: float = 600):
+        """
+        Creates a new Credential.
+        :param oauth_token:
+        :param user_id:
+        :param requests_per_minute: The number of requests that can be sent with this token per minute.
+        """
+        self.oauth_token = oauth_token
+        self.user_id = user_id
+        self._capacity = max(1.0, requests_per_minute)
+        self._refill_per_second = requests_per_minute / 60
+
+        # The number of requests that can be sent right now
+        self.remaining = self._capacity
+        self._refill_time = time.monotonic()
+
+        # Monotonic times until which the token must not be used
+        self.cooldown_until = 0.0
+        self.quarantined_until = 0.0
+
+        # Used for smooth weighted round-robin
+        self.current_weight = 0.0
+
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.auth_error_count = 0
+
+    def refill(self, now: float):
+        self.remaining = min(self._capacity, self.remaining + (now - self._refill_time) * self._refill_per_second)
+        self._refill_time = now
+
+    def get_wait_seconds(self, now: float) -> float:
+        """
+        Get the number of seconds until this token can be used again, ignoring quarantine.
+        :param now:
+        :return:
+        """
+        refill_wait = max(0.0, (1 - self.remaining) / self._refill_per_second) if self._refill_per_second > 0 else float('inf')
+        return max(self.cooldown_until - now, refill_wait, 0.0)
+
+    def __repr__(self):
+        # Never log the whole token
+        return f'Credential({self.oauth_token[:4]}..., requests={self.request_count}, rate_limited={self.rate_limited_count}, ' \
+               f'auth_errors={self.auth_error_count}, remaining={self.remaining:.1f})'
+
+
+class CredentialPool:
+    """
+    Spreads requests across several OAuth tokens, so that they don't all share the rate budget of a single token.
+    Tokens are picked with smooth weighted round-robin, weighted by their remaining budget. Tokens that were rate
+    limited are rested until their cooldown ends, and tokens that were rejected as unauthorized are quarantined.
+    """
+
+    def __init__(self, credentials: Iterable[Credential], quarantine_seconds: float = 60 * 60):
+        """
+        Creates a new CredentialPool.
+        :param credentials:
+        :param quarantine_seconds: The number of seconds to stop using a token for after an authorization error.
+        """
+        self._credentials = list(credentials)
+        self._quarantine_seconds = quarantine_seconds
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, data, requests_per_minute: float = 600, quarantine_seconds: float = 60 * 60) -> 'CredentialPool':
+        """
+        Create a pool from the contents of a credentials file.
+        :param data: A dictionary with 'oauth_token' and 'user_id', or a list of them. Each one can also contain
+        'requests_per_minute' to override the default.
+        :param requests_per_minute:
+        :param quarantine_seconds:
+        :return:
+        """
+        if isinstance(data, dict):
+            data = [data]
+        return cls([Credential(x['oauth_token'], x.get('user_id'), x.get('requests_per_minute', requests_per_minute)) for x in data], quarantine_seconds)
+
+    @property
+    def credentials(self) -> List[Credential]:
+        return list(self._credentials)
+
+    def __len__(self):
+        return len(self._credentials)
+
+    def acquire(self) -> Tuple[Optional[Credential], float]:
+        """
+        Pick a token for the next request and take one request out of its budget.
+        :return: A (credential, wait seconds) tuple. If every token is cooling down or out of budget, the credential is
+        None and the wait is the number of seconds until one can be used.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for credential in self._credentials:
+                credential.refill(now)
+            usable = [x for x in self._credentials if x.quarantined_until <= now]
+
+            # If every token was rejected, keep trying the one that was quarantined first in case it works again
+            if len(usable) == 0:
+                credential = min(self._credentials, key=lambda x: x.quarantined_until)
+                credential.request_count += 1
+                return credential, 0.0
+
+            available = [x for x in usable if x.get_wait_seconds(now) == 0]
+            if len(available) == 0:
+                return None, min(x.get_wait_seconds(now) for x in usable)
+
+            total_weight = 0.0
+            for credential in available:
+                credential.current_weight += credential.remaining
+                total_weight += credential.remaining
+            credential = max(available, key=lambda x: x.current_weight)
+            credential.current_weight -= total_weight
+            credential.remaining -= 1
+            credential.request_count += 1
+            return credential, 0.0
+
+    def record_rate_limited(self, credential: Credential, cooldown_seconds: float):
+        with self._lock:
+            credential.rate_limited_count += 1
+            credential.remaining = 0.0
+            credential.cooldown_until = max(credential.cooldown_until, time.monotonic() + cooldown_seconds)
+        metrics.increment('twitch.rate_limited')
+
+    def record_auth_error(self, credential: Credential):
+        with self._lock:
+            credential.auth_error_count += 1
+            credential.quarantined_until = time.monotonic() + self._quarantine_seconds
+        metrics.increment('twitch.auth_errors')
+        logger.error(f'Token was rejected, not using it for {self._quarantine_seconds:.0f} seconds: {credential}')
+
+    def record_remaining(self, credential: Credential, remaining: float):
+        """
+        Correct the remaining budget of a token with the value reported by the server.
+        :param credential:
+        :param remaining:
+        """
+        with self._lock:
+            credential.remaining = remaining
+
+    def has_usable(self, exclude: Credential) -> bool:
+        """
+        Check if there is a token other than `exclude` that isn't quarantined.
+        :param exclude:
+        :return:
+        """
+        now = time.monotonic()
+        with self._lock:
+            return any(x is not exclude and x.quarantined_until <= now for x in self._credentials)
+
+    def __repr__(self):
+        return f'CredentialPool({self._credentials})'
+
+
 class Client:
 
     CLIENT_ID_TV = "ue6666qo983tsx6so1t0vnawi233wa"
     USER_AGENT_ANDROID_TV = "Mozilla/5.0 (Linux; Android 7.1; Smart Box C1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36"
 
-    def __init__(self, *, client_id: str, oath_token: Optional[str] = None, user_id: Optional[str] = None):
+    GQL_URL = 'https://gql.twitch.tv/gql'
+
+    # Responses with these status codes are considered temporary failures and are retried
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    # Responses with these status codes mean that the token was rejected
+    AUTH_ERROR_STATUS_CODES = {401, 403}
+
+    def __init__(self, *, client_id: str, oath_token: Optional[str] = None, user_id: Optional[str] = None, url: str = GQL_URL,
+                 timeout_seconds: float = 30, max_retries: int = 3, backoff_seconds: float = 1, max_backoff_seconds: float = 60,
+                 pool_size: int = 10, credentials: Optional[CredentialPool] = None):
+        """
+        Creates a new Client.
+        :param client_id:
+        :param oath_token: The OAuth token to use. This is ignored if `credentials` is given.
+        :param user_id: Defaults to the user ID of the first credential in `credentials`.
+        :param url: The URL of the GQL endpoint.
+        :param timeout_seconds: The number of seconds to wait for the server to respond before giving up on a request.
+        :param max_retries: The maximum number of times to retry a request that failed with a temporary error.
+        :param backoff_seconds: The delay before the first retry. This is doubled after every retry.
+        :param max_backoff_seconds: The maximum delay between retries. This also limits how long a Retry-After header can
+        make us wait.
+        :param pool_size: The maximum number of connections to keep open to the server.
+        :param credentials: Several OAuth tokens to spread requests across.
+        """
+        self._url = url
         self._client_id = client_id
-        self._oauth_token = oath_token
         self._device_id = secrets.token_hex(32)
         self._client_session_id = secrets.token_hex(16)
+
+        if credentials is None:
+            credentials = CredentialPool([] if oath_token is None else [Credential(oath_token, user_id)])
+        self._credentials = credentials
+        if user_id is None and len(credentials) > 0:
+            user_id = credentials.credentials[0].user_id
         self._user_id = user_id
 
-    def _post_authorized(self, data: str):
-        assert self._oauth_token is not None, "Missing OAuth token!"
+        self._timeout_seconds = timeout_seconds
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+
+        # Reuse connections between requests
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        self.stats = RequestStats()
+
+    @property
+    def credentials(self) -> CredentialPool:
+        return self._credentials
+
+    def close(self):
+        self._session.close()
+
+    def _get_retry_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """
+        Get the number of seconds to wait before retrying a failed request.
+        :param attempt: The number of attempts that have failed so far, starting at 0.
+        :param response: The failed response, if any.
+        :return:
+        """
+        delay = self._backoff_seconds * (2 ** attempt) * random.uniform(0.8, 1.2)
+
+        # Honor the server's Retry-After header
+        retry_after = None if response is None else response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                    delay = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    pass
+
+        return min(max(delay, 0.0), self._max_backoff_seconds)
+
+    def _acquire_credential(self) -> Credential:
+        """
+        Get a token to send a request with, waiting until one has budget left.
+        :return:
+        """
+        while True:
+            credential, wait_seconds = self._credentials.acquire()
+            if credential is not None:
+                return credential
+            logger.debug(f'Every token is rate limited. Waiting {wait_seconds:.1f} seconds...')
+            time.sleep(min(wait_seconds, self._max_backoff_seconds))
+
+    def _post(self, data: str, headers):
+        """
+        Post data to the GQL endpoint, retrying temporary failures with exponential backoff. Each attempt is sent with
+        the token picked by the credential pool. Requests that were rate limited or rejected are retried with another
+        token without waiting, if there is one.
+        :param data:
+        :param headers:
+        :return: The last response received.
+        """
+        attempt = 0
+        while True:
+            credential = self._acquire_credential()
+            delay = 0.0
+            start_time = time.perf_counter()
+            try:
+                response = self._session.post(self._url, headers=dict(headers, Authorization=f'OAuth {credential.oauth_token}'), data=data, timeout=self._timeout_seconds)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.stats.record_request(time.perf_counter() - start_time, error=True)
+                if attempt >= self._max_retries:
+                    raise
+                delay = self._get_retry_delay(attempt)
+                logger.warning(f'Request failed: {e}. Retrying in {delay:.1f} seconds...')
+            else:
+                self.stats.record_request(time.perf_counter() - start_time, error=not response.ok)
+
+                # Use the budget reported by the server if there is one
+                remaining = response.headers.get('Ratelimit-Remaining')
+                if remaining is not None:
+                    try:
+                        self._credentials.record_remaining(credential, float(remaining))
+                    except ValueError:
+                        pass
 
-        response = requests.post(
-            'https://gql.twitch.tv/gql',
+                if response.status_code == 429:
+                    # Rest this token, and let the pool wait if no other token is available
+                    cooldown_seconds = self._get_retry_delay(attempt, response)
+                    self._credentials.record_rate_limited(credential, cooldown_seconds)
+                    message = f'Rate limited. Resting token for {cooldown_seconds:.1f} seconds...'
+                elif response.status_code in Client.AUTH_ERROR_STATUS_CODES:
+                    self._credentials.record_auth_error(credential)
+                    if not self._credentials.has_usable(credential):
+                        return response
+                    message = f'Bad response: {response.status_code}. Retrying with another token...'
+                elif response.status_code in Client.RETRY_STATUS_CODES:
+                    delay = self._get_retry_delay(attempt, response)
+                    message = f'Bad response: {response.status_code}. Retrying in {delay:.1f} seconds...'
+                else:
+                    return response
+                if attempt >= self._max_retries:
+                    return response
+                logger.warning(message)
+
+            self.stats.record_retry()
+            attempt += 1
+            if delay > 0:
+                time.sleep(delay)
+
+    def _post_authorized(self, operations: List[dict]) -> Optional[List[dict]]:
+        """
+        Send one or more GQL operations in a single request.
+        :param operations:
+        :return: The decoded result of each operation, in the same order as `operations`. Each result contains either
+        'data' or 'errors'. None is returned if the request as a whole failed.
+        """
+        assert len(self._credentials) > 0, "Missing OAuth token!"
+
+        data = json.dumps(operations)
+        response = self._post(
+            data,
             headers={
-                'Authorization': f'OAuth {self._oauth_token}',
                 #'Client-Id': self._client_id,
                 #'Client-Version': 'fb9b8666-ae21-4697-a49b-69595ea176aa',
                 #'Client-Session-Id': self._client_session_id,
                 'Content-Type': 'text/plain;charset=UTF-8',
                 #'User-Agent': Client.USER_AGENT_ANDROID_TV,
                 #'X-Device-Id': self._device_id
-            },
-            data=data
+            }
         )
 
         if not response.ok:
             logger.error(f'Bad response: {response.status_code}')
-            logger.debug(f'Request : {response.request.headers} {response.request.body}')
+            logger.debug(f'Request : {data}')
             logger.debug(f'Response: {response.text}')
             return None
 
-        response_json = response.json()[0]
+        try:
+            results = response.json()
+        except ValueError as e:
+            logger.exception('Bad response format!', exc_info=e)
+            logger.debug(f'Request : {data}')
+            logger.debug(f'Response: {response.text}')
+            return None
 
-        errors = response_json.get('errors', None)
-        if errors is not None:
-            logger.error(f'Found errors in response!')
-            logger.debug(errors)
+        # Single operations may be returned without being wrapped in a list
+        if isinstance(results, dict):
+            results = [results]
+
+        if not isinstance(results, list) or len(results) != len(operations):
+            logger.error(f'Expected {len(operations)} results but got: {results}')
             return None
 
-        return response
+        # Check every operation for errors since some operations in a batch can fail while others succeed
+        for operation, result in zip(operations, results):
+            errors = result.get('errors', None)
+            if errors is not None:
+                logger.error(f'Found errors in response for operation: {operation["operationName"]} {operation.get("variables", "")}')
+                logger.debug(errors)
+
+        return results
 
+    @metrics.timed('twitch.get_drop_campaigns')
     def get_drop_campaigns(self):
-        response = self._post_authorized(json.dumps([{
+        results = self._post_authorized([{
             'operationName': 'ViewerDropsDashboard',
             'extensions': {
                 'persistedQuery': {
@@ -64,22 +431,27 @@ class Client:
                     "sha256Hash": "e8b98b52bbd7ccd37d0b671ad0d47be5238caa5bea637d2a65776175b4a23a64"
                 }
             }
-        }]))
+        }])
 
-        if response is None:
+        if results is None or 'errors' in results[0]:
             return None
 
-        response_json = response.json()
         try:
-            return response_json[0]['data']['currentUser']['dropCampaigns']
+            return results[0]['data']['currentUser']['dropCampaigns']
         except Exception as e:
             logger.exception('Bad response format!', exc_info=e)
-            logger.debug(f'Request : {response.request.headers} {response.request.body}')
-            logger.debug(f'Response: {response_json}')
+            logger.debug(f'Response: {results[0]}')
 
         return None
 
+    @metrics.timed('twitch.get_drop_campaign_details')
     def get_drop_campaign_details(self, drop_campaign_ids: List[str]):
+        """
+        Get the details of one or more drop campaigns in a single request.
+        :param drop_campaign_ids:
+        :return: A list containing the details of each campaign, in the same order as `drop_campaign_ids`. If the
+        details of a campaign could not be retrieved, its entry is None. None is returned if the whole request failed.
+        """
         data = []
         for drop_campaign_id in drop_campaign_ids:
             data.append({
@@ -96,18 +468,21 @@ class Client:
                 }
             })
 
-        response = self._post_authorized(json.dumps(data))
+        results = self._post_authorized(data)
 
-        if response is None:
+        if results is None:
             return None
 
-        response_json = response.json()
+        campaign_details = []
+        for result in results:
+            if 'errors' in result:
+                campaign_details.append(None)
+                continue
+            try:
+                campaign_details.append(result['data']['user']['dropCampaign'])
+            except Exception as e:
+                logger.exception('Bad response format!', exc_info=e)
+                logger.debug(f'Response: {result}')
+                campaign_details.append(None)
 
-        try:
-            return [x['data']['user']['dropCampaign'] for x in response_json]
-        except Exception as e:
-            logger.exception('Bad response format!', exc_info=e)
-            logger.debug(f'Request : {response.request.headers} {response.request.body}')
-            logger.debug(f'Response: {response_json}')
-
-        return None
+        return campaign_details
@@ -1,127 +1,503 @@
+import asyncio
+import collections
 import datetime
 import logging
 import time
+from typing import Optional
 
-from google.cloud import firestore
-
+from . import metrics
 from . import twitch
 from . import utils
+from .dispatcher import NotificationDispatcher
+from .expiry_scheduler import ExpiryScheduler
+from .poll_scheduler import PollScheduler
+from .state_cache import StateCache
+from .storage import Storage
 from .utils import get_datetime
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# The maximum number of writes sent to the storage backend at once. This matches the Firestore write batch limit.
+MAX_BATCH_SIZE = 500
+
 
 class TwitchDropsWatchdog:
     """
-    This class is used to poll the Twitch API at regular intervals to check for new Drop Campaigns.
+    This class is used to poll the Twitch API to check for new Drop Campaigns. The time between polls adapts to how
+    often campaigns change and when known campaigns start.
     """
 
-    def __init__(self, twitch_client: twitch.Client, firestore_client: firestore.Client, sleep_delay_seconds: int = 60 * 60 * 1):
+    def __init__(self, twitch_client: twitch.Client, storage: Storage, sleep_delay_seconds: int = 60 * 60 * 1, details_batch_size: int = 25,
+                 max_concurrent_requests: int = 4, max_concurrent_writes: int = 16, full_refresh_interval_seconds: int = 60 * 60 * 6,
+                 min_sleep_delay_seconds: Optional[int] = None, max_sleep_delay_seconds: Optional[int] = None, sleep_jitter: float = 0.1,
+                 state: Optional[dict] = None, max_concurrent_listeners: int = 8, listener_timeout_seconds: float = 60):
         """
         Creates a new TwitchDropsWatchdog.
         :param twitch_client:
-        :param firestore_client:
-        :param sleep_delay_seconds: The number of seconds to wait in between
-        polling the Twitch API. Since new campaigns are not added very often,
+        :param storage: Where campaigns and games are stored.
+        :param sleep_delay_seconds: The usual number of seconds in between
+        polls of the Twitch API. Since new campaigns are not added very often,
         this can be set to a few hours.
+        :param details_batch_size: The maximum number of campaigns to request
+        details for in a single GQL request.
+        :param max_concurrent_requests: The maximum number of Twitch requests
+        that can be in flight at the same time.
+        :param max_concurrent_writes: The maximum number of database operations
+        that can be in flight at the same time.
+        :param full_refresh_interval_seconds: The number of seconds after
+        which the cached database state is reloaded and the details of every
+        campaign are fetched again, even if they appear unchanged.
+        :param min_sleep_delay_seconds: The number of seconds in between polls
+        after a poll found changes. Defaults to a quarter of
+        `sleep_delay_seconds`.
+        :param max_sleep_delay_seconds: The longest number of seconds in
+        between polls while nothing changes. Defaults to twice
+        `sleep_delay_seconds`.
+        :param sleep_jitter: The fraction by which the time in between polls is
+        randomly changed.
+        :param state: A state returned by get_state() before a restart. The
+        watchdog resumes from it instead of reloading every campaign and game
+        from storage and fetching the details of every campaign again.
+        :param max_concurrent_listeners: The maximum number of listeners that
+        can run at the same time. Listeners run in the background, so a slow
+        listener doesn't delay polling or the other listeners.
+        :param listener_timeout_seconds: The number of seconds after which a
+        call to a listener is abandoned.
         """
         self._twitch_client = twitch_client
-        self._firestore_client = firestore_client
-        self._sleep_delay_seconds = sleep_delay_seconds
+        self._storage = storage
+        self._details_batch_size = max(1, details_batch_size)
+        self._max_concurrent_requests = max(1, max_concurrent_requests)
+        self._max_concurrent_writes = max(1, max_concurrent_writes)
+
+        self._cache = StateCache(full_refresh_interval_seconds)
+        self._expiry_scheduler = ExpiryScheduler()
+        self._poll_scheduler = PollScheduler(sleep_delay_seconds, min_sleep_delay_seconds, max_sleep_delay_seconds, jitter=sleep_jitter)
+
+        # The time of the last poll, as a UNIX timestamp
+        self._last_poll_time = None
+
+        self._state = state
+        if state is not None:
+            self._cache.load_state(state['cache'])
+            self._poll_scheduler.interval_seconds = state['interval_seconds']
+            self._last_poll_time = state['last_poll_time']
+            for campaign in self._cache.campaigns.values():
+                self._expiry_scheduler.schedule(campaign['id'], get_datetime(campaign['endAt']))
+            logger.info(f'Resumed with {len(self._cache.campaigns)} campaigns and {len(self._cache.games)} games.')
 
         self._on_new_campaign_details_listeners = []
         self._on_new_games_listeners = []
+        self._dispatcher = NotificationDispatcher(max_workers=max_concurrent_listeners, timeout_seconds=listener_timeout_seconds)
+        self._listener_timeout_seconds = listener_timeout_seconds
+
+        # These are created by _bind_loop() since they belong to the running event loop
+        self._loop = None
+        self._stop_event = None
+        self._expiry_event = None
+        self._twitch_semaphore = None
+        self._storage_semaphore = None
+        self._write_lock = None
 
-    def _add_or_update_campaign_details(self, campaign):
-        return self._add_or_update_document(self._firestore_client.collection('campaigns').document(campaign['id']), campaign)
+    def _bind_loop(self):
+        """
+        Create the synchronization primitives used by the watchdog on the running event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._expiry_event = asyncio.Event()
+        self._twitch_semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+        self._storage_semaphore = asyncio.Semaphore(self._max_concurrent_writes)
+
+        # Held while campaigns are compared with the cache and written, so that expired campaigns are not removed in
+        # between
+        self._write_lock = asyncio.Lock()
 
-    def _add_or_update_game(self, game):
-        return self._add_or_update_document(self._firestore_client.collection('games').document(game['id']), game)
+    async def _run_blocking(self, semaphore: asyncio.Semaphore, f, *args):
+        """
+        Run a blocking function in a worker thread without blocking the event loop.
+        :param semaphore: A semaphore used to limit the number of concurrent calls.
+        :param f:
+        :param args:
+        :return: The return value of `f`.
+        """
+        async with semaphore:
+            return await asyncio.to_thread(f, *args)
 
-    def _add_or_update_document(self, document_reference, data):
-        document_snapshot = document_reference.get()
+    async def _get_drop_campaign_details_chunk(self, campaigns):
+        try:
+            campaign_details = await self._run_blocking(self._twitch_semaphore, self._twitch_client.get_drop_campaign_details, [campaign['id'] for campaign in campaigns])
+        except Exception as e:
+            logger.error('Error getting drop campaign details!', exc_info=e)
+            campaign_details = None
 
-        # If this document already exists in our database, check if it changed
-        if document_snapshot.exists:
-            before = document_snapshot.to_dict()
-            document_reference.update(data)
-            after = document_reference.get().to_dict()
-            if before != after:
-                logger.debug('Document data changed!')
-            return False
+        if campaign_details is None or len(campaign_details) != len(campaigns):
+            campaign_details = [None] * len(campaigns)
+
+        failed_indices = [i for i, x in enumerate(campaign_details) if x is None]
+        if len(failed_indices) == 0:
+            return campaign_details
+
+        # Fall back to the dashboard campaign if the details for a single campaign can't be retrieved
+        if len(campaigns) == 1:
+            logger.error('Failed to get drop campaign details for campaign: ' + campaigns[0]['id'])
+            return list(campaigns)
+
+        # Retry only the campaigns that failed. If they all failed, split the chunk in half to isolate the bad ones.
+        failed_campaigns = [campaigns[i] for i in failed_indices]
+        if len(failed_campaigns) == len(campaigns):
+            middle = len(campaigns) // 2
+            first, second = await asyncio.gather(
+                self._get_drop_campaign_details_chunk(campaigns[:middle]),
+                self._get_drop_campaign_details_chunk(campaigns[middle:])
+            )
+            return first + second
+        for i, x in zip(failed_indices, await self._get_drop_campaign_details_chunk(failed_campaigns)):
+            campaign_details[i] = x
+        return campaign_details
+
+    async def _load_collections(self):
+        """
+        Load every campaign and game from storage.
+        :return: A (campaigns, games) tuple of dictionaries mapping document IDs to document data.
+        """
+        return await asyncio.gather(
+            self._run_blocking(self._storage_semaphore, self._storage.get_campaigns),
+            self._run_blocking(self._storage_semaphore, self._storage.get_games)
+        )
+
+    async def _commit_writes(self, writes):
+        """
+        Commit a list of writes using as few storage calls as possible.
+        :param writes: A list of (operation, collection name, document ID, data) tuples, where operation is one of
+        'set', 'update', or 'delete'.
+        """
+        chunks = [writes[i:i + MAX_BATCH_SIZE] for i in range(0, len(writes), MAX_BATCH_SIZE)]
+        metrics.increment('watchdog.writes', len(writes))
+        await asyncio.gather(*[self._run_blocking(self._storage_semaphore, self._storage.write, chunk) for chunk in chunks])
+
+    @metrics.timed('watchdog.add_or_update_documents')
+    async def _add_or_update_documents(self, collection_name, existing_documents, documents, change_summary):
+        """
+        Compare documents against their current state in the database and write only the ones that are new or changed.
+        :param collection_name:
+        :param existing_documents: A dictionary mapping document IDs to their current data in the database.
+        :param documents: The documents to add or update. Each document must have an 'id' field.
+        :param change_summary: A Counter that is updated with the name of every field that changed.
+        :return: A list of the documents that were not in the database before.
+        """
+        writes = []
+        new_documents = []
+        for data in documents:
+            before = existing_documents.get(data['id'])
 
-        # Add a 'created' field to the document so we know when it was added to the database
-        data['created'] = utils.get_timestamp()
+            if before is None:
 
-        # Add document to database
-        document_reference.set(data)
-        return True
+                # Add a 'created' field to the document so we know when it was added to the database
+                data = dict(data, created=utils.get_timestamp())
 
-    def _call_all(self, callables, parameters):
-        for f in callables:
+                writes.append(('set', collection_name, data['id'], data))
+                new_documents.append(data)
+                continue
+
+            # Only write the fields that changed
+            changed_fields = [key for key, value in data.items() if key not in before or before[key] != value]
+            if len(changed_fields) > 0:
+                writes.append(('update', collection_name, data['id'], {key: data[key] for key in changed_fields}))
+                change_summary.update(changed_fields)
+
+        await self._commit_writes(writes)
+
+        # Keep the known database state up to date
+        for operation, _, document_id, data in writes:
+            if operation == 'set':
+                existing_documents[document_id] = data
+            else:
+                existing_documents[document_id].update(data)
+
+        return new_documents
+
+    async def _update_campaigns(self, campaigns, existing_campaigns, change_summary):
+        """
+        Get the details of the given campaigns and add or update them in the database. Each chunk of campaigns is
+        written to the database as soon as its details are received, so that writes overlap with the remaining requests.
+        :param campaigns:
+        :param existing_campaigns: A dictionary mapping campaign IDs to their current data in the database.
+        :param change_summary:
+        :return: A list of the campaign details that were not in the database before.
+        """
+        chunks = [campaigns[i:i + self._details_batch_size] for i in range(0, len(campaigns), self._details_batch_size)]
+        results = await asyncio.gather(*[self._update_campaigns_chunk(chunk, existing_campaigns, change_summary) for chunk in chunks])
+        return [campaign_details for result in results for campaign_details in result]
+
+    async def _update_campaigns_chunk(self, campaigns, existing_campaigns, change_summary):
+        all_campaign_details = await self._get_drop_campaign_details_chunk(campaigns)
+
+        # Store start and end times as timestamps so that they can be used in range queries
+        documents = [dict(x, startAt=get_datetime(x['startAt']), endAt=get_datetime(x['endAt'])) for x in all_campaign_details]
+
+        new_campaign_details = await self._add_or_update_documents('campaigns', existing_campaigns, documents, change_summary)
+        for document in documents:
+            self._schedule_expiry(document)
+
+        # Campaigns that fell back to their dashboard data are fetched again on the next poll
+        for campaign, campaign_details in zip(campaigns, all_campaign_details):
+            if campaign_details is not campaign:
+                self._cache.set_campaign_fetched(campaign)
+        for campaign_details in new_campaign_details:
+            logger.info('New campaign details: ' + campaign_details['game']['displayName'] + ' ' + campaign_details['name'])
+        return new_campaign_details
+
+    async def _update_games(self, games, existing_games, change_summary):
+        """
+        Add or update the given games in the database.
+        :param games:
+        :param existing_games: A dictionary mapping game IDs to their current data in the database.
+        :param change_summary:
+        :return: A list of the games that were not in the database before.
+        """
+        new_games = await self._add_or_update_documents('games', existing_games, games, change_summary)
+        for game in new_games:
+            logger.info('New game: ' + game['displayName'])
+        return new_games
+
+    def _schedule_expiry(self, campaign):
+        self._expiry_scheduler.schedule(campaign['id'], get_datetime(campaign['endAt']))
+
+        # Wake up the expiry task in case this campaign ends before the one it is waiting for
+        self._expiry_event.set()
+
+    @metrics.timed('watchdog.remove_expired_campaigns')
+    async def _remove_expired_campaigns(self):
+        """
+        Remove campaigns that have ended from the database.
+        """
+        async with self._write_lock:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            expired_campaign_ids = self._expiry_scheduler.pop_expired(now)
+            if len(expired_campaign_ids) == 0:
+                return
             try:
-                f(parameters)
-            except Exception as e:
-                logger.exception('Exception occurred while calling listener!', exc_info=e)
+                await self._commit_writes([('delete', 'campaigns', campaign_id, None) for campaign_id in expired_campaign_ids])
+            except Exception:
+                # Try again later
+                for campaign_id in expired_campaign_ids:
+                    self._expiry_scheduler.schedule(campaign_id, now)
+                raise
+            for campaign_id in expired_campaign_ids:
+                self._cache.remove_campaign(campaign_id)
+        metrics.increment('watchdog.expired_campaigns', len(expired_campaign_ids))
+        logger.info(f'Removed {len(expired_campaign_ids)} expired campaigns.')
 
-    def start(self):
+    async def _run_expiry(self):
+        """
+        Remove campaigns from the database as soon as they end, independently of the polling interval.
+        """
         while True:
-
+            self._expiry_event.clear()
+            next_expiry_time = self._expiry_scheduler.get_next_expiry_time()
+            timeout = None
+            if next_expiry_time is not None:
+                timeout = max(0.0, (next_expiry_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
             try:
+                await asyncio.wait_for(self._expiry_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
 
-                # Remove expired campaigns from database
-                for document_snapshot in self._firestore_client.collection('campaigns').stream():
-                    d = document_snapshot.to_dict()
-                    end_date = get_datetime(d['endAt'])
-                    if end_date < datetime.datetime.now(datetime.timezone.utc):
-                        document_snapshot.reference.delete()
-
-                # Get all drop campaigns
-                logger.info('Updating campaign list...')
-                campaigns = self._twitch_client.get_drop_campaigns()
-                logger.info(f'Found {len(campaigns)} campaigns.')
-
-                # Update drop campaign database and find new campaigns
-                logger.info('Updating database...')
-                new_campaign_details = []
-                new_games = []
-                for campaign in campaigns:
-
-                    # Ignore campaigns that have already ended
-                    if datetime.datetime.now(datetime.timezone.utc) >= get_datetime(campaign['endAt']):
-                        continue
-
-                    # Get campaign details
-                    try:
-                        campaign_details = self._twitch_client.get_drop_campaign_details([campaign['id']])[0]
-                    except Exception as e:
-                        logger.error('Error getting drop campaign details!', exc_info=e)
-                        campaign_details = campaign
-
-                    # Update database
-                    if self._add_or_update_campaign_details(campaign_details):
-                        new_campaign_details.append(campaign_details)
-                        logger.info('New campaign details: ' + campaign['game']['displayName'] + ' ' + campaign['name'])
-                    game = campaign['game']
-                    if self._add_or_update_game(game):
-                        new_games.append(game)
-                        logger.info('New game: ' + game['displayName'])
-
-                # Notify listeners
-                if len(new_campaign_details) > 0:
-                    self._call_all(self._on_new_campaign_details_listeners, list(new_campaign_details))
-                if len(new_games) > 0:
-                    self._call_all(self._on_new_games_listeners, list(new_games))
+            try:
+                await self._remove_expired_campaigns()
             except Exception as e:
-                logger.error('', exc_info=e)
+                logger.error('Failed to remove expired campaigns!', exc_info=e)
+
+                # Avoid retrying in a tight loop
+                await asyncio.sleep(60)
+
+    async def _poll(self) -> bool:
+        """
+        Check for new and changed campaigns and update the database.
+        :return: True if any campaigns or games were added or changed.
+        """
+        # Load the current state of the database if we don't have it yet, or if it's time for a full refresh
+        if self._cache.is_stale():
+            logger.info('Loading campaigns and games from database...')
+            self._cache.warm(*await self._load_collections())
+            self._expiry_scheduler.clear()
+            for campaign in self._cache.campaigns.values():
+                self._schedule_expiry(campaign)
+        existing_campaigns = self._cache.campaigns
+        existing_games = self._cache.games
+
+        # Remove expired campaigns from database
+        await self._remove_expired_campaigns()
+
+        # Get all drop campaigns
+        logger.info('Updating campaign list...')
+        campaigns = await self._run_blocking(self._twitch_semaphore, self._twitch_client.get_drop_campaigns)
+        if campaigns is None:
+            logger.error('Failed to get drop campaigns!')
+            return False
+        logger.info(f'Found {len(campaigns)} campaigns.')
+
+        # Ignore campaigns that have already ended
+        now = datetime.datetime.now(datetime.timezone.utc)
+        campaigns = [campaign for campaign in campaigns if now < get_datetime(campaign['endAt'])]
+
+        # Remember when upcoming campaigns start so that they are picked up soon after
+        self._poll_scheduler.set_start_times(x for x in (get_datetime(campaign['startAt']) for campaign in campaigns) if x > now)
+
+        # Skip campaigns that haven't changed since their details were last fetched
+        campaigns = [campaign for campaign in campaigns if not self._cache.is_campaign_unchanged(campaign)]
+        logger.info(f'{len(campaigns)} campaigns changed. Campaign cache: {self._cache.hits} hits, {self._cache.misses} misses.')
+        metrics.increment('watchdog.changed_campaigns', len(campaigns))
+
+        # Update drop campaign database and find new campaigns
+        logger.info('Updating database...')
+        campaigns_change_summary = collections.Counter()
+        games_change_summary = collections.Counter()
+        async with self._write_lock:
+            # Campaigns that ended while we waited for the lock may have been removed already, and would look new
+            now = datetime.datetime.now(datetime.timezone.utc)
+            campaigns = [campaign for campaign in campaigns if now < get_datetime(campaign['endAt'])]
 
-            # Sleep
-            logger.info(f'Sleeping for {self._sleep_delay_seconds} seconds...')
-            time.sleep(self._sleep_delay_seconds)
+            games = list({campaign['game']['id']: campaign['game'] for campaign in campaigns}.values())
+            new_campaign_details, new_games = await asyncio.gather(
+                self._update_campaigns(campaigns, existing_campaigns, campaigns_change_summary),
+                self._update_games(games, existing_games, games_change_summary)
+            )
+        if len(campaigns_change_summary) > 0:
+            logger.info(f'Changed campaign fields: {dict(campaigns_change_summary)}')
+        if len(games_change_summary) > 0:
+            logger.info(f'Changed game fields: {dict(games_change_summary)}')
+
+        metrics.increment('watchdog.new_campaigns', len(new_campaign_details))
+        metrics.increment('watchdog.new_games', len(new_games))
+
+        # Notify listeners in the background
+        if len(new_campaign_details) > 0:
+            self._dispatcher.dispatch(self._on_new_campaign_details_listeners, list(new_campaign_details))
+        if len(new_games) > 0:
+            self._dispatcher.dispatch(self._on_new_games_listeners, list(new_games))
+
+        return len(new_campaign_details) > 0 or len(new_games) > 0 or len(campaigns_change_summary) > 0 or len(games_change_summary) > 0
+
+    async def _poll_and_log(self) -> bool:
+        """
+        Poll once and log a summary of where the time went.
+        :return: True if the poll found changes.
+        """
+        snapshot = metrics.get_snapshot()
+        start_time = time.perf_counter()
+        changed = False
+        try:
+            changed = await self._poll()
+        except Exception as e:
+            logger.error('', exc_info=e)
+        duration = time.perf_counter() - start_time
+        metrics.observe('watchdog.poll', duration)
+        logger.info(f'Poll finished in {duration:.3f}s. {metrics.get_summary(snapshot)}')
+        logger.debug(f'Twitch client: {self._twitch_client.stats}')
+
+        # Take the snapshot here rather than in get_state(), since the cache is only consistent in between polls
+        self._last_poll_time = time.time()
+        self._state = {
+            'cache': self._cache.get_state(),
+            'interval_seconds': self._poll_scheduler.interval_seconds,
+            'last_poll_time': self._last_poll_time
+        }
+        return changed
+
+    def get_state(self) -> Optional[dict]:
+        """
+        Get the state of the watchdog after the last poll, so that it can be saved and passed to the constructor after
+        a restart. This can be called from any thread.
+        :return: The state, or None if the watchdog has not polled yet.
+        """
+        return self._state
+
+    async def _sleep(self, delay: float):
+        """
+        Sleep until the next poll or until we are stopped.
+        """
+        logger.info(f'Sleeping for {delay:.0f} seconds...')
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """
+        Poll the Twitch API until `stop()` is called or the task is cancelled.
+        """
+        self._bind_loop()
+        expiry_task = asyncio.create_task(self._run_expiry())
+
+        try:
+            # Keep to the schedule from before a restart, as if the time since the last poll was spent polling
+            if self._last_poll_time is not None:
+                await self._sleep(self._poll_scheduler.get_delay(datetime.datetime.now(datetime.timezone.utc), time.time() - self._last_poll_time))
+
+            while not self._stop_event.is_set():
+
+                start_time = time.perf_counter()
+                self._poll_scheduler.record_poll(await self._poll_and_log())
+
+                delay = self._poll_scheduler.get_delay(datetime.datetime.now(datetime.timezone.utc), time.perf_counter() - start_time)
+                await self._sleep(delay)
+        except asyncio.CancelledError:
+            logger.info('Watchdog cancelled.')
+            raise
+        finally:
+            expiry_task.cancel()
+            try:
+                await expiry_task
+            except asyncio.CancelledError:
+                pass
+            await self._dispatcher.close(self._listener_timeout_seconds)
+            logger.info('Watchdog stopped.')
+
+    async def run_once(self) -> bool:
+        """
+        Poll the Twitch API once, for example when the watchdog is run by a scheduled job.
+        :return: True if the poll found changes.
+        """
+        self._bind_loop()
+        try:
+            return await self._poll_and_log()
+        finally:
+            await self._dispatcher.close(self._listener_timeout_seconds)
+
+    def start(self, once: bool = False):
+        """
+        Run the watchdog on a new event loop. This blocks until the watchdog is stopped.
+        :param once: Poll only once instead of until stopped.
+        """
+        try:
+            asyncio.run(self.run_once() if once else self.run())
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        """
+        Stop the watchdog after the current poll finishes. This can be called from any thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    @property
+    def cache(self) -> StateCache:
+        return self._cache
 
     def add_on_new_campaign_details_listener(self, listener):
+        """
+        Add a listener that is called with a list of new campaign details. The listener can be a regular function or a
+        coroutine function. It is called in the background, after the poll that found the campaigns.
+        """
         self._on_new_campaign_details_listeners.append(listener)
 
     def add_on_new_games_listener(self, listener):
+        """
+        Add a listener that is called with a list of new games. The listener can be a regular function or a coroutine
+        function. It is called in the background, after the poll that found the games.
+        """
         self._on_new_games_listeners.append(listener)
@@ -0,0 +1,92 @@
+import collections
+import threading
+
+
+class UserIndex:
+    """
+    Keeps every user in memory along with an index from game IDs to the users that are subscribed to them, so that
+    notifications only need to look at the users that are affected.
+    """
+
+    def __init__(self):
+        # Users are updated from the Firestore listener thread and read from the watchdog
+        self._lock = threading.Lock()
+
+        # Map emails to users
+        self._users = {}
+
+        # Map game IDs to the emails of the users that are subscribed to them
+        self._game_subscribers = collections.defaultdict(set)
+
+        # Emails of users that haven't selected any games, which means they are subscribed to all of them
+        self._all_games_subscribers = set()
+
+        # Emails of users that want to be notified about new games
+        self._new_games_subscribers = set()
+
+    def _remove(self, email):
+        user = self._users.pop(email, None)
+        if user is None:
+            return
+        for game_id in user.get('games', []):
+            subscribers = self._game_subscribers.get(game_id)
+            if subscribers is not None:
+                subscribers.discard(email)
+                if len(subscribers) == 0:
+                    del self._game_subscribers[game_id]
+        self._all_games_subscribers.discard(email)
+        self._new_games_subscribers.discard(email)
+
+    def add_or_update(self, user):
+        email = user['email']
+        with self._lock:
+            self._remove(email)
+            self._users[email] = user
+            games = user.get('games', [])
+            if len(games) == 0:
+                self._all_games_subscribers.add(email)
+            for game_id in games:
+                self._game_subscribers[game_id].add(email)
+            if user.get('new_game_notifications', True):
+                self._new_games_subscribers.add(email)
+
+    def remove(self, email):
+        with self._lock:
+            self._remove(email)
+
+    def get(self, email):
+        with self._lock:
+            return self._users.get(email)
+
+    def get_users(self):
+        with self._lock:
+            return list(self._users.values())
+
+    def get_subscribed_campaigns(self, campaigns):
+        """
+        Find the users that are subscribed to each campaign.
+        :param campaigns:
+        :return: A list of (user, campaigns) tuples, one for each user that is subscribed to at least one of the
+        campaigns. The campaigns of each user are in the same order as `campaigns`.
+        """
+        with self._lock:
+            subscribed_campaigns = collections.defaultdict(list)
+            for campaign in campaigns:
+                for email in self._game_subscribers.get(campaign['game']['id'], ()):
+                    subscribed_campaigns[email].append(campaign)
+            if len(campaigns) > 0:
+                for email in self._all_games_subscribers:
+                    subscribed_campaigns[email] = list(campaigns)
+            return [(self._users[email], x) for email, x in subscribed_campaigns.items()]
+
+    def get_new_games_subscribers(self):
+        """
+        Get the users that want to be notified about new games.
+        :return:
+        """
+        with self._lock:
+            return [self._users[email] for email in self._new_games_subscribers]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users)
@@ -1,13 +1,66 @@
 import datetime
+import functools
+import json
+from typing import Union
+
+import pytz
 
 
 def get_timestamp():
     return datetime.datetime.utcnow().replace(microsecond=0, tzinfo=datetime.timezone.utc).isoformat()
 
 
-def get_datetime(timestamp: str) -> datetime.datetime:
-    try:
-        return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f%z")
-    except:
-        pass
-    return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
+@functools.lru_cache(maxsize=4096)
+def _parse_timestamp(timestamp: str) -> datetime.datetime:
+    # Python versions before 3.11 don't accept a 'Z' suffix
+    if timestamp.endswith('Z'):
+        timestamp = timestamp[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(timestamp)
+
+
+def get_datetime(timestamp: Union[str, datetime.datetime]) -> datetime.datetime:
+    """
+    Parse an ISO 8601 timestamp. The same timestamps are parsed many times, so results are cached.
+    :param timestamp: The timestamp to parse. Timestamps stored in Firestore are already datetimes, and are returned
+    as they are.
+    :return:
+    """
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp
+    return _parse_timestamp(timestamp)
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name: str) -> datetime.tzinfo:
+    """
+    Get a timezone by name. This is cached since looking up a timezone is slow compared to converting a time.
+    :param name:
+    :return:
+    :raises pytz.exceptions.UnknownTimeZoneError: If there is no timezone with the given name.
+    """
+    return pytz.timezone(name)
+
+
+def _encode_json(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _decode_json(value: dict):
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def dumps_json(data) -> str:
+    """
+    Serialize an object to compact JSON. Datetimes are encoded so that loads_json() turns them back into datetimes.
+    :param data:
+    :return:
+    """
+    return json.dumps(data, default=_encode_json, separators=(',', ':'))
+
+
+def loads_json(data: str):
+    return json.loads(data, object_hook=_decode_json)
@@ -0,0 +1,223 @@
+import datetime
+import json
+import logging
+import random
+import time
+import urllib.parse
+from typing import List, Optional
+
+import requests
+
+from . import metrics
+from .utils import get_datetime
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+FORMATS = ('discord', 'slack', 'json')
+
+# Discord rejects messages with more than 10 embeds
+MAX_DISCORD_EMBEDS = 10
+
+# Slack rejects messages with more than 50 blocks
+MAX_SLACK_BLOCKS = 50
+
+# Responses with these status codes are considered temporary failures and are retried
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_game_url(game) -> str:
+    return f'https://www.twitch.tv/directory/game/{urllib.parse.quote(game["displayName"])}?tl=c2542d6d-cd10-4532-919b-3d19f30a768b'
+
+
+def get_reward_names(campaign) -> List[str]:
+    return [edge['benefit']['name'] for drop in campaign.get('timeBasedDrops') or [] for edge in drop.get('benefitEdges') or []]
+
+
+def _encode_json(value):
+    # Campaigns from the watchdog have datetimes, which webhooks receive as ISO 8601 strings
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def format_time(value) -> str:
+    return get_datetime(value).strftime('%Y-%m-%d %H:%M %Z')
+
+
+def create_session(pool_size: int = 10) -> requests.Session:
+    """
+    Create a session that keeps connections to webhook servers open between requests. It can be shared by every
+    channel.
+    :param pool_size: The maximum number of connections to keep open to each server.
+    :return:
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class WebhookChannel:
+    """
+    Sends notifications about new campaigns and games to a webhook, such as a Discord or Slack incoming webhook. The
+    notifications of a poll are batched into as few requests as the webhook accepts.
+    """
+
+    def __init__(self, url: str, format: str = 'json', session: Optional[requests.Session] = None, name: Optional[str] = None, batch_size: int = 10,
+                 timeout_seconds: float = 10, max_retries: int = 3, backoff_seconds: float = 1, max_backoff_seconds: float = 60):
+        """
+        Creates a new WebhookChannel.
+        :param url: The URL to POST notifications to.
+        :param format: The format of the payload. 'discord' and 'slack' send messages for their incoming webhooks, and
+        'json' sends the campaigns and games as they are.
+        :param session: The session to send requests with. Defaults to a new one.
+        :param name: A name for logs. Defaults to the host of the URL, since webhook URLs contain secrets.
+        :param batch_size: The maximum number of campaigns or games to send in a single request. This is capped by
+        the number of embeds or blocks that Discord and Slack accept.
+        :param timeout_seconds: The number of seconds to wait for the server to respond before giving up on a request.
+        :param max_retries: The maximum number of times to retry a request that failed with a temporary error.
+        :param backoff_seconds: The delay before the first retry. This is doubled after every retry.
+        :param max_backoff_seconds: The maximum delay between retries. This also limits how long a Retry-After header can
+        make us wait.
+        """
+        if format not in FORMATS:
+            raise ValueError(f'Unknown webhook format: {format}')
+        self._url = url
+        self._format = format
+        self._session = session or create_session()
+        self.name = name or urllib.parse.urlparse(url).netloc
+        self._batch_size = max(1, batch_size)
+        if format == 'discord':
+            self._batch_size = min(self._batch_size, MAX_DISCORD_EMBEDS)
+        elif format == 'slack':
+            self._batch_size = min(self._batch_size, MAX_SLACK_BLOCKS - 1)
+        self._timeout_seconds = timeout_seconds
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+
+    @classmethod
+    def from_json(cls, data: dict, session: Optional[requests.Session] = None) -> 'WebhookChannel':
+        """
+        Create a channel from an entry of the webhooks file.
+        :param data: A dictionary with 'url', and optionally 'format', 'name', and 'batch_size'.
+        :param session:
+        :return:
+        """
+        return cls(data['url'], data.get('format', 'json'), session=session, name=data.get('name'), batch_size=data.get('batch_size', 10))
+
+    def _get_retry_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        delay = self._backoff_seconds * (2 ** attempt) * random.uniform(0.8, 1.2)
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            try:
+                if retry_after is not None:
+                    delay = float(retry_after)
+                elif response.status_code == 429:
+                    # Discord also reports the delay in the body
+                    delay = float(response.json()['retry_after'])
+            except (ValueError, KeyError, TypeError):
+                pass
+        return min(max(delay, 0.0), self._max_backoff_seconds)
+
+    def _post(self, payload) -> bool:
+        """
+        Post a payload, retrying temporary failures with exponential backoff.
+        :param payload:
+        :return: True if the payload was accepted.
+        """
+        data = json.dumps(payload, default=_encode_json)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                with metrics.span('webhook.post'):
+                    response = self._session.post(self._url, data=data, headers={'Content-Type': 'application/json'}, timeout=self._timeout_seconds)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                message = f'Request failed: {e}.'
+            else:
+                if response.ok:
+                    metrics.increment('webhook.sent')
+                    return True
+                if response.status_code not in RETRY_STATUS_CODES:
+                    logger.error(f'Webhook {self.name} rejected a notification: {response.status_code} {response.text[:200]}')
+                    metrics.increment('webhook.failed')
+                    return False
+                message = f'Bad response: {response.status_code}.'
+            if attempt >= self._max_retries:
+                logger.error(f'Failed to send a notification to webhook {self.name}! {message}')
+                metrics.increment('webhook.failed')
+                return False
+            delay = self._get_retry_delay(attempt, response)
+            logger.warning(f'Webhook {self.name}: {message} Retrying in {delay:.1f} seconds...')
+            attempt += 1
+            time.sleep(delay)
+
+    def _get_campaigns_payload(self, campaigns):
+        if self._format == 'discord':
+            return {
+                'content': 'New Twitch drop campaigns!',
+                'embeds': [{
+                    'title': f'{campaign["game"]["displayName"]} | {campaign["name"]}'[:256],
+                    'url': get_game_url(campaign['game']),
+                    'description': '\n'.join([
+                        f'Starts <t:{int(get_datetime(campaign["startAt"]).timestamp())}:R>, ends <t:{int(get_datetime(campaign["endAt"]).timestamp())}:R>',
+                        *get_reward_names(campaign)
+                    ])[:4096],
+                    'thumbnail': {'url': campaign['game'].get('boxArtURL')}
+                } for campaign in campaigns]
+            }
+        if self._format == 'slack':
+            return {
+                'text': f'{len(campaigns)} new Twitch drop campaign(s)',
+                'blocks': [{'type': 'header', 'text': {'type': 'plain_text', 'text': 'New Twitch drop campaigns!'}}] + [{
+                    'type': 'section',
+                    'text': {
+                        'type': 'mrkdwn',
+                        'text': f'*<{get_game_url(campaign["game"])}|{campaign["game"]["displayName"]}>* | {campaign["name"]}\n'
+                                f'Ends {format_time(campaign["endAt"])}\n{", ".join(get_reward_names(campaign))}'[:3000]
+                    }
+                } for campaign in campaigns]
+            }
+        return {'type': 'new_campaigns', 'campaigns': campaigns}
+
+    def _get_games_payload(self, games):
+        if self._format == 'discord':
+            return {
+                'content': 'New games are available for notifications!',
+                'embeds': [{'title': game['displayName'][:256], 'url': get_game_url(game)} for game in games]
+            }
+        if self._format == 'slack':
+            return {
+                'text': f'{len(games)} new game(s) are available for notifications',
+                'blocks': [{'type': 'header', 'text': {'type': 'plain_text', 'text': 'New games are available for notifications!'}}] + [{
+                    'type': 'section',
+                    'text': {'type': 'mrkdwn', 'text': f'*<{get_game_url(game)}|{game["displayName"]}>*'}
+                } for game in games]
+            }
+        return {'type': 'new_games', 'games': games}
+
+    def _send_batches(self, items, get_payload):
+        for i in range(0, len(items), self._batch_size):
+            self._post(get_payload(items[i:i + self._batch_size]))
+
+    def on_new_campaign_details(self, campaigns):
+        """
+        Send new campaigns. This can be used as a watchdog listener.
+        :param campaigns:
+        """
+        campaigns = sorted(campaigns, key=lambda x: (x['game']['displayName'], x['name']))
+        self._send_batches(campaigns, self._get_campaigns_payload)
+
+    def on_new_games(self, games):
+        """
+        Send new games. This can be used as a watchdog listener.
+        :param games:
+        """
+        games = sorted(games, key=lambda x: x['displayName'])
+        self._send_batches(games, self._get_games_payload)
+
+    def __repr__(self):
+        return f'WebhookChannel({self.name}, format={self._format})'
@@ -0,0 +1,10 @@
+#!/bin/sh
+# Deploy the web app to Google App Engine. Only this directory is uploaded, so the twitch_drops_notifier package that
+# the app imports its storage from is copied into it first. Any arguments are passed to `gcloud app deploy`.
+set -e
+cd "$(dirname "$0")"
+rm -rf twitch_drops_notifier
+trap 'rm -rf twitch_drops_notifier' EXIT
+cp -r ../twitch_drops_notifier twitch_drops_notifier
+find twitch_drops_notifier -name '__pycache__' -prune -exec rm -rf {} +
+gcloud app deploy "$@"
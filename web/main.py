@@ -1,10 +1,16 @@
 import datetime
+import hashlib
+import json
+import os
+import threading
+import time
 import uuid
 
-from flask import Flask, render_template, request
-from google.cloud import firestore
+from flask import Flask, render_template, request, make_response
 import pytz
 
+from twitch_drops_notifier.storage import create_storage
+
 
 def get_datetime(timestamp):
     return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
@@ -12,31 +18,134 @@ def get_datetime(timestamp):
 
 app = Flask(__name__)
 
-firestore_client = firestore.Client()
+# The storage backend can be changed for small deployments, for example STORAGE_BACKEND=sqlite with STORAGE_PATH set to
+# the database file of the notifier. The memory backend can't be used, since the notifier runs in another process.
+storage_backend = os.environ.get('STORAGE_BACKEND', 'firestore')
+if storage_backend == 'memory':
+    raise ValueError('The web app can not use the memory storage backend, since the notifier would not see its users.')
+storage = create_storage(storage_backend, os.environ.get('STORAGE_PATH'))
+
+
+class GamesCache:
+    """
+    Process level cache of the sorted games list and the parts of the index page that are the same for every visitor.
+    The cache is refreshed by a listener on the 'games' collection, and also expires after a while in case the
+    listener is not running, for example while the instance is idle.
+    """
+
+    def __init__(self, ttl_seconds: float = 5 * 60):
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._games = None
+        self._games_by_id = {}
+        self._fragments = None
+        self._version = None
+        self._expiry_time = 0
+
+    def _set_games(self, games):
+        games = list(sorted(games, key=lambda x: x['displayName']))
+        version = hashlib.sha1(json.dumps([(x['id'], x['displayName']) for x in games]).encode('utf-8')).hexdigest()
+        with self._lock:
+            if version != self._version:
+                self._fragments = None
+            self._games = games
+            self._version = version
+            self._expiry_time = time.monotonic() + self._ttl_seconds
+
+    def on_games_changed(self, changes):
+        with self._lock:
+            for change in changes:
+                if change.type == 'REMOVED':
+                    self._games_by_id.pop(change.id, None)
+                else:
+                    self._games_by_id[change.id] = change.data
+            games = list(self._games_by_id.values())
+        self._set_games(games)
+
+    def get(self):
+        """
+        Get the sorted games list and the rendered games table and timezone options.
+        :return: A (games, fragments, version) tuple. The version changes whenever the games change.
+        """
+        with self._lock:
+            expired = self._games is None or time.monotonic() >= self._expiry_time
+        if expired:
+            games = storage.get_games()
+            with self._lock:
+                self._games_by_id = games
+            self._set_games(list(games.values()))
+
+        with self._lock:
+            if self._fragments is None:
+                self._fragments = {
+                    'games_table': render_template('games_table.html', games=self._games),
+                    'timezone_options': render_template('timezone_options.html', timezones=pytz.common_timezones)
+                }
+            return self._games, self._fragments, self._version
+
+
+games_cache = GamesCache()
+storage.watch('games', games_cache.on_games_changed)
+
+
+def get_user(user_id):
+    """
+    Find a user by ID.
+    :param user_id:
+    :return: The user, or None if there is no user with this ID.
+    """
+    if user_id is None:
+        return None
+    return storage.get_user_by_id(user_id)
+
+
+def update_user(user_id, form):
+    def update(user):
+        # Update games
+        games = []
+        for key, value in form.items():
+            if key.startswith('game_'):
+                games.append(key.split('game_')[1])
+        user['games'] = games
+
+        # Update new games notification
+        user['new_game_notifications'] = form.get('new_game_notifications', 'off') == 'on'
+
+        # Update timezone
+        user['timezone'] = form['timezone']
+
+        return user
+
+    if user_id is None:
+        return False
+    return storage.update_user(user_id, update)
 
 
 @app.route('/')
 def index():
     # Find user
-    user = None
-    user_id = request.args.get('id', None)
-    if user_id is not None:
-        for document in firestore_client.collection('users').list_documents():
-            d = document.get().to_dict()
-            if d['id'] == user_id:
-                user = d
-                break
-
-    # Games
-    games = []
-    for game_document in firestore_client.collection('games').list_documents():
-        games.append(game_document.get().to_dict())
-    games = list(sorted(games, key=lambda x: x['displayName']))
+    user = get_user(request.args.get('id', None))
+
+    # Games and timezones
+    games, fragments, version = games_cache.get()
 
-    # Timezones
-    timezones = pytz.common_timezones
+    # The page only changes when the games or the user change
+    etag = version
+    if user is not None:
+        etag = hashlib.sha1((version + json.dumps(user, sort_keys=True, default=str)).encode('utf-8')).hexdigest()
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template('index.html', user=user, **fragments))
+    response.set_etag(etag)
+
+    # Pages with user preferences must not be stored by shared caches
+    if user is None:
+        response.headers['Cache-Control'] = 'public, max-age=60'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
 
-    return render_template('index.html', user=user, games=games, timezones=timezones)
+    return response
 
 
 @app.route('/subscribe', methods=['POST'])
@@ -46,10 +155,6 @@ def subscribe():
     if 'email' not in request.form or len(request.form['email']) <= 1:
         return render_template('error.html', message='Invalid email.')
 
-    # Make sure this user is not already subscribed
-    if firestore_client.collection('users').document(request.form['email']).get().exists:
-        return render_template('error.html', message='This user is already subscribed!')
-
     games = []
     for key, value in request.form.items():
         if key.startswith('game_'):
@@ -64,50 +169,25 @@ def subscribe():
         'new_game_notifications': request.form.get('new_game_notifications', 'off') == 'on'
     }
 
-    firestore_client.collection('users').document(user['email']).set(user)
+    # Add the user and their ID mapping together, unless the user is already subscribed
+    if not storage.add_user(user):
+        return render_template('error.html', message='This user is already subscribed!')
 
     return render_template('success.html', message='You have subscribed to notifications!')
 
 
 @app.route('/update', methods=['POST'])
 def update():
-
-    # Find user
-    for document in firestore_client.collection('users').list_documents():
-        d = document.get().to_dict()
-        if d['id'] == request.args.get('id'):
-            user = d
-            break
-    else:
+    if not update_user(request.args.get('id'), request.form):
         return render_template('error.html', message='This user is not subscribed.')
 
-    # Update games
-    games = []
-    for key, value in request.form.items():
-        if key.startswith('game_'):
-            games.append(key.split('game_')[1])
-    user['games'] = games
-
-    # Update new games notification
-    user['new_game_notifications'] = request.form.get('new_game_notifications', 'off') == 'on'
-
-    # Update timezone
-    user['timezone'] = request.form['timezone']
-
-    # Update firestore document
-    firestore_client.collection('users').document(user['email']).set(user)
-
     return render_template('success.html', message='Preferences updated!')
 
 
 @app.route('/unsubscribe', methods=['GET'])
 def unsubscribe():
-    for document in firestore_client.collection('users').list_documents():
-        d = document.get().to_dict()
-        if d['id'] == request.args.get('id'):
-            document.delete()
-            break
-    else:
+    user_id = request.args.get('id')
+    if user_id is None or not storage.remove_user(user_id):
         return render_template('error.html', message='This user is not subscribed.')
 
     return render_template('success.html', message='You have been unsubscribed')
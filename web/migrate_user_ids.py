@@ -0,0 +1,41 @@
+"""
+Backfill the 'user_ids' collection, which maps user IDs to emails, for users that subscribed before it existed.
+
+Usage: python migrate_user_ids.py [--dry-run]
+"""
+import argparse
+
+from google.cloud import firestore
+
+# The maximum number of operations allowed in a single Firestore write batch
+MAX_BATCH_SIZE = 500
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run',
+                        help='Only print the number of mappings that would be written.',
+                        dest='dry_run',
+                        action='store_true')
+    args = parser.parse_args()
+
+    firestore_client = firestore.Client()
+
+    # Find users that don't have a mapping yet
+    existing_ids = {snapshot.id for snapshot in firestore_client.collection('user_ids').select([]).stream()}
+    missing = []
+    for snapshot in firestore_client.collection('users').stream():
+        user = snapshot.to_dict()
+        if user['id'] not in existing_ids:
+            missing.append(user)
+    print(f'Found {len(missing)} users without an ID mapping.')
+
+    if args.dry_run:
+        exit(0)
+
+    # Write mappings
+    for i in range(0, len(missing), MAX_BATCH_SIZE):
+        batch = firestore_client.batch()
+        for user in missing[i:i + MAX_BATCH_SIZE]:
+            batch.set(firestore_client.collection('user_ids').document(user['id']), {'email': user['email']})
+        batch.commit()
+        print(f'Wrote {min(i + MAX_BATCH_SIZE, len(missing))} / {len(missing)} mappings.')